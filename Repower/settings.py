@@ -37,6 +37,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'game.middleware.PlayerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -88,6 +89,8 @@ LOGIN_URL = '/login'
 
 SKIP_MAIL_TESTS = False
 
+SKIP_STRESS_TESTS = True
+
 
 # Game settings
 
@@ -101,6 +104,39 @@ COMMANDS_PER_TURN = 5
 
 MAX_BATTLE_ITERATIONS = 30
 
+# Queue turns to be resolved by the resolve_turns command instead of resolving them in the request of the last
+# player getting ready
+RESOLVE_TURNS_IN_BACKGROUND = False
+# Queue a turn again if its worker has not finished it after this many seconds, and give up on it after this many tries
+TURN_RESOLUTION_TIMEOUT = 300
+TURN_RESOLUTION_ATTEMPTS = 3
+
+# Matches store the board every this many turns and log the commands of every turn, so older steps can be replayed
+MATCH_SNAPSHOT_INTERVAL = 10
+# Keep the players and tokens of the steps of this many latest turns, at least 1, and replay older ones from the match
+# log. None keeps all of them.
+KEEP_BOARD_ROWS_FOR_TURNS = None
+# Boards of pruned steps kept in memory once rebuilt
+MATERIALIZED_BOARD_CACHE_SIZE = 256
+
+# Match pages get events from a stream that checks the database this often, and ends after this many seconds to be
+# reopened by the browser, so a request thread is not held for longer
+MATCH_EVENTS_POLL_INTERVAL = 1.0
+MATCH_EVENTS_STREAM_SECONDS = 30
+
+# Rendered images are kept in memory and in this directory. Set it to None to only cache in memory.
+RENDER_CACHE_DIR = os.path.join(BASE_DIR, 'render_cache')
+
+BASE_MAP_CACHE_SIZE = 16
+
+MATCH_MAP_CACHE_SIZE = 64
+
+# The render_static_assets command writes token sprites and base maps here, for the web server to serve them under
+# RENDERED_ASSETS_URL. Templates link to the views drawing them until it has been run.
+RENDERED_ASSETS_DIR = os.path.join(BASE_DIR, 'rendered_assets')
+
+RENDERED_ASSETS_URL = '/rendered/'
+
 # TODO: dev vs production settings
 # http://stackoverflow.com/questions/88259/how-do-you-configure-django-for-simple-development-and-deployment/88331
 # http://stackoverflow.com/questions/4664724/distributing-django-projects-with-unique-secret-keys
\ No newline at end of file
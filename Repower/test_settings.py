@@ -0,0 +1,9 @@
+"""
+Settings for the tests that fork processes, which can not open an in-memory test database:
+
+    python manage.py test game --settings=Repower.test_settings
+"""
+
+from Repower.settings import *  # noqa
+
+DATABASES['default']['TEST'] = {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')}
@@ -1,7 +1,12 @@
+from django.conf import settings
 from django.conf.urls import patterns, include, url
+from django.conf.urls.static import static
 from django.contrib import admin
 
 urlpatterns = patterns('',
                        url(r'^admin/', include(admin.site.urls)),
                        url(r'', include('game.urls')),
 )
+
+# Only in debug mode, web servers serve the pre-rendered images in production
+urlpatterns += static(settings.RENDERED_ASSETS_URL, document_root=settings.RENDERED_ASSETS_DIR)
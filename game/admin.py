@@ -18,3 +18,4 @@ admin.site.register(models.PlayerInTurnStep)
 admin.site.register(models.TokenConversion)
 admin.site.register(models.TokenValueConversion)
 admin.site.register(models.Turn)
+admin.site.register(models.TurnResolutionJob)
@@ -1,11 +1,7 @@
-from game.models import Player
+from game.middleware import get_player
 
 
 def player_processor(request):
     if request.user.is_authenticated():
-        try:
-            player = Player.objects.get_by_user(request.user)
-        except Player.DoesNotExist:
-            player = None
-        return {'player': player}
+        return {'player': get_player(request)}
     return dict()
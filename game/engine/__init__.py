@@ -0,0 +1,8 @@
+"""
+Rules engine working on plain Python objects.
+
+state holds the board, players, tokens and commands, rules resolves a turn without touching the database and
+storage loads a turn from the models and persists what the resolution changed.
+compact stores a board as flat count arrays, for caching and for whole-board computations.
+history logs the commands of every turn with periodic board snapshots, and replays old steps from them.
+"""
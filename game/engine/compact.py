@@ -0,0 +1,142 @@
+from array import array
+
+from game.engine.state import Board, Player, Token
+
+
+MOVED = 1
+CANNOT_MOVE = 2
+RETREATED = 4
+
+PLAYER_DEFEATED = 1
+PLAYER_TIMEOUT_REQUESTED = 2
+PLAYER_READY = 4
+PLAYER_LEFT_MATCH = 8
+
+
+def token_flags(moved_this_turn, can_move_this_turn, retreat_from_draw):
+    return (MOVED if moved_this_turn else 0) | (0 if can_move_this_turn else CANNOT_MOVE) | \
+        (RETREATED if retreat_from_draw else 0)
+
+
+def player_flags(defeated, timeout_requested, ready, left_match):
+    return (PLAYER_DEFEATED if defeated else 0) | (PLAYER_TIMEOUT_REQUESTED if timeout_requested else 0) | \
+        (PLAYER_READY if ready else 0) | (PLAYER_LEFT_MATCH if left_match else 0)
+
+
+class CompactBoard(object):
+    """
+    Board of a turn step stored as flat arrays instead of one object per token.
+
+    counts holds how many tokens of every type each player has in every region, as an int16 matrix of
+    regions x players x token types in row major order. Most tokens have the default flags (not moved, can move,
+    not retreated), so only the others are listed, one entry per token in flagged_cells and flagged_bits.
+    Players are kept as parallel arrays in board order.
+
+    The encoding keeps everything but token ids and the order of tokens within the board.
+    """
+
+    __slots__ = ('region_ids', 'player_ids', 'token_type_ids', 'counts', 'flagged_cells', 'flagged_bits',
+                 'power_points', 'total_strength', 'player_bits', 'player_row_ids')
+
+    def __init__(self, region_ids, player_ids, token_type_ids):
+        self.region_ids = tuple(region_ids)
+        self.player_ids = tuple(player_ids)
+        self.token_type_ids = tuple(token_type_ids)
+        self.counts = array('h', bytes(2 * len(self.region_ids) * len(self.player_ids) * len(self.token_type_ids)))
+        self.flagged_cells = array('l')
+        self.flagged_bits = array('b')
+        self.power_points = array('l', [0] * len(self.player_ids))
+        self.total_strength = array('l', [0] * len(self.player_ids))
+        self.player_bits = array('b', [0] * len(self.player_ids))
+        self.player_row_ids = array('l', [0] * len(self.player_ids))
+
+    @property
+    def shape(self):
+        return len(self.region_ids), len(self.player_ids), len(self.token_type_ids)
+
+    def cell(self, region, player, token_type):
+        """Position in counts of the given region, player and token type indexes."""
+        return (region * len(self.player_ids) + player) * len(self.token_type_ids) + token_type
+
+    def cell_indexes(self, cell):
+        cell, token_type = divmod(cell, len(self.token_type_ids))
+        region, player = divmod(cell, len(self.player_ids))
+        return region, player, token_type
+
+    def add_token(self, region, player, token_type, flags=0):
+        cell = self.cell(region, player, token_type)
+        self.counts[cell] += 1
+        if flags:
+            self.flagged_cells.append(cell)
+            self.flagged_bits.append(flags)
+
+    def count(self, region_id, match_player_id, token_type_id):
+        return self.counts[self.cell(self.region_ids.index(region_id), self.player_ids.index(match_player_id),
+                                     self.token_type_ids.index(token_type_id))]
+
+    def token_count(self):
+        return sum(self.counts)
+
+    def nbytes(self):
+        arrays = (self.counts, self.flagged_cells, self.flagged_bits, self.power_points, self.total_strength,
+                  self.player_bits, self.player_row_ids)
+        return sum(len(values) * values.itemsize for values in arrays)
+
+    def matrix(self):
+        """counts as a NumPy array of shape (regions, players, token types), sharing its memory."""
+        import numpy
+
+        return numpy.frombuffer(self.counts, dtype=numpy.int16).reshape(self.shape)
+
+    @classmethod
+    def from_board(cls, board, region_ids, token_type_ids):
+        compact = cls(region_ids, [player.match_player.id for player in board.players], token_type_ids)
+        region_index = dict((region_id, i) for i, region_id in enumerate(compact.region_ids))
+        player_index = dict((player_id, i) for i, player_id in enumerate(compact.player_ids))
+        token_type_index = dict((token_type_id, i) for i, token_type_id in enumerate(compact.token_type_ids))
+
+        for i, player in enumerate(board.players):
+            compact.power_points[i] = player.power_points
+            compact.total_strength[i] = player.total_strength
+            compact.player_bits[i] = player_flags(player.defeated, player.timeout_requested, player.ready,
+                                                  player.left_match)
+            compact.player_row_ids[i] = player.id or 0
+        for token in board.tokens:
+            compact.add_token(region_index[token.position], player_index[token.owner], token_type_index[token.type.id],
+                              token_flags(token.moved_this_turn, token.can_move_this_turn, token.retreat_from_draw))
+        return compact
+
+    def tokens(self):
+        """Yield (region id, match player id, token type id, flags) for every token."""
+        flagged = dict()
+        for cell, bits in zip(self.flagged_cells, self.flagged_bits):
+            flagged.setdefault(cell, list()).append(bits)
+
+        for cell, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            region, player, token_type = self.cell_indexes(cell)
+            cell_flags = flagged.get(cell, ())
+            for i in range(count):
+                yield (self.region_ids[region], self.player_ids[player], self.token_type_ids[token_type],
+                       cell_flags[i] if i < len(cell_flags) else 0)
+
+    def to_board(self, match_players, token_types):
+        """
+        Expand into a state.Board. match_players maps MatchPlayer ids to state.MatchPlayer and token_types maps
+        token type ids to state.TokenType. Tokens come out ordered by region, player and token type.
+        """
+        players = list()
+        for i, player_id in enumerate(self.player_ids):
+            bits = self.player_bits[i]
+            players.append(Player(
+                match_players[player_id], self.power_points[i], bool(bits & PLAYER_DEFEATED), self.total_strength[i],
+                bool(bits & PLAYER_TIMEOUT_REQUESTED), bool(bits & PLAYER_READY), bool(bits & PLAYER_LEFT_MATCH),
+                id=self.player_row_ids[i] or None
+            ))
+
+        types = dict((token_type_id, token_types[token_type_id]) for token_type_id in self.token_type_ids)
+        tokens = [Token(player_id, region_id, types[token_type_id], bool(bits & MOVED), not bits & CANNOT_MOVE,
+                        bool(bits & RETREATED))
+                  for region_id, player_id, token_type_id, bits in self.tokens()]
+        return Board(players, tokens)
@@ -0,0 +1,311 @@
+from collections import OrderedDict
+from difflib import SequenceMatcher
+import json
+import threading
+import zlib
+
+from django.conf import settings
+
+from game.engine import rules, state, storage
+from game.engine.compact import MOVED, CANNOT_MOVE, RETREATED, token_flags, player_flags, PLAYER_DEFEATED, \
+    PLAYER_TIMEOUT_REQUESTED, PLAYER_READY, PLAYER_LEFT_MATCH
+from game.models import BoardSnapshot, BoardToken, MatchLogEntry, TurnStep
+
+
+class HistoryNotInLog(Exception):
+    pass
+
+
+class BoardCache(object):
+    """Thread safe LRU of the boards of pruned steps by TurnStep pk. The boards are shared, nothing may change them."""
+
+    def __init__(self, size):
+        self.size = size
+        self._boards = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pk):
+        with self._lock:
+            board = self._boards.get(pk)
+            if board is not None:
+                self._boards.move_to_end(pk)
+            return board
+
+    def put(self, pk, board):
+        with self._lock:
+            self._boards[pk] = board
+            self._boards.move_to_end(pk)
+            while len(self._boards) > self.size:
+                self._boards.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._boards.clear()
+
+
+materialized_boards = BoardCache(settings.MATERIALIZED_BOARD_CACHE_SIZE)
+
+
+def encode(content):
+    return zlib.compress(json.dumps(content, separators=(',', ':')).encode())
+
+
+def decode(data):
+    return json.loads(zlib.decompress(bytes(data)).decode())
+
+
+def board_content(board):
+    return {
+        'players': [[player.match_player.id, player.power_points, player.total_strength,
+                     player_flags(player.defeated, player.timeout_requested, player.ready, player.left_match)]
+                    for player in board.players],
+        'tokens': [[token.owner, token.position, token.type.id,
+                    token_flags(token.moved_this_turn, token.can_move_this_turn, token.retreat_from_draw)]
+                   for token in board.tokens],
+    }
+
+
+def board_from_content(content, match_players, token_types):
+    players = [state.Player(match_players[match_player_id], power_points, bool(bits & PLAYER_DEFEATED),
+                            total_strength, bool(bits & PLAYER_TIMEOUT_REQUESTED), bool(bits & PLAYER_READY),
+                            bool(bits & PLAYER_LEFT_MATCH))
+               for match_player_id, power_points, total_strength, bits in content['players']]
+    tokens = [state.Token(owner, position, token_types[type_id], bool(bits & MOVED), not bits & CANNOT_MOVE,
+                          bool(bits & RETREATED))
+              for owner, position, type_id, bits in content['tokens']]
+    return state.Board(players, tokens)
+
+
+def encode_board(board):
+    """
+    Board as zlib compressed JSON. Unlike CompactBoard this keeps the order of tokens, which decides the token a
+    movement command moves, so boards replayed from it resolve exactly like the stored ones.
+    """
+    return encode(board_content(board))
+
+
+def decode_board(data, match_players, token_types):
+    """Board encoded by encode_board. match_players maps MatchPlayer ids to state.MatchPlayer."""
+    return board_from_content(decode(data), match_players, token_types)
+
+
+def encode_delta(previous, board):
+    """
+    Changes from the board previous to board. Steps copy the tokens of the previous one in order, moving, capturing
+    and changing some, deleting some and adding new ones at the end, so the changed token ranges are a small part of
+    the board. Players are few and change often, they are kept whole.
+    """
+    previous_tokens = [tuple(token) for token in board_content(previous)['tokens']]
+    content = board_content(board)
+    tokens = [tuple(token) for token in content['tokens']]
+    content['tokens'] = [[i1, i2, tokens[j1:j2]]
+                         for tag, i1, i2, j1, j2
+                         in SequenceMatcher(None, previous_tokens, tokens, autojunk=False).get_opcodes()
+                         if tag != 'equal']
+    return encode(content)
+
+
+def apply_delta(previous, data, match_players, token_types):
+    """The board encode_delta(previous, board) was made from."""
+    content = decode(data)
+    tokens = board_content(previous)['tokens']
+    for i1, i2, changed in reversed(content['tokens']):
+        tokens[i1:i2] = changed
+    content['tokens'] = tokens
+    return board_from_content(content, match_players, token_types)
+
+
+def next_turn_board(board):
+    """The board a turn starts with after a turn ending with board, as Turn.clone_to_new_turn copies it."""
+    board = board.copy()
+    for player in board.players:
+        player.ready = False
+    for token in board.tokens:
+        token.moved_this_turn = False
+        token.can_move_this_turn = True
+        token.retreat_from_draw = False
+    return board
+
+
+def snapshot_due(match, turn_number):
+    return (turn_number - 1) % settings.MATCH_SNAPSHOT_INTERVAL == 0 or not match.snapshots.exists()
+
+
+def save_snapshot(turn):
+    """Store the board turn starts with. Called when the turn is created, before anyone plays it."""
+    match = turn.match
+    board = storage.load_board(turn.steps.get(step=1), storage.load_match_players(match), storage.load_token_types())
+    BoardSnapshot.objects.create(match=match, turn_number=turn.number, data=encode_board(board))
+
+
+def log_turn_resolved(match, turn):
+    """Append the commands state.Turn turn was resolved with, and who was ready then, to the log of match."""
+    MatchLogEntry.objects.create(match=match, turn_number=turn.number, type=MatchLogEntry.TYPE_TURN_RESOLVED,
+                                 data=json.dumps({
+                                     'commands': [[command.match_player, command.order, command.type,
+                                                   command.location,
+                                                   command.token_type.id if command.token_type else None,
+                                                   command.move_destination,
+                                                   command.conversion.id if command.conversion else None]
+                                                  for command in turn.commands],
+                                     'ready': [player.match_player.id for player in turn.steps[0].board.players
+                                               if player.ready],
+                                 }, separators=(',', ':')))
+
+
+def log_player_left(player_in_turn):
+    MatchLogEntry.objects.create(match_id=player_in_turn.match_player.match_id,
+                                 turn_number=player_in_turn.turn_step.turn.number,
+                                 type=MatchLogEntry.TYPE_PLAYER_LEFT, match_player_id=player_in_turn.match_player_id)
+
+
+def leave(board, match_player_id):
+    """Apply a player leaving to board, as PlayerInTurnStep.leave does to the stored one."""
+    player = board.player(match_player_id)
+    player.left_match = True
+    player.ready = True
+    player.power_points = 0
+    player.match_player.left_match = True
+    board.tokens = [token for token in board.tokens if token.owner != match_player_id]
+
+
+def replay_turn(match, turn_number):
+    """
+    Resolve turn_number of match again from the nearest snapshot and the log, and return its steps as state.Step.
+    turn_number has to be resolved already. Raises HistoryNotInLog if the log does not reach back to it.
+    """
+    snapshot = match.snapshots.filter(turn_number__lte=turn_number).order_by('-turn_number').first()
+    if snapshot is None:
+        raise HistoryNotInLog()
+
+    token_types = storage.load_token_types()
+    conversions = storage.load_conversions(token_types)
+    match_players = storage.load_match_players(match)
+    board = decode_board(snapshot.data, dict((match_player.id, match_player) for match_player in match_players),
+                         token_types)
+    for player in board.players:
+        player.match_player.defeated = player.defeated
+        player.match_player.left_match = player.left_match
+
+    entries = dict()
+    for entry in match.log.filter(turn_number__gte=snapshot.turn_number, turn_number__lte=turn_number) \
+            .order_by('pk'):
+        entries.setdefault(entry.turn_number, list()).append(entry)
+
+    graph = match.map.graph()
+    for number in range(snapshot.turn_number, turn_number + 1):
+        resolution = None
+        for entry in entries.get(number, ()):
+            if entry.type == MatchLogEntry.TYPE_PLAYER_LEFT:
+                leave(board, entry.match_player_id)
+            elif entry.type == MatchLogEntry.TYPE_TURN_RESOLVED:
+                resolution = json.loads(entry.data)
+        if resolution is None:
+            raise HistoryNotInLog()
+
+        commands = [state.Command(None, match_player, order, type, location, token_types.get(token_type),
+                                  move_destination, conversions.get(conversion))
+                    for match_player, order, type, location, token_type, move_destination, conversion
+                    in resolution['commands']]
+        for player in board.players:
+            player.ready = player.match_player.id in resolution['ready']
+
+        turn = rules.resolve_turn(state.Turn(number, match.name, match.get_absolute_url(), graph, match_players,
+                                             [state.Step(1, board)], commands, settings.MAX_BATTLE_ITERATIONS))
+        if number == turn_number:
+            return turn.steps
+        board = next_turn_board(turn.latest_step().board)
+
+
+def step_board(turn_step):
+    """
+    Board of turn_step as a state.Board. Pruned steps are rebuilt from the nearest snapshot and the deltas of the
+    steps after it, starting from the latest of them in materialized_boards.
+    """
+    if not turn_step.pruned:
+        return storage.load_board(turn_step, storage.load_match_players(turn_step.turn.match),
+                                  storage.load_token_types())
+    return materialized_board(turn_step).copy()
+
+
+def materialized_board(turn_step):
+    """Board of the pruned turn_step, shared through materialized_boards: do not change it."""
+    match = turn_step.turn.match
+    board = materialized_boards.get(turn_step.pk)
+    if board is not None:
+        return board
+
+    snapshot = match.snapshots.filter(turn_number__lte=turn_step.turn.number).order_by('-turn_number').first()
+    chain = list()
+    if snapshot is not None:
+        for pk, delta in TurnStep.objects.filter(turn__match=match, turn__number__gte=snapshot.turn_number,
+                                                 turn__number__lte=turn_step.turn.number) \
+                .exclude(turn__number=turn_step.turn.number, step__gt=turn_step.step) \
+                .order_by('turn__number', 'step').values_list('pk', 'board_delta'):
+            chain.append((pk, delta))
+    if not chain or any(delta is None for pk, delta in chain):
+        # Pruned before deltas were stored
+        board = replay_turn(match, turn_step.turn.number)[turn_step.step - 1].board
+        materialized_boards.put(turn_step.pk, board)
+        return board
+
+    start = 0
+    for i in range(len(chain) - 1, -1, -1):
+        board = materialized_boards.get(chain[i][0])
+        if board is not None:
+            start = i + 1
+            break
+    match_players = dict((match_player.id, match_player) for match_player in storage.load_match_players(match))
+    token_types = storage.load_token_types()
+    if board is None:
+        board = decode_board(snapshot.data, match_players, token_types)
+    for pk, delta in chain[start:]:
+        board = apply_delta(board, delta, match_players, token_types)
+        materialized_boards.put(pk, board)
+    return board
+
+
+def step_tokens(turn_step):
+    """Tokens of turn_step as (region id, match player id, token type id), in board order."""
+    if not turn_step.pruned:
+        return list(BoardToken.objects.filter(owner__turn_step=turn_step).order_by('pk')
+                    .values_list('position_id', 'owner__match_player_id', 'type_id'))
+    return [(token.position, token.owner, token.type.id) for token in materialized_board(turn_step).tokens]
+
+
+def prune_boards(match, keep_turns):
+    """
+    Replace the tokens of the steps of match older than its keep_turns latest turns by the delta of their board from
+    the previous step, or from the snapshot for the first step of a snapshot turn. Only the resolved turns the log can
+    replay are pruned, the latest turn never is. Players, commands and battles are kept, and so are the tokens battles
+    won or captured.
+    """
+    snapshots = dict(match.snapshots.values_list('turn_number', 'data'))
+    if not snapshots:
+        return 0
+    steps = list(TurnStep.objects.filter(turn__match=match, pruned=False, turn__number__gte=min(snapshots),
+                                         turn__number__lte=match.get_latest_turn().number - max(keep_turns, 1),
+                                         turn__number__in=match.log.filter(type=MatchLogEntry.TYPE_TURN_RESOLVED)
+                                         .values('turn_number'))
+                 .select_related('turn').order_by('turn__number', 'step'))
+    if not steps:
+        return 0
+
+    match_players = storage.load_match_players(match)
+    token_types = storage.load_token_types()
+    previous = None
+    for turn_step in steps:
+        if turn_step.step == 1 and turn_step.turn.number in snapshots:
+            previous = decode_board(snapshots[turn_step.turn.number],
+                                    dict((match_player.id, match_player) for match_player in match_players),
+                                    token_types)
+        elif previous is None:
+            previous = materialized_board(TurnStep.objects.filter(turn__match=match, pruned=True)
+                                          .select_related('turn').order_by('-turn__number', '-step')[0])
+        board = storage.load_board(turn_step, match_players, token_types)
+        TurnStep.objects.filter(pk=turn_step.pk).update(board_delta=encode_delta(previous, board))
+        previous = board
+
+    BoardToken.objects.filter(owner__turn_step__in=steps, winning_in=None, captured_in=None).delete()
+    TurnStep.objects.filter(pk__in=[turn_step.pk for turn_step in steps]).update(pruned=True)
+    return len(steps)
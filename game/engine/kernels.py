@@ -0,0 +1,71 @@
+"""
+Whole-board computations on a CompactBoard: which regions are contested and how strong every player is in every
+region. Done with NumPy when it is installed, with plain loops over the count array otherwise.
+"""
+
+from game.engine.compact import MOVED
+
+
+def get_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def token_strength(token_type, moved_this_turn):
+    # Missiles only count if fired this turn
+    if token_type.special_missile and not moved_this_turn:
+        return 0
+    return token_type.strength
+
+
+def contested_regions(compact, use_numpy=True):
+    """Indexes, in map order, of the regions where more than one player has tokens."""
+    numpy = get_numpy() if use_numpy else None
+    regions, players, token_types = compact.shape
+    if regions == 0 or players < 2 or token_types == 0:
+        return list()
+
+    if numpy is not None:
+        owners = compact.matrix().any(axis=2).sum(axis=1)
+        return numpy.flatnonzero(owners > 1).tolist()
+
+    contested = list()
+    counts = compact.counts
+    region_size = players * token_types
+    for region in range(regions):
+        owners = 0
+        for player in range(region * region_size, (region + 1) * region_size, token_types):
+            if any(counts[player:player + token_types]):
+                owners += 1
+                if owners > 1:
+                    contested.append(region)
+                    break
+    return contested
+
+
+def region_strengths(compact, token_types, use_numpy=True):
+    """
+    Strength of every player in every region as a list of rows, one per region, indexed like compact.player_ids.
+    token_types are the state.TokenType of compact.token_type_ids, in the same order.
+    """
+    numpy = get_numpy() if use_numpy else None
+    regions, players, types = compact.shape
+    resting = [token_strength(token_type, False) for token_type in token_types]
+
+    if numpy is not None and len(compact.counts):
+        strengths = compact.matrix().dot(numpy.array(resting, dtype=numpy.int64)).tolist()
+    else:
+        strengths = [[0] * players for _ in range(regions)]
+        for cell, count in enumerate(compact.counts):
+            if count:
+                region, player, token_type = compact.cell_indexes(cell)
+                strengths[region][player] += count * resting[token_type]
+
+    # Moved tokens are listed as flagged, only their strength can differ from the resting one
+    for cell, bits in zip(compact.flagged_cells, compact.flagged_bits):
+        region, player, token_type = compact.cell_indexes(cell)
+        strengths[region][player] += token_strength(token_types[token_type], bits & MOVED) - resting[token_type]
+    return strengths
@@ -0,0 +1,303 @@
+from collections import defaultdict
+import heapq
+
+from game.engine import kernels
+from game.engine.compact import CompactBoard
+from game.engine.state import Battle, Token
+
+
+TYPE_MOVEMENT = 'MOV'
+TYPE_CONVERSION = 'TCO'
+TYPE_VALUE_CONVERSION = 'VCO'
+TYPE_PURCHASE = 'BUY'
+
+
+class InvalidCommandType(Exception):
+    pass
+
+
+class TooManyBattleIterations(Exception):
+    pass
+
+
+def resolve_turn(turn):
+    outgoing_step = turn.latest_step()
+    incoming_step = outgoing_step.create_next()
+    turn.steps.append(incoming_step)
+
+    # Process commands
+    for outgoing_player in outgoing_step.board.players:
+        match_player = outgoing_player.match_player
+        incoming_player = incoming_step.board.player(match_player.id)
+
+        valid_command = False
+        for command in sorted((command for command in turn.commands if command.match_player == match_player.id),
+                              key=lambda command: command.order):
+            command.valid = is_valid(turn.graph, command, incoming_step.board, incoming_player)
+            if command.valid:
+                valid_command = True
+                execute(command, incoming_step.board, incoming_player)
+
+        # if no valid movements, subtract power point
+        if not valid_command and incoming_player.power_points > 0:
+            outgoing_step.report.append("%s had no valid commands, loses one power point" % match_player.username)
+            incoming_player.power_points -= 1
+
+    resolve_battles(turn)
+
+    # Flag capture & defeats
+    latest_step = turn.latest_step()
+    for match_player in [match_player for match_player in turn.match_players if not match_player.defeated]:
+        check_and_process_defeat(latest_step, latest_step.board.player(match_player.id))
+
+    check_and_process_end_of_game(turn)
+
+    if not turn.finished:
+        for player in latest_step.board.players:
+            collect_power_points(turn.graph, latest_step, player)
+
+        for player in latest_step.board.players:
+            if player.match_player.is_active():
+                turn.notify(player.match_player, "Turn passed (%d) for match %s." % (turn.number, turn.match_name),
+                            "%s?turn=%d" % (turn.match_url, turn.number))
+
+    return turn
+
+
+def command_token(board, command):
+    for token in board.tokens:
+        if token.type is command.token_type and token.position == command.location:
+            return token
+    return None
+
+
+def consumable_tokens(board, command, player):
+    tokens = [token for token in board.tokens
+              if token.owner == player.match_player.id and token.type is command.conversion.needs and
+              token.position == command.location]
+    return sorted(tokens, key=lambda token: token.can_move_this_turn)
+
+
+def is_valid(graph, command, board, player):
+    if command.type == TYPE_MOVEMENT:
+        token = command_token(board, command)
+        if token is None or not token.can_move_this_turn:
+            return False
+        return graph.path_exists(token.type, command.location, command.move_destination)
+
+    elif command.type == TYPE_PURCHASE:
+        return command.token_type.purchasable and command.token_type.strength <= player.power_points
+
+    elif command.type == TYPE_CONVERSION:
+        return len(consumable_tokens(board, command, player)) >= command.conversion.needs_quantity
+
+    else:
+        raise InvalidCommandType()
+
+
+def execute(command, board, player):
+    assert command.valid
+    match_player = player.match_player
+
+    if command.type == TYPE_MOVEMENT:
+        token = command_token(board, command)
+        token.position = command.move_destination
+        token.moved_this_turn = True
+        token.can_move_this_turn = command.location == match_player.reserve and \
+            command.move_destination == match_player.headquarters
+
+    elif command.type == TYPE_PURCHASE:
+        player.power_points -= command.token_type.strength
+        board.tokens.append(Token(match_player.id, match_player.reserve, command.token_type))
+
+    elif command.type == TYPE_CONVERSION:
+        for token in consumable_tokens(board, command, player)[:command.conversion.needs_quantity]:
+            board.tokens.remove(token)
+        for i in range(command.conversion.produces_quantity):
+            board.tokens.append(Token(match_player.id, command.location, command.conversion.produces,
+                                      can_move_this_turn=command.location == match_player.reserve))
+
+    else:
+        raise InvalidCommandType()
+
+
+def battle_summary(graph, board):
+    """CompactBoard of board and the token types on it, in the order of its token type axis."""
+    token_types = dict((token.type.id, token.type) for token in board.tokens)
+    token_type_ids = sorted(token_types)
+    return CompactBoard.from_board(board, graph.region_ids, token_type_ids), \
+        [token_types[token_type_id] for token_type_id in token_type_ids]
+
+
+def resolve_battles(turn):
+    iterations = 0
+    while True:
+        compact, token_types = battle_summary(turn.graph, turn.latest_step().board)
+        contested = kernels.contested_regions(compact)
+        if not contested:
+            break
+
+        # Create new turn step
+        outgoing_step = turn.latest_step()
+        incoming_step = outgoing_step.create_next()
+        turn.steps.append(incoming_step)
+
+        fight_battles(turn, outgoing_step, incoming_step, contested, kernels.region_strengths(compact, token_types))
+        fire_missiles(turn.graph, outgoing_step, incoming_step)
+
+        iterations += 1
+        if iterations >= turn.max_battle_iterations:
+            raise TooManyBattleIterations()
+
+
+def fight_battles(turn, outgoing_step, incoming_step, contested, strengths):
+    """
+    contested are the indexes of the contested regions and strengths the strength of every player in every region,
+    both as computed by kernels on the board of outgoing_step, which incoming_step starts as a copy of.
+    """
+    graph = turn.graph
+    board = incoming_step.board
+    tokens_per_region = defaultdict(list)
+    for token in board.tokens:
+        tokens_per_region[token.position].append(token)
+    order = dict((id(token), i) for i, token in enumerate(board.tokens))
+    player_index = dict((player.match_player.id, i) for i, player in enumerate(board.players))
+
+    # Regions are visited in map order, tokens moved by a battle can still fight later in the same step
+    queue = list(contested)
+    queued = set(contested)
+
+    def move(token, owner, destination, current):
+        tokens_per_region[token.position].remove(token)
+        strength = kernels.token_strength(token.type, token.moved_this_turn)
+        strengths[graph.index[token.position]][player_index[token.owner]] -= strength
+        token.owner = owner
+        token.position = destination
+        tokens_per_region[destination].append(token)
+        destination_index = graph.index[destination]
+        strengths[destination_index][player_index[owner]] += strength
+        if destination_index > current and destination_index not in queued:
+            heapq.heappush(queue, destination_index)
+            queued.add(destination_index)
+
+    while queue:
+        current = heapq.heappop(queue)
+        region = graph.region_ids[current]
+        tokens_in_region = sorted(tokens_per_region[region], key=lambda token: order[id(token)])
+        players_in_battle = list()
+        for token in tokens_in_region:
+            if token.owner not in players_in_battle:
+                players_in_battle.append(token.owner)
+        if len(players_in_battle) < 2:
+            continue
+
+        # TODO If infinite strength token present, it wins. If missile, it kills every token (no capture)
+        # TODO: missiles do not capture!
+        players_by_force = defaultdict(list)
+        for player_in_battle in players_in_battle:
+            players_by_force[strengths[current][player_index[player_in_battle]]].append(board.player(player_in_battle))
+        winners = players_by_force[max(players_by_force.keys())]
+
+        if len(winners) == 1:
+            # Single winner case, capture tokens
+            winner = winners[0].match_player
+            battle = Battle(region, winner.id)
+            for token in tokens_in_region:
+                if token.owner == winner.id:
+                    battle.winning_tokens.append(token)
+                else:
+                    battle.captured_tokens.append(token)
+                    move(token, winner.id, winner.reserve, current)
+        else:
+            # Draw: retreat winner forces
+            battle = Battle(region)
+            winner_ids = [winner.match_player.id for winner in winners]
+            for token in tokens_in_region:
+                battle.winning_tokens.append(token)
+                if token.owner in winner_ids and not token.retreat_from_draw:
+                    for command in turn.commands:
+                        if command.valid and not command.reverted_in_draw and command.type == TYPE_MOVEMENT and \
+                                command.match_player == token.owner and \
+                                command.move_destination == token.position and command.token_type is token.type:
+                            command.reverted_in_draw = True
+                            token.retreat_from_draw = True
+                            move(token, token.owner, command.location, current)
+                            break
+        outgoing_step.battles.append(battle)
+
+
+def fire_missiles(graph, outgoing_step, incoming_step):
+    # Delete shot missiles and steal power points from shot infinite strength missiles
+    board = incoming_step.board
+    for missile in [token for token in board.tokens if token.type.special_missile and token.moved_this_turn]:
+        reserve_of = graph.reserve_country[graph.index[missile.position]]
+        if missile.type.special_destroys_all and reserve_of is not None:
+            thief = board.player(missile.owner)
+            for steal_from in board.players:
+                if steal_from.match_player.country == reserve_of:
+                    thief.power_points += steal_from.power_points
+                    steal_from.power_points = 0
+        board.tokens.remove(missile)
+        for battle in outgoing_step.battles:
+            if missile in battle.winning_tokens:
+                battle.winning_tokens.remove(missile)
+            if missile in battle.captured_tokens:
+                battle.captured_tokens.remove(missile)
+
+
+def set_defeated(player):
+    player.defeated = True
+    player.match_player.defeated = True
+
+
+def check_and_process_defeat(step, player):
+    board = step.board
+    match_player = player.match_player
+    defeater_token = None
+    for token in board.tokens:
+        if token.type.can_capture_flag and token.position == match_player.headquarters and \
+                token.owner != match_player.id:
+            defeater_token = token
+            break
+
+    if defeater_token is not None:
+        defeater = board.player(defeater_token.owner)
+        defeater.power_points += player.power_points
+        player.power_points = 0
+        set_defeated(player)
+        for token in board.tokens_of(match_player.id):
+            token.owner = defeater.match_player.id
+            token.position = defeater.match_player.reserve
+        step.report.append("%s captured %s's flag." % (defeater.match_player.username, match_player.username))
+    elif not board.tokens_of(match_player.id) and player.power_points == 0:
+        set_defeated(player)
+        step.report.append("%s lost all tokens and power points and is defeated." % match_player.username)
+
+
+def check_and_process_end_of_game(turn):
+    remaining_players = [match_player for match_player in turn.match_players if match_player.is_active()]
+    if len(remaining_players) > 1:
+        return
+
+    if len(remaining_players) == 1:
+        turn.latest_step().report.append("%s wins the match!" % remaining_players[0].username)
+    else:
+        turn.latest_step().report.append("The match ends in a draw!")
+    turn.finished = True
+
+    for match_player in turn.match_players:
+        if match_player in remaining_players:
+            turn.notify(match_player, "Congratulations! You won the match %s!" % turn.match_name, turn.match_url)
+        elif not match_player.left_match:
+            turn.notify(match_player, "You lost the match %s" % turn.match_name, turn.match_url)
+
+
+def collect_power_points(graph, step, player):
+    countries = list()
+    for token in step.board.tokens_of(player.match_player.id):
+        country = graph.region_country[graph.index[token.position]]
+        if country is not None and country != player.match_player.country and country not in countries:
+            countries.append(country)
+    player.power_points += len(countries)
+    if countries:
+        step.report.append("%s collects %d power points" % (player.match_player.username, len(countries)))
@@ -0,0 +1,184 @@
+class TokenType(object):
+    __slots__ = ('id', 'name', 'strength', 'movements', 'purchasable', 'one_water_cross_per_movement', 'can_be_on_land',
+                 'can_be_on_water', 'can_capture_flag', 'special_missile', 'special_attack_reserves',
+                 'special_destroys_all')
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields[field])
+
+    def __repr__(self):
+        return "<TokenType %s>" % self.name
+
+
+class Conversion(object):
+    __slots__ = ('id', 'needs', 'needs_quantity', 'produces', 'produces_quantity')
+
+    def __init__(self, id, needs, needs_quantity, produces, produces_quantity):
+        self.id = id
+        self.needs = needs
+        self.needs_quantity = needs_quantity
+        self.produces = produces
+        self.produces_quantity = produces_quantity
+
+
+class MatchPlayer(object):
+    __slots__ = ('id', 'player_id', 'username', 'country', 'reserve', 'headquarters', 'defeated', 'left_match')
+
+    def __init__(self, id, player_id, username, country, reserve, headquarters, defeated=False, left_match=False):
+        self.id = id
+        self.player_id = player_id
+        self.username = username
+        self.country = country
+        self.reserve = reserve
+        self.headquarters = headquarters
+        self.defeated = defeated
+        self.left_match = left_match
+
+    def is_active(self):
+        return not self.defeated and not self.left_match
+
+
+class Player(object):
+    """A match player in one turn step, the engine counterpart of PlayerInTurnStep."""
+
+    __slots__ = ('id', 'match_player', 'power_points', 'defeated', 'total_strength', 'timeout_requested', 'ready',
+                 'left_match')
+
+    def __init__(self, match_player, power_points=0, defeated=False, total_strength=0, timeout_requested=False,
+                 ready=False, left_match=False, id=None):
+        self.id = id
+        self.match_player = match_player
+        self.power_points = power_points
+        self.defeated = defeated
+        self.total_strength = total_strength
+        self.timeout_requested = timeout_requested
+        self.ready = ready
+        self.left_match = left_match
+
+    def copy(self):
+        return Player(self.match_player, self.power_points, self.defeated, self.total_strength,
+                      self.timeout_requested, self.ready, self.left_match)
+
+
+class Token(object):
+    """A board token. The owner is the id of a MatchPlayer and the position the id of a region."""
+
+    __slots__ = ('id', 'owner', 'position', 'type', 'moved_this_turn', 'can_move_this_turn', 'retreat_from_draw')
+
+    def __init__(self, owner, position, type, moved_this_turn=False, can_move_this_turn=True, retreat_from_draw=False,
+                 id=None):
+        self.id = id
+        self.owner = owner
+        self.position = position
+        self.type = type
+        self.moved_this_turn = moved_this_turn
+        self.can_move_this_turn = can_move_this_turn
+        self.retreat_from_draw = retreat_from_draw
+
+    def copy(self):
+        return Token(self.owner, self.position, self.type, self.moved_this_turn, self.can_move_this_turn,
+                     self.retreat_from_draw)
+
+    def __repr__(self):
+        return "<Token %s of %s in %s>" % (self.type.name, self.owner, self.position)
+
+
+class Board(object):
+    """Players and tokens of a turn step. Both lists are kept in creation order, like the rows they come from."""
+
+    __slots__ = ('players', 'tokens')
+
+    def __init__(self, players, tokens):
+        self.players = players
+        self.tokens = tokens
+
+    def copy(self):
+        return Board([player.copy() for player in self.players], [token.copy() for token in self.tokens])
+
+    def player(self, match_player_id):
+        for player in self.players:
+            if player.match_player.id == match_player_id:
+                return player
+        raise KeyError(match_player_id)
+
+    def tokens_of(self, match_player_id):
+        return [token for token in self.tokens if token.owner == match_player_id]
+
+
+class Battle(object):
+    __slots__ = ('location', 'winner', 'winning_tokens', 'captured_tokens')
+
+    def __init__(self, location, winner=None):
+        self.location = location
+        self.winner = winner
+        self.winning_tokens = list()
+        self.captured_tokens = list()
+
+
+class Step(object):
+    """
+    A turn step. Steps loaded from the database have an id, steps created by the engine do not.
+    The report only holds the lines added by the engine, and battles are those fought between this step and the next.
+    """
+
+    __slots__ = ('id', 'number', 'board', 'report', 'battles')
+
+    def __init__(self, number, board, id=None):
+        self.id = id
+        self.number = number
+        self.board = board
+        self.report = list()
+        self.battles = list()
+
+    def create_next(self):
+        return Step(self.number + 1, self.board.copy())
+
+
+class Command(object):
+    __slots__ = ('id', 'match_player', 'order', 'type', 'location', 'token_type', 'move_destination', 'conversion',
+                 'valid', 'reverted_in_draw')
+
+    def __init__(self, id, match_player, order, type, location=None, token_type=None, move_destination=None,
+                 conversion=None, valid=None, reverted_in_draw=False):
+        self.id = id
+        self.match_player = match_player
+        self.order = order
+        self.type = type
+        self.location = location
+        self.token_type = token_type
+        self.move_destination = move_destination
+        self.conversion = conversion
+        self.valid = valid
+        self.reverted_in_draw = reverted_in_draw
+
+
+class Turn(object):
+    """
+    Everything needed to resolve a turn, and everything the resolution changed: the steps it created, the report
+    lines, command results, defeats, the end of the match and the notifications to send.
+    """
+
+    __slots__ = ('number', 'match_name', 'match_url', 'graph', 'match_players', 'steps', 'commands',
+                 'max_battle_iterations', 'finished', 'notifications')
+
+    def __init__(self, number, match_name, match_url, graph, match_players, steps, commands, max_battle_iterations):
+        self.number = number
+        self.match_name = match_name
+        self.match_url = match_url
+        self.graph = graph
+        self.match_players = match_players
+        self.steps = steps
+        self.commands = commands
+        self.max_battle_iterations = max_battle_iterations
+        self.finished = False
+        self.notifications = list()
+
+    def latest_step(self):
+        return self.steps[-1]
+
+    def new_steps(self):
+        return [step for step in self.steps if step.id is None]
+
+    def notify(self, match_player, text, url):
+        self.notifications.append((match_player, text, url))
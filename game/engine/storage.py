@@ -0,0 +1,234 @@
+from django.conf import settings
+from django.db import transaction
+
+from game.engine import state
+from game.engine.compact import CompactBoard, MOVED, CANNOT_MOVE, RETREATED, token_flags, player_flags, \
+    PLAYER_DEFEATED, PLAYER_TIMEOUT_REQUESTED, PLAYER_READY, PLAYER_LEFT_MATCH
+from game.models import BoardTokenType, TokenConversion, Match as MatchRow, MatchPlayer as MatchPlayerRow, \
+    PlayerInTurnStep, BoardToken, Command as CommandRow, Turn as TurnRow, TurnStep, Battle as BattleRow, Notification
+
+
+def load_token_types():
+    token_types = dict()
+    for token_type in BoardTokenType.objects.all():
+        token_types[token_type.pk] = state.TokenType(**dict(
+            (field, getattr(token_type, field)) for field in state.TokenType.__slots__))
+    return token_types
+
+
+def load_conversions(token_types):
+    return dict(
+        (conversion.pk, state.Conversion(conversion.pk, token_types[conversion.needs_id], conversion.needs_quantity,
+                                         token_types[conversion.produces_id], conversion.produces_quantity))
+        for conversion in TokenConversion.objects.all()
+    )
+
+
+def load_match_players(match):
+    match_players = list()
+    for match_player in MatchPlayerRow.objects.filter(match=match).select_related('player__user', 'country') \
+            .order_by('pk'):
+        country = match_player.country
+        match_players.append(state.MatchPlayer(
+            match_player.pk, match_player.player_id, match_player.player.user.username,
+            country.pk if country else None,
+            country.reserve_id if country else None,
+            country.headquarters_id if country else None,
+            match_player.defeated, match_player.left_match
+        ))
+    return match_players
+
+
+def load_board(turn_step, match_players, token_types):
+    match_players = dict((match_player.id, match_player) for match_player in match_players)
+    players = list()
+    owners = dict()
+    for player in PlayerInTurnStep.objects.filter(turn_step=turn_step).order_by('pk'):
+        owners[player.pk] = player.match_player_id
+        players.append(state.Player(
+            match_players[player.match_player_id], player.power_points, player.defeated, player.total_strength,
+            player.timeout_requested, player.ready, player.left_match, id=player.pk
+        ))
+    tokens = [
+        state.Token(owners[token.owner_id], token.position_id, token_types[token.type_id], token.moved_this_turn,
+                    token.can_move_this_turn, token.retreat_from_draw, id=token.pk)
+        for token in BoardToken.objects.filter(owner__turn_step=turn_step).order_by('pk')
+    ]
+    return state.Board(players, tokens)
+
+
+def load_commands(turn, token_types, conversions):
+    return [
+        state.Command(
+            command.pk, command.player_in_turn.match_player_id, command.order, command.type,
+            command.location_id, token_types.get(command.token_type_id), command.move_destination_id,
+            conversions.get(command.conversion_id), command.valid, command.reverted_in_draw
+        )
+        for command in CommandRow.objects.filter(player_in_turn__turn_step__turn=turn,
+                                                 player_in_turn__turn_step__step=1)
+        .select_related('player_in_turn').order_by('pk')
+    ]
+
+
+def load_turn(turn_step):
+    """Load the state of a match from turn_step on. turn_step has to be the latest step of its match."""
+    turn = turn_step.turn
+    match = turn.match
+    token_types = load_token_types()
+    match_players = load_match_players(match)
+    return state.Turn(
+        turn.number,
+        match.name,
+        match.get_absolute_url(),
+        match.map.graph(),
+        match_players,
+        [state.Step(turn_step.step, load_board(turn_step, match_players, token_types), id=turn_step.pk)],
+        load_commands(turn, token_types, load_conversions(token_types)),
+        settings.MAX_BATTLE_ITERATIONS
+    )
+
+
+def save_board(turn_step, board):
+    PlayerInTurnStep.objects.bulk_create(
+        PlayerInTurnStep(
+            turn_step=turn_step, match_player_id=player.match_player.id, power_points=player.power_points,
+            defeated=player.defeated, total_strength=player.total_strength,
+            timeout_requested=player.timeout_requested, ready=player.ready, left_match=player.left_match)
+        for player in board.players
+    )
+    owners = dict(PlayerInTurnStep.objects.filter(turn_step=turn_step).values_list('match_player_id', 'pk'))
+    for player in board.players:
+        player.id = owners[player.match_player.id]
+
+    BoardToken.objects.bulk_create(
+        BoardToken(
+            owner_id=owners[token.owner], position_id=token.position, type_id=token.type.id,
+            moved_this_turn=token.moved_this_turn, can_move_this_turn=token.can_move_this_turn,
+            retreat_from_draw=token.retreat_from_draw)
+        for token in board.tokens
+    )
+    # Rows are inserted in list order, so their primary keys follow it
+    token_pks = BoardToken.objects.filter(owner__turn_step=turn_step).order_by('pk').values_list('pk', flat=True)
+    for token, pk in zip(board.tokens, token_pks):
+        token.id = pk
+
+
+def load_compact_board(turn_step, region_ids):
+    """Load the board of turn_step as a CompactBoard without building model instances."""
+    players = list(PlayerInTurnStep.objects.filter(turn_step=turn_step).order_by('pk').values_list(
+        'pk', 'match_player_id', 'power_points', 'total_strength', 'defeated', 'timeout_requested', 'ready',
+        'left_match'))
+    compact = CompactBoard(region_ids, [player[1] for player in players],
+                           BoardTokenType.objects.order_by('pk').values_list('pk', flat=True))
+    for i, (pk, match_player_id, power_points, total_strength, defeated, timeout_requested, ready, left_match) \
+            in enumerate(players):
+        compact.player_row_ids[i] = pk
+        compact.power_points[i] = power_points
+        compact.total_strength[i] = total_strength
+        compact.player_bits[i] = player_flags(defeated, timeout_requested, ready, left_match)
+
+    region_index = dict((region_id, i) for i, region_id in enumerate(compact.region_ids))
+    player_index = dict((player[0], i) for i, player in enumerate(players))
+    token_type_index = dict((token_type_id, i) for i, token_type_id in enumerate(compact.token_type_ids))
+    for owner_id, position_id, type_id, moved_this_turn, can_move_this_turn, retreat_from_draw in \
+            BoardToken.objects.filter(owner__turn_step=turn_step).values_list(
+                'owner_id', 'position_id', 'type_id', 'moved_this_turn', 'can_move_this_turn', 'retreat_from_draw'):
+        compact.add_token(region_index[position_id], player_index[owner_id], token_type_index[type_id],
+                          token_flags(moved_this_turn, can_move_this_turn, retreat_from_draw))
+    return compact
+
+
+def save_compact_board(turn_step, compact):
+    """Create the players and tokens of a CompactBoard in turn_step."""
+    PlayerInTurnStep.objects.bulk_create(
+        PlayerInTurnStep(
+            turn_step=turn_step, match_player_id=player_id, power_points=compact.power_points[i],
+            total_strength=compact.total_strength[i], defeated=bool(compact.player_bits[i] & PLAYER_DEFEATED),
+            timeout_requested=bool(compact.player_bits[i] & PLAYER_TIMEOUT_REQUESTED),
+            ready=bool(compact.player_bits[i] & PLAYER_READY),
+            left_match=bool(compact.player_bits[i] & PLAYER_LEFT_MATCH))
+        for i, player_id in enumerate(compact.player_ids)
+    )
+    owners = dict(PlayerInTurnStep.objects.filter(turn_step=turn_step).values_list('match_player_id', 'pk'))
+    for i, player_id in enumerate(compact.player_ids):
+        compact.player_row_ids[i] = owners[player_id]
+
+    tokens = [
+        BoardToken(owner_id=owners[player_id], position_id=region_id, type_id=token_type_id,
+                   moved_this_turn=bool(bits & MOVED), can_move_this_turn=not bits & CANNOT_MOVE,
+                   retreat_from_draw=bool(bits & RETREATED))
+        for region_id, player_id, token_type_id, bits in compact.tokens()
+    ]
+    BoardToken.objects.bulk_create(tokens)
+
+
+def save_battles(step, owners):
+    winning_tokens = list()
+    captured_tokens = list()
+    for battle in step.battles:
+        row = BattleRow.objects.create(location_id=battle.location, turn_step_id=step.id,
+                                       winner_id=None if battle.winner is None else owners[battle.winner])
+        winning_tokens.extend(BattleRow.winning_tokens.through(battle_id=row.pk, boardtoken_id=token.id)
+                              for token in battle.winning_tokens)
+        captured_tokens.extend(BattleRow.captured_tokens.through(battle_id=row.pk, boardtoken_id=token.id)
+                               for token in battle.captured_tokens)
+    return winning_tokens, captured_tokens
+
+
+def append_report(report, lines):
+    for line in lines:
+        if len(report) != 0:
+            report += '<br>'
+        report += line
+    return report
+
+
+@transaction.atomic
+def save_turn(match, turn):
+    """Persist everything resolving the turn changed."""
+    turn_row = TurnRow.objects.get(match=match, number=turn.number)
+    steps = dict((turn_step.step, turn_step) for turn_step in turn_row.steps.all())
+
+    new_step = None
+    for step in turn.steps:
+        if step.id is None:
+            new_step = TurnStep.objects.create(turn=turn_row, step=step.number, report=append_report('', step.report))
+            step.id = new_step.pk
+            save_board(new_step, step.board)
+        elif step.report:
+            TurnStep.objects.filter(pk=step.id).update(report=append_report(steps[step.number].report, step.report))
+    if new_step is not None:
+        MatchRow.objects.set_current_step(new_step)
+
+    # Battles are stored in the step they were fought in but point to the tokens of the following step
+    winning_tokens = list()
+    captured_tokens = list()
+    for i, step in enumerate(turn.steps[:-1]):
+        owners = dict((player.match_player.id, player.id) for player in turn.steps[i + 1].board.players)
+        step_winning_tokens, step_captured_tokens = save_battles(step, owners)
+        winning_tokens.extend(step_winning_tokens)
+        captured_tokens.extend(step_captured_tokens)
+    if winning_tokens:
+        BattleRow.winning_tokens.through.objects.bulk_create(winning_tokens)
+    if captured_tokens:
+        BattleRow.captured_tokens.through.objects.bulk_create(captured_tokens)
+
+    for valid in (True, False, None):
+        for reverted_in_draw in (True, False):
+            commands = [command.id for command in turn.commands
+                        if command.valid is valid and command.reverted_in_draw == reverted_in_draw]
+            if commands:
+                CommandRow.objects.filter(pk__in=commands).update(valid=valid, reverted_in_draw=reverted_in_draw)
+
+    defeated = [match_player.id for match_player in turn.match_players if match_player.defeated]
+    if defeated:
+        MatchPlayerRow.objects.filter(pk__in=defeated).update(defeated=True)
+
+    if turn.finished:
+        match.status = match.STATUS_FINISHED
+        match.save()
+
+    Notification.objects.bulk_create(
+        Notification(player_id=match_player.player_id, text=text, url=url)
+        for match_player, text, url in turn.notifications
+    )
@@ -0,0 +1,91 @@
+from collections import defaultdict
+from optparse import make_option
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.engine import kernels, storage
+from game.engine.compact import CompactBoard
+from game.engine.state import Board, MatchPlayer, Player, Token
+from game.models import Map
+
+
+def loop_battle_detection(board):
+    """Contested regions and strengths computed token by token, as the battle phase used to."""
+    owners_per_region = defaultdict(set)
+    for token in board.tokens:
+        owners_per_region[token.position].add(token.owner)
+    contested = [region for region, owners in owners_per_region.items() if len(owners) > 1]
+
+    strengths = dict()
+    for region in contested:
+        tokens_per_player = defaultdict(list)
+        for token in board.tokens:
+            if token.position == region:
+                tokens_per_player[token.owner].append(token)
+        strengths[region] = dict(
+            (player, sum(kernels.token_strength(token.type, token.moved_this_turn) for token in tokens))
+            for player, tokens in tokens_per_player.items())
+    return contested, strengths
+
+
+def kernel_battle_detection(compact, token_types, use_numpy):
+    return kernels.contested_regions(compact, use_numpy), kernels.region_strengths(compact, token_types, use_numpy)
+
+
+def random_board(region_ids, players, token_types, tokens_per_region):
+    match_players = [MatchPlayer(i + 1, i + 1, "player%d" % (i + 1), None, None, None) for i in range(players)]
+    tokens = list()
+    for region_id in region_ids:
+        for _ in range(tokens_per_region):
+            tokens.append(Token(random.randint(1, players), region_id, random.choice(token_types),
+                                moved_this_turn=random.random() < 0.2))
+    return Board([Player(match_player) for match_player in match_players], tokens)
+
+
+class Command(BaseCommand):
+    help = "Compares the token loop and the vectorized kernels finding battles and strengths"
+    option_list = BaseCommand.option_list + (
+        make_option('--regions', type='int', default=500, help="Regions of the synthetic map"),
+        make_option('--players', type='int', default=4),
+        make_option('--tokens-per-region', type='int', default=3),
+        make_option('--repeat', type='int', default=20),
+        make_option('--seed', type='int', default=0),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        token_types = list(storage.load_token_types().values())
+        numpy = kernels.get_numpy()
+        if numpy is None:
+            self.stdout.write("NumPy is not installed, kernels use plain loops")
+
+        boards = list()
+        for game_map in Map.objects.exclude(regions=None).order_by('pk'):
+            region_ids = game_map.graph().region_ids
+            boards.append((game_map.name, region_ids, 2))
+        boards.append(("Synthetic", tuple(range(1, options['regions'] + 1)), options['players']))
+
+        for name, region_ids, players in boards:
+            board = random_board(region_ids, players, token_types, options['tokens_per_region'])
+            self.stdout.write("%s: %d regions, %d players, %d tokens" % (
+                name, len(region_ids), players, len(board.tokens)))
+
+            token_type_ids = sorted(token_type.id for token_type in token_types)
+            types = sorted(token_types, key=lambda token_type: token_type.id)
+            compact = CompactBoard.from_board(board, region_ids, token_type_ids)
+
+            self.report("loop", options['repeat'], lambda: loop_battle_detection(board))
+            if numpy is not None:
+                self.report("kernel (numpy)", options['repeat'],
+                            lambda: kernel_battle_detection(compact, types, True))
+            self.report("kernel (python)", options['repeat'], lambda: kernel_battle_detection(compact, types, False))
+            self.report("conversion to compact", options['repeat'],
+                        lambda: CompactBoard.from_board(board, region_ids, token_type_ids))
+
+    def report(self, label, repeat, function):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        self.stdout.write("  %-22s %8.3f ms" % (label, (time.perf_counter() - start) * 1000 / repeat))
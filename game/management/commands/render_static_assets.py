@@ -0,0 +1,54 @@
+from optparse import make_option
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from game import rendering
+from game.models import BoardTokenType, Map, MapCountry
+
+
+class Command(BaseCommand):
+    help = "Draws the token sprites of every country, the token atlases and the base images of public maps into " \
+           "RENDERED_ASSETS_DIR, to be served by the web server. Run it again after changing maps or token types."
+    option_list = BaseCommand.option_list + (
+        make_option('--output-dir', default=None, help="Write to this directory instead of RENDERED_ASSETS_DIR"),
+    )
+
+    def handle(self, *args, **options):
+        directory = options['output_dir'] or settings.RENDERED_ASSETS_DIR
+        if not directory:
+            raise CommandError("RENDERED_ASSETS_DIR is not set")
+
+        assets = list(self.token_assets()) + list(self.token_atlas_assets()) + list(self.map_assets())
+        written = rendering.write_static_assets(directory, assets)
+        self.stdout.write("%d assets, %d new files in %s" % (len(assets), written, directory))
+
+    def token_assets(self):
+        countries = [(None, None)] + list(MapCountry.objects.order_by('pk').values_list('pk', 'color_gif_palette'))
+        for token_type in BoardTokenType.objects.order_by('pk'):
+            for country_pk, color_gif_palette in countries:
+                content_hash, png = rendering.token_sprite_png(token_type.image_file_name, color_gif_palette)
+                yield (rendering.token_asset_name(token_type.pk, country_pk),
+                       "tokens/%s-%s.png" % (token_type.image_file_name, content_hash[:16]),
+                       lambda png=png: png)
+
+    def token_atlas_assets(self):
+        for game_map in Map.objects.filter(public=True).order_by('pk'):
+            atlas = rendering.token_atlas(game_map)
+            yield (rendering.token_atlas_asset_name(game_map.pk),
+                   "atlases/%d-%s.png" % (game_map.pk, atlas.content_hash[:16]),
+                   lambda atlas=atlas: atlas.png)
+
+    def map_assets(self):
+        for game_map in Map.objects.filter(public=True).order_by('pk'):
+            if not os.path.exists(game_map.background_path()):
+                self.stderr.write("Skipping map %s, it has no background image" % game_map)
+                continue
+            for show_debug in (False, True):
+                for show_links in (False, True):
+                    content_hash = rendering.map_content_hash(game_map, show_debug, show_links)
+                    yield (rendering.map_asset_name(game_map.pk, show_debug, show_links),
+                           "maps/%d-%d-%d-%s.png" % (game_map.pk, show_debug, show_links, content_hash[:16]),
+                           lambda game_map=game_map, show_debug=show_debug, show_links=show_links:
+                           rendering.encode_png(game_map.image(show_debug, show_links)))
@@ -0,0 +1,138 @@
+from optparse import make_option
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from game.engine import history, rules, state, storage
+from game.models import Match, MatchLogEntry, Turn, TurnStep
+
+
+def board_differences(expected, actual):
+    """Lines describing how the board actual differs from the board expected, empty if they are the same."""
+    differences = list()
+    expected_content = history.board_content(expected)
+    actual_content = history.board_content(actual)
+    for expected_player, actual_player in zip(expected_content['players'], actual_content['players']):
+        if expected_player != actual_player:
+            differences.append("player %d has [power points, strength, flags] %s instead of %s" % (
+                expected_player[0], actual_player[1:], expected_player[1:]))
+    if len(expected_content['players']) != len(actual_content['players']):
+        differences.append("%d players instead of %d" % (len(actual_content['players']),
+                                                         len(expected_content['players'])))
+    for i, (expected_token, actual_token) in enumerate(zip(expected_content['tokens'], actual_content['tokens'])):
+        if expected_token != actual_token:
+            differences.append("token %d is [owner, region, type, flags] %s instead of %s" % (
+                i, actual_token, expected_token))
+            break
+    if len(expected_content['tokens']) != len(actual_content['tokens']):
+        differences.append("%d tokens instead of %d" % (len(actual_content['tokens']),
+                                                        len(expected_content['tokens'])))
+    return differences
+
+
+class Command(BaseCommand):
+    args = "<match id>"
+    help = "Resolves every turn of a match again from its stored board and commands, compares the steps the engine " \
+           "produces with the stored ones and reports the differences and how long each turn took"
+    option_list = BaseCommand.option_list + (
+        make_option('--from-turn', type='int', default=1),
+        make_option('--to-turn', type='int', default=None, help="Last turn to replay, the last resolved one if unset"),
+        make_option('--repeat', type='int', default=1,
+                    help="Resolve every turn this many times and report the fastest"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the id of one match")
+        try:
+            match = Match.objects.select_related('map').get(pk=args[0])
+        except (Match.DoesNotExist, ValueError):
+            raise CommandError("Match %s does not exist" % args[0])
+        if options['from_turn'] < 1:
+            raise CommandError("--from-turn has to be at least 1")
+        if options['repeat'] < 1:
+            raise CommandError("--repeat has to be at least 1")
+
+        self.token_types = storage.load_token_types()
+        self.conversions = storage.load_conversions(self.token_types)
+        # Resolving a turn creates the next one, so the latest turn of a match has not been resolved
+        last_resolved = Turn.objects.filter(match=match).count() - 1
+        to_turn = min(options['to_turn'] or last_resolved, last_resolved)
+
+        diverging = 0
+        total_seconds = 0
+        for number in range(options['from_turn'], to_turn + 1):
+            differences, seconds, steps = self.verify_turn(match, number, options['repeat'])
+            total_seconds += seconds
+            if differences:
+                diverging += 1
+                self.stdout.write("Turn %d: %d steps in %.3f ms, DIVERGES" % (number, steps, seconds * 1000))
+                for difference in differences:
+                    self.stdout.write("  %s" % difference)
+            else:
+                self.stdout.write("Turn %d: %d steps in %.3f ms, same as stored" % (number, steps, seconds * 1000))
+
+        turns = max(to_turn - options['from_turn'] + 1, 0)
+        self.stdout.write("%d turns replayed in %.3f ms (%.1f turns/s), %d diverging" % (
+            turns, total_seconds * 1000, turns / total_seconds if total_seconds else 0, diverging))
+        if diverging:
+            raise CommandError("%d of %d turns diverge from the stored ones" % (diverging, turns))
+
+    def load_turn(self, match, number):
+        """The state.Turn of turn number as it was before being resolved, and its stored steps."""
+        turn_steps = list(TurnStep.objects.filter(turn__match=match, turn__number=number).select_related('turn__match')
+                          .order_by('step'))
+        if not turn_steps:
+            raise CommandError("Turn %d of match %s has no steps" % (number, match.pk))
+        match_players = storage.load_match_players(match)
+        board = history.step_board(turn_steps[0])
+        players = dict((match_player.id, match_player) for match_player in match_players)
+        for player in board.players:
+            player.match_player = players[player.match_player.id]
+            player.match_player.defeated = player.defeated
+            player.match_player.left_match = player.left_match
+        # Rules compare token types by identity
+        for token in board.tokens:
+            token.type = self.token_types[token.type.id]
+
+        entry = match.log.filter(turn_number=number, type=MatchLogEntry.TYPE_TURN_RESOLVED).first()
+        if entry is not None:
+            resolution = json.loads(entry.data)
+            commands = [state.Command(None, match_player, order, type, location, self.token_types.get(token_type),
+                                      move_destination, self.conversions.get(conversion))
+                        for match_player, order, type, location, token_type, move_destination, conversion
+                        in resolution['commands']]
+            for player in board.players:
+                player.ready = player.match_player.id in resolution['ready']
+        else:
+            commands = storage.load_commands(turn_steps[0].turn, self.token_types, self.conversions)
+            for command in commands:
+                command.valid = None
+                command.reverted_in_draw = False
+
+        turn = state.Turn(number, match.name, match.get_absolute_url(), match.map.graph(), match_players,
+                          [state.Step(1, board)], commands, settings.MAX_BATTLE_ITERATIONS)
+        return turn, turn_steps
+
+    def verify_turn(self, match, number, repeat):
+        """Differences between resolving turn number again and its stored steps, the fastest time and step count."""
+        seconds = None
+        for _ in range(repeat):
+            turn, turn_steps = self.load_turn(match, number)
+            start = time.perf_counter()
+            rules.resolve_turn(turn)
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+        differences = list()
+        if len(turn.steps) != len(turn_steps):
+            differences.append("%d steps instead of %d" % (len(turn.steps), len(turn_steps)))
+        for step, turn_step in zip(turn.steps, turn_steps):
+            if step.number > 1:
+                for difference in board_differences(history.step_board(turn_step), step.board):
+                    differences.append("step %d: %s" % (step.number, difference))
+            if storage.append_report('', step.report) != turn_step.report:
+                differences.append("step %d: report differs" % step.number)
+        return differences, seconds, len(turn.steps)
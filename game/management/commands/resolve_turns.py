@@ -0,0 +1,158 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from optparse import make_option
+import os
+import socket
+import time
+import traceback
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from game import rendering
+from game.models import TurnResolutionJob
+
+
+def resolve(job):
+    """Run job, then draw the maps of the turn it resolved so the players do not wait for them."""
+    done = job.run()
+    if done and not job.turn.is_latest():
+        rendering.cache_match_maps(job.turn)
+    return done
+
+
+def run_job(job_pk):
+    """Resolve a claimed job in a pool process. Returns the job pk, whether it succeeded and how long it took."""
+    django.setup()
+    start = time.perf_counter()
+    job = TurnResolutionJob.objects.select_related('turn__match').get(pk=job_pk)
+    done = resolve(job)
+    return job_pk, done, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = "Resolves the turns queued when RESOLVE_TURNS_IN_BACKGROUND is enabled"
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', default=False,
+                    help="Exit when the queue is empty instead of waiting for new jobs"),
+        make_option('--poll-interval', type='float', default=1.0,
+                    help="Seconds to wait before checking an empty queue again"),
+        make_option('--retry-failed', action='store_true', default=False,
+                    help="Queue the failed jobs again before starting"),
+        make_option('--processes', type='int', default=1,
+                    help="Resolve this many matches at the same time, each in its own process"),
+    )
+
+    def handle(self, *args, **options):
+        self.worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.resolved = 0
+        self.failed = 0
+        self.busy_since = None
+
+        if options['retry_failed']:
+            retried = TurnResolutionJob.objects.filter(status=TurnResolutionJob.STATUS_FAILED) \
+                .update(status=TurnResolutionJob.STATUS_QUEUED, error='', attempts=0)
+            self.stdout.write("Queued %d failed jobs again" % retried)
+
+        try:
+            if options['processes'] > 1:
+                self.run_pool(options)
+            else:
+                self.run_inline(options)
+        finally:
+            self.report_throughput()
+
+    def run_inline(self, options):
+        while True:
+            jobs = TurnResolutionJob.objects.claim(self.worker)
+            if not jobs:
+                self.report_throughput()
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.start_busy_period()
+            job = jobs[0]
+            start = time.perf_counter()
+            self.job_finished(job.pk, resolve(job), time.perf_counter() - start)
+
+    def run_pool(self, options):
+        while not self.run_executor(options):
+            self.stderr.write("A pool process died, starting new ones")
+
+    def run_executor(self, options):
+        """Resolve jobs in a new process pool. Returns False if the pool broke and has to be replaced."""
+        processes = options['processes']
+        # Pool processes can be forked from this one on every submit and must not share its database connections
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            running = dict()
+            while True:
+                if len(running) < processes:
+                    jobs = TurnResolutionJob.objects.claim(self.worker, processes - len(running))
+                    if jobs:
+                        self.start_busy_period()
+                        connections.close_all()
+                        for i, job in enumerate(jobs):
+                            try:
+                                running[executor.submit(run_job, job.pk)] = job.pk
+                            except BrokenProcessPool:
+                                for job_pk in list(running.values()) + [job.pk for job in jobs[i:]]:
+                                    self.job_crashed(job_pk, traceback.format_exc())
+                                return False
+
+                if running:
+                    finished, not_finished = wait(running, timeout=options['poll_interval'],
+                                                  return_when=FIRST_COMPLETED)
+                    broken = False
+                    for future in finished:
+                        job_pk = running.pop(future)
+                        try:
+                            self.job_finished(*future.result())
+                        except Exception:
+                            broken = broken or isinstance(future.exception(), BrokenProcessPool)
+                            self.job_crashed(job_pk, traceback.format_exc())
+                    if broken:
+                        for job_pk in running.values():
+                            self.job_crashed(job_pk, "The process pool broke while the job was running")
+                        return False
+                else:
+                    self.report_throughput()
+                    if options['once']:
+                        return True
+                    time.sleep(options['poll_interval'])
+
+    def start_busy_period(self):
+        if self.busy_since is None:
+            self.busy_since = time.perf_counter()
+
+    def job_finished(self, job_pk, done, seconds):
+        job = TurnResolutionJob.objects.select_related('turn__match').get(pk=job_pk)
+        if done:
+            self.resolved += 1
+            self.stdout.write("Resolved turn %s in %.3f s" % (job.turn, seconds))
+        else:
+            self.failed += 1
+            if job.status == TurnResolutionJob.STATUS_FAILED:
+                self.stderr.write("Failed to resolve turn %s, giving up after %d attempts\n%s" % (
+                    job.turn, job.attempts, job.error))
+            else:
+                self.stderr.write("Failed to resolve turn %s, it will be tried again\n%s" % (job.turn, job.error))
+
+    def job_crashed(self, job_pk, error):
+        """Fail a job whose pool process did not return, it is queued again unless it ran out of attempts."""
+        job = TurnResolutionJob.objects.get(pk=job_pk)
+        job.fail(error)
+        self.job_finished(job_pk, False, 0)
+
+    def report_throughput(self):
+        """Write how many turns were resolved since the queue stopped being empty, and how fast."""
+        if self.busy_since is None:
+            return
+        elapsed = time.perf_counter() - self.busy_since
+        self.stdout.write("%d turns resolved, %d failed in %.2f s (%.1f turns/s)" % (
+            self.resolved, self.failed, elapsed, (self.resolved + self.failed) / elapsed if elapsed else 0))
+        self.resolved = 0
+        self.failed = 0
+        self.busy_since = None
@@ -0,0 +1,55 @@
+from optparse import make_option
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from game import simulator
+from game.models import Map
+
+
+class Command(BaseCommand):
+    help = "Creates players and matches in the database and plays them with random legal commands through the models " \
+           "or the views, reporting turns per second, queries per turn and latencies"
+    option_list = BaseCommand.option_list + (
+        make_option('--map', default="Alpha", help="Name of the map to play on"),
+        make_option('--players', type='int', default=None, help="Players to create, the seats of the map if unset"),
+        make_option('--matches', type='int', default=1),
+        make_option('--turns', type='int', default=20, help="Stop matches that have not finished after this many"),
+        make_option('--driver', choices=('orm', 'http'), default='orm',
+                    help="Play through the models (orm) or through the views with the test client (http)"),
+        make_option('--host', default='testserver', help="Host name of the requests of the http driver"),
+        make_option('--prefix', default=None, help="Players are named prefix1, prefix2... sim<time>- if unset"),
+        make_option('--seed', type='int', default=None),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            game_map = Map.objects.get(name=options['map'])
+        except Map.DoesNotExist:
+            raise CommandError("Map %s does not exist" % options['map'])
+        prefix = options['prefix'] or "sim%d-" % time.time()
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError("There are users named %s..., choose another prefix" % prefix)
+        password = prefix
+
+        try:
+            players = simulator.create_players(options['players'] or game_map.num_seats, prefix, password)
+            matches = simulator.create_matches(game_map, players, options['matches'], prefix)
+            if options['driver'] == 'http':
+                driver = simulator.HttpDriver(password, options['host'])
+            else:
+                driver = simulator.OrmDriver()
+            report = simulator.Simulation(matches, driver, options['seed']).run(options['turns'])
+        except simulator.SimulationError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("%d turns of %d matches on %s through %s in %.3f s (%.1f turns/s)" % (
+            report.turns, len(matches), game_map.name, driver.name, report.seconds(), report.turns_per_second()))
+        if not report.turns:
+            return
+        self.stdout.write("%.1f queries per turn (max %d)" % (report.queries_per_turn(), max(report.turn_queries)))
+        for label, seconds in [('turn', report.turn_seconds)] + sorted(report.latencies.items()):
+            self.stdout.write("  %-10s p50 %8.3f ms  p99 %8.3f ms  max %8.3f ms  (%d)" % (
+                label, simulator.percentile(seconds, 50) * 1000, simulator.percentile(seconds, 99) * 1000,
+                max(seconds) * 1000, len(seconds)))
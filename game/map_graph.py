@@ -0,0 +1,171 @@
+class MapGraph(object):
+    """
+    Immutable, in-memory copy of the regions and links of a Map.
+
+    Regions are addressed by their position in region_ids (ordered by pk). Region sets are stored as int bitsets.
+    Built once per map and shared by every path check, so movement validation never touches the database.
+    Reachability tables are computed lazily, once per kind of movement, and kept with the graph.
+    """
+
+    __slots__ = ('map_id', 'region_ids', 'index', 'links', 'adjacency', 'land', 'water', 'reserves', 'region_country',
+                 'reserve_country', 'headquarters_country', 'headquarters_of_reserve', '_reachability')
+
+    _cache = dict()
+
+    def __init__(self, map_id, regions, links, countries):
+        self.map_id = map_id
+        self.region_ids = tuple(region['id'] for region in regions)
+        self.index = dict((region_id, i) for i, region_id in enumerate(self.region_ids))
+
+        land = 0
+        water = 0
+        for i, region in enumerate(regions):
+            if region['land']:
+                land |= 1 << i
+            if region['water']:
+                water |= 1 << i
+        self.land = land
+        self.water = water
+        self.region_country = tuple(region['country_id'] for region in regions)
+
+        # (source, destination, unidirectional, crossing_water)
+        self.links = tuple(
+            (self.index[link['source_id']], self.index[link['destination_id']],
+             link['unidirectional'], link['crossing_water'])
+            for link in links
+        )
+
+        # Usable links per region as (neighbour, crossing_water), same rules as MapRegion.usable_links
+        adjacency = [list() for _ in self.region_ids]
+        for source, destination, unidirectional, crossing_water in self.links:
+            adjacency[source].append((destination, crossing_water))
+            if not unidirectional:
+                adjacency[destination].append((source, crossing_water))
+        self.adjacency = tuple(tuple(neighbours) for neighbours in adjacency)
+
+        reserve_country = [None] * len(self.region_ids)
+        headquarters_country = [None] * len(self.region_ids)
+        for country in countries:
+            reserve_country[self.index[country['reserve_id']]] = country['id']
+            headquarters_country[self.index[country['headquarters_id']]] = country['id']
+        self.reserve_country = tuple(reserve_country)
+        self.headquarters_country = tuple(headquarters_country)
+        self.reserves = sum(1 << i for i, country in enumerate(reserve_country) if country is not None)
+        self.headquarters_of_reserve = tuple(
+            None if country is None else headquarters_country.index(country) for country in reserve_country)
+
+        self._reachability = dict()
+
+    @classmethod
+    def for_map(cls, map_id):
+        graph = cls._cache.get(map_id)
+        if graph is None:
+            from game.models import MapRegion, MapRegionLink, MapCountry
+
+            graph = cls(
+                map_id,
+                list(MapRegion.objects.filter(map_id=map_id).order_by('pk').values(
+                    'id', 'land', 'water', 'country_id')),
+                list(MapRegionLink.objects.filter(source__map_id=map_id).order_by('pk').values(
+                    'source_id', 'destination_id', 'unidirectional', 'crossing_water')),
+                list(MapCountry.objects.filter(map_id=map_id).values('id', 'reserve_id', 'headquarters_id')),
+            )
+            cls._cache[map_id] = graph
+        return graph
+
+    @classmethod
+    def invalidate(cls, map_id=None):
+        if map_id is None:
+            cls._cache.clear()
+        else:
+            cls._cache.pop(map_id, None)
+
+    def is_reserve(self, region_id):
+        return self.reserve_country[self.index[region_id]] is not None
+
+    def is_headquarters(self, region_id):
+        return self.headquarters_country[self.index[region_id]] is not None
+
+    def reachability(self, movements, can_be_on_land, can_be_on_water, one_water_cross_per_movement):
+        """
+        Bitsets of the regions reachable from every region in at most `movements` steps, not taking the
+        reserve and headquarters rules into account. Shared by all token types moving the same way.
+        """
+        key = (movements, bool(can_be_on_land), bool(can_be_on_water), bool(one_water_cross_per_movement))
+        table = self._reachability.get(key)
+        if table is None:
+            table = self._build_reachability(*key)
+            self._reachability[key] = table
+        return table
+
+    def _build_reachability(self, movements, can_be_on_land, can_be_on_water, one_water_cross_per_movement):
+        allowed = (self.land if can_be_on_land else 0) | (self.water if can_be_on_water else 0)
+        water_crossing_limited = not can_be_on_water and one_water_cross_per_movement
+
+        dry_links = list()
+        wet_links = list()
+        for neighbours in self.adjacency:
+            dry = 0
+            wet = 0
+            for neighbour, crossing_water in neighbours:
+                if crossing_water:
+                    wet |= 1 << neighbour
+                else:
+                    dry |= 1 << neighbour
+            dry_links.append(dry & allowed)
+            wet_links.append(wet & allowed)
+
+        def regions_in(bitset):
+            while bitset:
+                lowest = bitset & -bitset
+                yield lowest.bit_length() - 1
+                bitset ^= lowest
+
+        # Breadth first search over (region, crossed water) states, one level per movement
+        table = list()
+        for source in range(len(self.region_ids)):
+            dry_seen = dry_frontier = 1 << source
+            wet_seen = wet_frontier = 0
+            for _ in range(movements):
+                next_dry = 0
+                next_wet = 0
+                for region in regions_in(dry_frontier):
+                    next_dry |= dry_links[region]
+                    next_wet |= wet_links[region]
+                for region in regions_in(wet_frontier):
+                    next_wet |= dry_links[region]
+                    if not water_crossing_limited:
+                        next_wet |= wet_links[region]
+                dry_frontier = next_dry & ~dry_seen
+                wet_frontier = next_wet & ~wet_seen
+                if not dry_frontier and not wet_frontier:
+                    break
+                dry_seen |= dry_frontier
+                wet_seen |= wet_frontier
+            table.append(dry_seen | wet_seen)
+        return tuple(table)
+
+    def destinations(self, token_type, source_id):
+        source = self.index.get(source_id)
+        if source is None:
+            return 0
+        if self.reserve_country[source] is not None:
+            reachable = 1 << self.headquarters_of_reserve[source]
+        else:
+            reachable = self.reachability(token_type.movements, token_type.can_be_on_land, token_type.can_be_on_water,
+                                          token_type.one_water_cross_per_movement)[source]
+        if not token_type.special_attack_reserves:
+            reachable &= ~self.reserves
+        if not token_type.special_missile:
+            reachable &= ~(1 << source)
+        return reachable
+
+    def destination_ids(self, token_type, source_id):
+        reachable = self.destinations(token_type, source_id)
+        return [region_id for i, region_id in enumerate(self.region_ids) if reachable >> i & 1]
+
+    def path_exists(self, token_type, source_id, destination_id):
+        destination = self.index.get(destination_id)
+        if destination is None:
+            return False
+        return bool(self.destinations(token_type, source_id) >> destination & 1)
@@ -0,0 +1,35 @@
+from django.utils.functional import SimpleLazyObject
+
+from game.models import MatchPlayer, Player
+
+
+def get_player(request):
+    """The Player of the logged in user, or None. Loaded at most once per request."""
+    if not hasattr(request, '_cached_player'):
+        player = None
+        if request.user.is_authenticated():
+            try:
+                player = Player.objects.get_by_user(request.user)
+                player.user = request.user
+            except Player.DoesNotExist:
+                pass
+        request._cached_player = player
+    return request._cached_player
+
+
+def get_match_player(request, match):
+    """The MatchPlayer of the logged in user in match, or None. Loaded at most once per request and match."""
+    if not hasattr(request, '_cached_match_players'):
+        request._cached_match_players = dict()
+    if match.pk not in request._cached_match_players:
+        player = get_player(request)
+        request._cached_match_players[match.pk] = \
+            None if player is None else MatchPlayer.objects.get_by_match_and_player(match, player)
+    return request._cached_match_players[match.pk]
+
+
+class PlayerMiddleware(object):
+    """Sets request.player to the Player of the logged in user, loaded when it is first used."""
+
+    def process_request(self, request):
+        request.player = SimpleLazyObject(lambda: get_player(request))
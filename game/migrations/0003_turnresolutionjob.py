@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('game', '0002_maps_and_token_types'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TurnResolutionJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('status', models.CharField(max_length=3, db_index=True, default='QUE', choices=[('QUE', 'Queued'), ('RUN', 'Running'), ('DON', 'Done'), ('FAI', 'Failed')])),
+                ('worker', models.CharField(max_length=100, blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('turn', models.OneToOneField(related_name='resolution_job', to='game.Turn')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+def set_current_pointers(apps, schema_editor):
+    Match = apps.get_model('game', 'Match')
+    MatchPlayer = apps.get_model('game', 'MatchPlayer')
+    Turn = apps.get_model('game', 'Turn')
+    TurnStep = apps.get_model('game', 'TurnStep')
+    PlayerInTurnStep = apps.get_model('game', 'PlayerInTurnStep')
+
+    for match in Match.objects.all():
+        turn = Turn.objects.filter(match=match).order_by('-number').first()
+        if turn is None:
+            continue
+        first_step = TurnStep.objects.get(turn=turn, step=1)
+        latest_step = TurnStep.objects.filter(turn=turn).order_by('-step').first()
+        Match.objects.filter(pk=match.pk).update(current_turn=turn, current_step=latest_step)
+        for match_player in MatchPlayer.objects.filter(match=match):
+            MatchPlayer.objects.filter(pk=match_player.pk).update(
+                current_turn_player=PlayerInTurnStep.objects.filter(turn_step=first_step,
+                                                                    match_player=match_player).first(),
+                current_step_player=PlayerInTurnStep.objects.filter(turn_step=latest_step,
+                                                                    match_player=match_player).first())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('game', '0003_turnresolutionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='current_turn',
+            field=models.ForeignKey(related_name='current_of_match', blank=True, null=True, to='game.Turn',
+                                    on_delete=django.db.models.deletion.SET_NULL),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='current_step',
+            field=models.ForeignKey(related_name='current_of_match', blank=True, null=True, to='game.TurnStep',
+                                    on_delete=django.db.models.deletion.SET_NULL),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='matchplayer',
+            name='current_turn_player',
+            field=models.ForeignKey(related_name='current_turn_of', blank=True, null=True,
+                                    to='game.PlayerInTurnStep', on_delete=django.db.models.deletion.SET_NULL),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='matchplayer',
+            name='current_step_player',
+            field=models.ForeignKey(related_name='current_step_of', blank=True, null=True,
+                                    to='game.PlayerInTurnStep', on_delete=django.db.models.deletion.SET_NULL),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_current_pointers),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('game', '0004_current_turn_pointers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('type', models.CharField(max_length=3, choices=[('RDY', 'ready'), ('TRN', 'turn')])),
+                ('time', models.DateTimeField(auto_now_add=True)),
+                ('text', models.CharField(max_length=300)),
+                ('match', models.ForeignKey(related_name='events', to='game.Match')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('game', '0005_matchevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BoardSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('turn_number', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('match', models.ForeignKey(related_name='snapshots', to='game.Match')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='boardsnapshot',
+            unique_together=set([('match', 'turn_number')]),
+        ),
+        migrations.CreateModel(
+            name='MatchLogEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('turn_number', models.PositiveIntegerField()),
+                ('type', models.CharField(max_length=3, choices=[('RES', 'Turn resolved'), ('LEF', 'Player left')])),
+                ('data', models.TextField(default='')),
+                ('match', models.ForeignKey(related_name='log', to='game.Match')),
+                ('match_player', models.ForeignKey(related_name='+', blank=True, null=True, to='game.MatchPlayer')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='turnstep',
+            name='pruned',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
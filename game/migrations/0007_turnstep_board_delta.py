@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('game', '0006_match_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='turnstep',
+            name='board_delta',
+            field=models.BinaryField(blank=True, null=True),
+            preserve_default=True,
+        ),
+    ]
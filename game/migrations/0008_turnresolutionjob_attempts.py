@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('game', '0007_turnstep_board_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='turnresolutionjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
@@ -1,14 +1,21 @@
 from collections import defaultdict
+from datetime import timedelta
 from math import floor
 import random
 import string
+import traceback
 
 from django.core.exceptions import ValidationError
-from django.db.models import Sum, Q
+from django.db.models import Sum
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from game.map_graph import MapGraph
 
 
 class InvalidInviteError(Exception):
@@ -39,6 +46,14 @@ class CannotKickOwner(Exception):
     pass
 
 
+class TurnBeingResolved(Exception):
+    pass
+
+
+class TurnAlreadyResolved(Exception):
+    pass
+
+
 class PlayerManager(models.Manager):
     def create_player(self, email, username, password):
         user = User.objects.create_user(username, email, password)
@@ -129,54 +144,57 @@ class Map(models.Model):
 
     @staticmethod
     def check_map_path(token, source, destination):
-        def check_path(token, source, destination, movements_left, crossed_water):
-            if source == destination:
-                return True
-            if movements_left == 0:
-                return False
-            for link in source.usable_links():
-                if link.crossing_water and (
-                                not token.type.can_be_on_water and crossed_water and token.type.one_water_cross_per_movement):
-                    pass
-                else:
-                    links_to = link.destination if link.source == source else link.source
-                    if ((links_to.water and token.type.can_be_on_water) or (
-                                links_to.land and token.type.can_be_on_land) ) and \
-                            check_path(token, links_to, destination, movements_left - 1,
-                                       crossed_water or link.crossing_water):
-                        return True
-            return False
-
-        if source.map != destination.map:
+        if source.map_id != destination.map_id:
             return False
-        if token.owner.match_player.match.map != source.map:
+        if token.owner.match_player.match.map_id != source.map_id:
             return False
-        if destination.countries_with_this_reserve.exists() and not token.type.special_attack_reserves:
-            return False
-        if source == destination and not token.special_missile:
-            return False
-        if source.countries_with_this_reserve.exists():
-            return destination.countries_with_this_headquarter.exists() and \
-                   destination.countries_with_this_headquarter.first() == source.countries_with_this_reserve.first()
-        return check_path(token, source, destination, token.type.movements, False)
+        return MapGraph.for_map(source.map_id).path_exists(token.type, source.pk, destination.pk)
+
+    def graph(self):
+        return MapGraph.for_map(self.pk)
 
     def image_in_match(self, turn_step):  # TODO: fix transparency
+        from game import rendering
+        from game.engine import history
+
         map_image = self.image(False, False)
         tokens_per_region = defaultdict(lambda: 0)
-        for token in BoardToken.objects.filter(owner__turn_step=turn_step):
-            if not token.position.render_on_map:
-                continue
-            token_image = token.image()
-            x = token.position.position_x + 5 + ((tokens_per_region[token.position_id] % 4) * 20)
-            y = token.position.position_y + 20 + (floor(tokens_per_region[token.position_id] / 4) * 20)
+        if turn_step.pruned:
+            regions = dict((region[0], region[1:]) for region in self.regions.filter(render_on_map=True)
+                           .values_list('pk', 'position_x', 'position_y'))
+            image_file_names = dict(BoardTokenType.objects.values_list('pk', 'image_file_name'))
+            palettes = dict(MatchPlayer.objects.filter(match=turn_step.turn.match_id)
+                            .values_list('pk', 'country__color_gif_palette'))
+            tokens = [(position_id,) + regions[position_id] + (image_file_names[type_id], palettes[match_player_id])
+                      for position_id, match_player_id, type_id in history.step_tokens(turn_step)
+                      if position_id in regions]
+        else:
+            tokens = BoardToken.objects.filter(owner__turn_step=turn_step, position__render_on_map=True) \
+                .order_by('pk').values_list('position_id', 'position__position_x', 'position__position_y',
+                                            'type__image_file_name', 'owner__match_player__country__color_gif_palette')
+        for position_id, position_x, position_y, image_file_name, color_gif_palette in tokens:
+            token_image = rendering.token_sprite(image_file_name, color_gif_palette)
+            x = position_x + 5 + ((tokens_per_region[position_id] % 4) * 20)
+            y = position_y + 20 + (floor(tokens_per_region[position_id] / 4) * 20)
             map_image.paste(token_image, (x, y))
-            tokens_per_region[token.position_id] += 1
+            tokens_per_region[position_id] += 1
         return map_image
 
     def image(self, show_debug, show_links):
+        from game import rendering
+
+        return rendering.base_map(self, show_debug, show_links)
+
+    def background_path(self):
+        return 'game/static/game/%s-play.png' % self.image_file_name
+
+    def links(self):
+        return MapRegionLink.objects.filter(source__map=self)
+
+    def render_image(self, show_debug, show_links):
         from PIL import Image, ImageDraw, ImageFont
 
-        image = Image.open('game/static/game/%s-play.png' % self.image_file_name)
+        image = Image.open(self.background_path())
         draw = ImageDraw.Draw(image)
         font = ImageFont.load_default()
 
@@ -285,10 +303,12 @@ class Turn(models.Model):
     end = models.DateTimeField(blank=True, null=True)  # TODO Use this
 
     def is_latest(self):
-        return not Turn.objects.filter(match=self.match, number__gt=self.number).exists()
+        return Match.objects.filter(pk=self.match_id, current_turn=self).exists()
 
     def get_latest_step(self):
-        return self.steps.order_by("-step").first()
+        # Only the current turn can get new steps, the steps of the others never change
+        latest_step = TurnStep.objects.filter(current_of_match__current_turn=self).first()
+        return latest_step or self.steps.order_by("-step").first()
 
     def get_first_step(self):
         return self.steps.get(step=1)
@@ -300,24 +320,12 @@ class Turn(models.Model):
 
     def clone_to_new_turn(self, new_turn):
         new_step = TurnStep.objects.create(turn=new_turn)
-
-        # Clone players
-        for player in PlayerInTurnStep.objects.filter(turn_step=self.get_latest_step()):
-            player.pk = None
-            player.turn_step = new_step
-            player.ready = False
-            player.save(force_insert=True)
-
-        # Clone tokens
-        for token in BoardToken.objects.filter(
-                owner__in=PlayerInTurnStep.objects.filter(turn_step=self.get_latest_step())):
-            token.pk = None
-            token.moved_this_turn = False
-            token.can_move_this_turn = True
-            token.retreat_from_draw = False
-            token.owner = PlayerInTurnStep.objects.get(match_player=token.owner.match_player, turn_step=new_step)
-            token.save(force_insert=True)
-
+        self.get_latest_step().clone_board_to(
+            new_step,
+            player_changes={'ready': False},
+            token_changes={'moved_this_turn': False, 'can_move_this_turn': True, 'retreat_from_draw': False}
+        )
+        Match.objects.set_current_step(new_step)
         return new_turn
 
     def get_absolute_url(self):
@@ -327,13 +335,41 @@ class Turn(models.Model):
         return "%d in %s" % (self.number, self.match.name)
 
 
+class TurnStepManager(models.Manager):
+    def for_display(self, turn):
+        """
+        Steps of turn with everything shown about them prefetched: players with their country, user, commands and
+        tokens in reserve (as reserve_tokens), and battles with their location, winner and captured tokens.
+        """
+        reserve_tokens = BoardToken.objects.filter(position=models.F('owner__match_player__country__reserve')) \
+            .select_related('type').order_by('pk')
+        commands = Command.objects.select_related('token_type', 'location', 'move_destination',
+                                                  'conversion__needs', 'conversion__produces').order_by('order')
+        players = PlayerInTurnStep.objects.select_related('match_player__country__reserve',
+                                                          'match_player__player__user').order_by('pk')
+        battles = Battle.objects.select_related('location', 'winner__match_player__player__user').order_by('pk')
+        return self.filter(turn=turn).select_related('turn').order_by('step').prefetch_related(
+            models.Prefetch('players', queryset=players),
+            models.Prefetch('players__tokens', queryset=reserve_tokens, to_attr='reserve_tokens'),
+            models.Prefetch('players__commands', queryset=commands),
+            models.Prefetch('battles', queryset=battles),
+            'battles__captured_tokens')
+
+
 class TurnStep(models.Model):
     class Meta:
         unique_together = (("turn", "step"),)
 
+    objects = TurnStepManager()
+
     def is_latest(self):
         return not TurnStep.objects.filter(turn=self.turn, step__gt=self.step).exists()
 
+    def is_final(self):
+        """Final steps can not change anymore, which is every step but the latest one of a match in progress."""
+        return not Match.objects.filter(current_step=self,
+                                        status__in=(Match.STATUS_PLAYING, Match.STATUS_PAUSED)).exists()
+
     def append_report(self, content):
         if len(self.report) != 0:
             self.report += '<br>'
@@ -346,24 +382,42 @@ class TurnStep(models.Model):
         return next_step
 
     def clone_to_new_step(self, new_step):
-
-        # Clone players
-        for player in PlayerInTurnStep.objects.filter(turn_step=self):
-            player.pk = None
-            player.turn_step = new_step
-            player.save(force_insert=True)
-
-        # Clone tokens
-        for token in BoardToken.objects.filter(owner__in=PlayerInTurnStep.objects.filter(turn_step=self)):
-            token.pk = None
-            token.owner = PlayerInTurnStep.objects.get(match_player=token.owner.match_player, turn_step=new_step)
-            token.save(force_insert=True)
-
+        self.clone_board_to(new_step)
+        Match.objects.set_current_step(new_step)
         return new_step
 
+    def clone_board_to(self, new_step, player_changes=None, token_changes=None):
+        owners = PlayerInTurnStep.objects.clone_to_step(self, new_step, **(player_changes or {}))
+        BoardToken.objects.clone_to_owners(owners, **(token_changes or {}))
+
     turn = models.ForeignKey(Turn, related_name='steps')
     step = models.PositiveSmallIntegerField(default=1, db_index=True)
     report = models.TextField(default='')
+    # Pruned steps only keep the tokens battles point to, and the changes of their board from the previous step.
+    # game.engine.history rebuilds their boards.
+    pruned = models.BooleanField(default=False)
+    board_delta = models.BinaryField(null=True, blank=True)
+
+    @cached_property
+    def players_for_display(self):
+        """
+        Players of the step, with their tokens in reserve as reserve_tokens. The tokens of pruned steps are unsaved
+        instances built from the rebuilt board.
+        """
+        from game.engine import history
+
+        players = list(self.players.all())
+        if not self.pruned:
+            return players
+
+        token_types = dict((token_type.pk, token_type) for token_type in BoardTokenType.objects.all())
+        board = history.step_board(self)
+        for player_in_turn in players:
+            reserve_id = player_in_turn.match_player.country.reserve_id
+            player_in_turn.reserve_tokens = [BoardToken(position_id=token.position, type=token_types[token.type.id])
+                                             for token in board.tokens_of(player_in_turn.match_player_id)
+                                             if token.position == reserve_id]
+        return players
 
     def get_absolute_url(self):
         return "%s?turn=%d&step=%d" % (
@@ -372,6 +426,13 @@ class TurnStep(models.Model):
             self.step
         )
 
+    def get_board_url(self):
+        return "%s?turn=%d&step=%d" % (
+            reverse('game.views.view_board_in_match', kwargs={'match_pk': self.turn.match_id}),
+            self.turn.number,
+            self.step
+        )
+
     def __str__(self):
         return "Step %s in %s" % (self.step, self.turn)
 
@@ -395,16 +456,10 @@ class BoardTokenType(models.Model):
     special_destroys_all = models.BooleanField(default=False, help_text="Infinite strength, beats all")
 
     def image(self, country):
-        from PIL import Image
-
-        image = Image.open('game/static/game/%s.gif' % self.image_file_name)
-        pixel_data = image.load()
-        if country is not None:
-            for y in range(image.size[0]):
-                for x in range(image.size[1]):
-                    if pixel_data[x, y] == 14:
-                        pixel_data[x, y] = country.color_gif_palette
-        return image
+        from game import rendering
+
+        return rendering.token_sprite(self.image_file_name,
+                                      None if country is None else country.color_gif_palette).copy()
 
     def __str__(self):
         return self.name
@@ -432,6 +487,20 @@ class PlayerInTurnStepManager(models.Manager):
         return self.filter(match_player=match_player, turn_step__turn__number=turn_number).order_by(
             "-turn_step__step").first()
 
+    def clone_to_step(self, turn_step, new_step, **changes):
+        players = list(self.filter(turn_step=turn_step).order_by('pk'))
+        old_pks = dict((player.match_player_id, player.pk) for player in players)
+        for player in players:
+            player.pk = None
+            player.turn_step = new_step
+            for field, value in changes.items():
+                setattr(player, field, value)
+        self.bulk_create(players)
+
+        # Map every old owner to its clone in one query (bulk_create does not return primary keys)
+        return dict((old_pks[match_player_id], pk)
+                    for match_player_id, pk in self.filter(turn_step=new_step).values_list('match_player_id', 'pk'))
+
 
 class PlayerInTurnStep(models.Model):
     class Meta:
@@ -455,56 +524,23 @@ class PlayerInTurnStep(models.Model):
     def is_active(self):
         return self.match_player.is_active()
 
-    def can_add_commands(self):
+    def can_edit_commands(self):
         if not self.is_latest_turn():
             return False
         elif not self.is_active():
             return False
         elif not self.match_player.match.is_in_progress():
             return False
-        elif Command.objects.filter(player_in_turn=self).count() >= settings.COMMANDS_PER_TURN:
+        elif self.match_player.match.is_resolving_turn():
             return False
         return True
 
-    def set_defeated(self):
-        self.defeated = True
-        self.save()
-        self.match_player.defeated = True
-        self.match_player.save()
-
-    def check_and_process_defeat(self):
-        defeater_token = BoardToken.objects.filter(owner__turn_step=self.turn_step,
-                                                   type__can_capture_flag=True,
-                                                   position=self.match_player.country.headquarters) \
-            .exclude(owner=self).first()
-        if defeater_token is not None:
-            defeater = defeater_token.owner
-            defeater.power_points += self.power_points
-            defeater.save()
-            self.power_points = 0
-            self.set_defeated()
-            captured_tokens = BoardToken.objects.filter(owner=self)
-            captured_tokens.update(owner=defeater, position=defeater.match_player.country.reserve)
-            self.turn_step.append_report("%s captured %s's flag." % (
-                defeater.match_player.player.user.username, self.match_player.player.user.username))
-        else:
-            if not BoardToken.objects.filter(owner=self).exists() and self.power_points == 0:
-                self.set_defeated()
-                self.turn_step.append_report("%s lost all tokens and power points and is defeated." %
-                                             self.match_player.player.user.username)
-
-    def collect_power_points(self):
-        countries = list()
-        for token in BoardToken.objects.filter(owner=self).exclude(
-                position__country=self.match_player.country):
-            if token.position.country is not None and token.position.country not in countries:
-                countries.append(token.position.country)
-        collected_power_ponts = len(countries)
-        self.power_points += collected_power_ponts
-        if collected_power_ponts > 0:
-            self.turn_step.append_report("%s collects %d power points" % (self.match_player.player.user.username,
-                                                                          collected_power_ponts))
-        self.save()
+    def can_add_commands(self):
+        if not self.can_edit_commands():
+            return False
+        elif Command.objects.filter(player_in_turn=self).count() >= settings.COMMANDS_PER_TURN:
+            return False
+        return True
 
     def tokens_in_reserve(self):
         return BoardToken.objects.filter(owner=self, position=self.match_player.country.reserve)
@@ -516,24 +552,25 @@ class PlayerInTurnStep(models.Model):
     def make_ready(self):
         if not self.match_player.match.is_in_progress():
             raise MatchInWrongStatus()
+        if self.match_player.match.is_resolving_turn():
+            raise TurnBeingResolved()
         if self.ready:
             raise MatchPlayerAlreadyReady()
         self.ready = True
         self.save()
+        MatchEvent.objects.publish(self.match_player.match, MatchEvent.TYPE_READY,
+                                   "%s is ready" % self.match_player.player.user.username)
         self.match_player.match.check_all_players_ready()
 
     def is_latest_turn(self):
-        return not PlayerInTurnStep.objects.filter(match_player=self.match_player,
-                                                   turn_step__turn__number__gt=self.turn_step.turn.number).exists()
+        return Match.objects.filter(current_turn__steps=self.turn_step_id).exists()
 
     def is_latest_turn_step(self):
-        return not PlayerInTurnStep.objects \
-            .filter(match_player=self.match_player) \
-            .filter(Q(turn_step__turn__number__gt=self.turn_step.turn.number) |
-                    (Q(turn_step__turn__number=self.turn_step.turn.number) &
-                     Q(turn_step__step__gt=self.turn_step.step))).exists()
+        return MatchPlayer.objects.filter(pk=self.match_player_id, current_step_player=self).exists()
 
     def leave(self):
+        from game.engine import history
+
         if not self.match_player.is_active() or not self.match_player.match.is_in_progress() or self.left_match or self.defeated:
             assert False
         self.left_match = True
@@ -544,6 +581,7 @@ class PlayerInTurnStep(models.Model):
         self.match_player.save()
         self.match_player.match.check_and_process_end_of_game()
         BoardToken.objects.filter(owner=self).delete()
+        history.log_player_left(self)
 
         for match_player in self.match_player.match.players.all():
             if match_player.is_active():
@@ -560,7 +598,20 @@ class PlayerInTurnStep(models.Model):
             self.match_player.player.user.username, self.match_player.match.name, self.turn_step.number)
 
 
+class BoardTokenManager(models.Manager):
+    def clone_to_owners(self, owners, **changes):
+        tokens = list(self.filter(owner__in=list(owners)).order_by('pk'))
+        for token in tokens:
+            token.pk = None
+            token.owner_id = owners[token.owner_id]
+            for field, value in changes.items():
+                setattr(token, field, value)
+        self.bulk_create(tokens)
+
+
 class BoardToken(models.Model):
+    objects = BoardTokenManager()
+
     owner = models.ForeignKey(PlayerInTurnStep, related_name='tokens')
     position = models.ForeignKey(MapRegion)
     type = models.ForeignKey(BoardTokenType)
@@ -577,105 +628,11 @@ class BoardToken(models.Model):
 
 class BattleManager(models.Manager):
     def process_battles(self, incoming_turn_step):
-        iterations = 0
-        while True:
-            battle_exists = False
-            # TODO optimize and remove repetition
-            for region in incoming_turn_step.turn.match.map.regions.all():
-                tokens_in_region = BoardToken.objects.filter(owner__turn_step=incoming_turn_step, position=region)
-                if tokens_in_region.count() > 1:
-                    # Sort tokens per owner
-                    tokens_per_player = defaultdict(list)
-                    for token in tokens_in_region:
-                        tokens_per_player[token.owner_id].append(token)
-                    if len(tokens_per_player) > 1:
-                        battle_exists = True
-                        break
-
-            if battle_exists:
-                # Create new turn step
-                outgoing_turn_step = incoming_turn_step
-                incoming_turn_step = incoming_turn_step.create_next()
-            else:
-                break
-
-            for region in incoming_turn_step.turn.match.map.regions.all():
-                tokens_in_region = BoardToken.objects.filter(owner__turn_step=incoming_turn_step, position=region)
-                if tokens_in_region.count() > 1:
-                    # Sort tokens per owner
-                    tokens_per_player = defaultdict(list)
-                    for token in tokens_in_region:
-                        tokens_per_player[token.owner_id].append(token)
-                    if len(tokens_per_player) > 1:
-                        # There is a battle
-                        battle = self.create(location=region, turn_step=outgoing_turn_step)
-                        # TODO If infinite strength token present, it wins. If missile, it kills every token (no capture)
-                        # TODO: missiles do not capture!
-
-                        # No infinite strength tokens, sort players by force
-                        players_by_force = defaultdict(list)
-                        for player_in_battle, tokens in tokens_per_player.items():
-                            # Add up force, missiles only count if fired this turn
-                            players_by_force[
-                                sum(token.type.strength for token in tokens
-                                    if not token.type.special_missile or
-                                    (token.type.special_missile and token.move_this_turn))
-                            ].append(player_in_battle)
-
-                        winners = PlayerInTurnStep.objects.filter(id__in=players_by_force[max(players_by_force.keys())])
-
-                        if len(winners) == 1:
-                            # Single winner case, capture tokens
-                            # TODO: missiles do not capture!
-                            winner = winners[0]
-                            battle.winner = winner
-                            battle.save()
-                            for token in tokens_in_region:
-                                if token.owner == winner:
-                                    battle.winning_tokens.add(token)
-                                else:
-                                    battle.captured_tokens.add(token)
-                                    token.owner = winner
-                                    token.position = winner.match_player.country.reserve
-                                    token.save()
-                        elif len(winners) > 1:
-                            # Draw: retreat winner forces
-                            for token in tokens_in_region:
-                                battle.winning_tokens.add(token)
-                                if token.owner in winners and not token.retreat_from_draw:
-                                    revertable_command = Command.objects.filter(
-                                        player_in_turn__match_player=token.owner.match_player,
-                                        player_in_turn__turn_step=incoming_turn_step.turn.steps.get(step=1),
-                                        valid=True,
-                                        reverted_in_draw=False,
-                                        type=Command.TYPE_MOVEMENT,
-                                        move_destination=token.position,
-                                        token_type=token.type
-                                    ).first()
-                                    if revertable_command is not None:
-                                        revertable_command.reverted_in_draw = True
-                                        revertable_command.save()
-                                        token.position = revertable_command.location
-                                        token.retreat_from_draw = True
-                                        token.save()
-
-            # Delete shot missiles and steal power points from shot infinite strength missiles
-            for missile in BoardToken.objects.filter(owner__turn_step=incoming_turn_step,
-                                                     type__special_missile=True,
-                                                     moved_this_turn=True):
-                reserve_of = missile.location.countries_with_this_reserve.first()
-                if missile.special_destroys_all and reserve_of:
-                    steal_from = PlayerInTurnStep.objects.filter(turn=incoming_turn_step,
-                                                                 match_player__country=reserve_of)
-                    missile.owner.power_points += steal_from.power_points
-                    missile.owner.save()
-                    steal_from.power_points = 0
-                    steal_from.save()
-                missile.delete()
-
-            iterations += 1
-            if iterations >= settings.MAX_BATTLE_ITERATIONS:
-                assert False
+        from game.engine import rules, storage
+
+        turn = storage.load_turn(incoming_turn_step)
+        rules.resolve_battles(turn)
+        storage.save_turn(incoming_turn_step.turn.match, turn)
 
 
 class Battle(models.Model):
@@ -703,10 +660,69 @@ class Battle(models.Model):
         return "Battle turn %s in %s" % (self.turn, self.location)
 
 
+class CommandManager(models.Manager):
+    def replace_commands(self, player_in_turn, commands):
+        """
+        Make a list of commands sent by a client the only commands of player_in_turn, in the given order. Each command
+        is a dict with a type (move, buy or convert) and the ids it needs. All of them are checked before anything is
+        written, raising Command.InvalidCommandList for the first invalid one.
+        """
+        if not isinstance(commands, list):
+            raise Command.InvalidCommandList("Commands must be a list")
+        if len(commands) > settings.COMMANDS_PER_TURN:
+            raise Command.InvalidCommandList("At most %d commands per turn" % settings.COMMANDS_PER_TURN)
+
+        regions = dict((region.pk, region)
+                       for region in MapRegion.objects.filter(map_id=player_in_turn.match_player.match.map_id))
+        token_types = dict((token_type.pk, token_type) for token_type in BoardTokenType.objects.all())
+        conversions = dict((conversion.pk, conversion)
+                           for conversion in TokenConversion.objects.select_related('needs', 'produces'))
+
+        new_commands = list()
+        for order, data in enumerate(commands):
+            def lookup(objects, key, error):
+                try:
+                    return objects[int(data[key])]
+                except (KeyError, TypeError, ValueError):
+                    raise Command.InvalidCommandList("Command %d: %s" % (order + 1, error))
+
+            if not isinstance(data, dict):
+                raise Command.InvalidCommandList("Command %d: Invalid command" % (order + 1))
+            command = Command(player_in_turn=player_in_turn, order=order)
+            if data.get('type') == 'move':
+                command.type = Command.TYPE_MOVEMENT
+                command.token_type = lookup(token_types, 'token_type', "Invalid token type")
+                command.location = lookup(regions, 'region_from', "Invalid location(s)")
+                command.move_destination = lookup(regions, 'region_to', "Invalid location(s)")
+            elif data.get('type') == 'buy':
+                command.type = Command.TYPE_PURCHASE
+                command.token_type = lookup(token_types, 'token_type', "Invalid token type")
+                if not command.token_type.purchasable:
+                    raise Command.InvalidCommandList("Command %d: Invalid token type" % (order + 1))
+            elif data.get('type') == 'convert':
+                command.type = Command.TYPE_CONVERSION
+                command.conversion = lookup(conversions, 'conversion', "Invalid conversion")
+                command.location = lookup(regions, 'region', "Invalid location")
+            else:
+                raise Command.InvalidCommandList("Command %d: Invalid command type" % (order + 1))
+            new_commands.append(command)
+
+        with transaction.atomic():
+            # Lock the match row like turn resolution does, so the list is not replaced while the turn is resolved
+            Match.objects.filter(pk=player_in_turn.match_player.match_id).update(status=models.F('status'))
+            if not player_in_turn.can_edit_commands():
+                raise Command.CommandsLocked()
+            self.filter(player_in_turn=player_in_turn).delete()
+            self.bulk_create(new_commands)
+        return new_commands
+
+
 class Command(models.Model):
     class Meta:
         unique_together = (("player_in_turn", "order"),)
 
+    objects = CommandManager()
+
     class InvalidLocation(Exception):
         pass
 
@@ -716,6 +732,12 @@ class Command(models.Model):
     class InvalidCommandType(Exception):
         pass
 
+    class InvalidCommandList(Exception):
+        pass
+
+    class CommandsLocked(Exception):
+        pass
+
     TYPE_MOVEMENT = 'MOV'
     TYPE_CONVERSION = 'TCO'
     TYPE_VALUE_CONVERSION = 'VCO'
@@ -756,87 +778,6 @@ class Command(models.Model):
             raise Command.InvalidCommandType()
         return True
 
-    def is_valid(self, incoming_turn_step, incoming_player_in_turn):
-        if self.type == Command.TYPE_MOVEMENT:
-            token = BoardToken.objects.filter(owner__turn_step=incoming_turn_step,
-                                              type=self.token_type,
-                                              position=self.location).first()
-            if token is None or not token.can_move_this_turn:
-                return False
-            elif not Map.check_map_path(token, self.location, self.move_destination):
-                return False
-            else:
-                return True
-
-        elif self.type == Command.TYPE_PURCHASE:
-            if not self.token_type.purchasable:
-                return False
-            elif self.token_type.strength > incoming_player_in_turn.power_points:
-                return False
-            else:
-                return True
-
-        elif self.type == Command.TYPE_CONVERSION:
-            consumable = BoardToken.objects.filter(
-                owner=incoming_player_in_turn,
-                type=self.conversion.needs,
-                position=self.location
-            ).order_by('can_move_this_turn')
-
-            if consumable.count() < self.conversion.needs_quantity:
-                return False
-            else:
-                return True
-
-        else:
-            raise Command.InvalidCommandType()
-
-    def execute(self, incoming_turn_step, incoming_player_in_turn):
-        assert self.valid
-
-        if self.type == Command.TYPE_MOVEMENT:
-            token = BoardToken.objects.filter(owner__turn_step=incoming_turn_step,
-                                              type=self.token_type,
-                                              position=self.location).first()
-            token.position = self.move_destination
-            token.moved_this_turn = True
-            if self.location == incoming_player_in_turn.match_player.country.reserve and \
-                            self.move_destination == incoming_player_in_turn.match_player.country.headquarters:
-                token.can_move_this_turn = True
-            else:
-                token.can_move_this_turn = False
-            token.save()
-
-        elif self.type == Command.TYPE_PURCHASE:
-            incoming_player_in_turn.power_points -= self.token_type.strength
-            incoming_player_in_turn.save()
-            BoardToken.objects.create(
-                type=self.token_type,
-                position=incoming_player_in_turn.match_player.country.reserve,
-                owner=incoming_player_in_turn
-            )
-
-        elif self.type == Command.TYPE_CONVERSION:
-            consumable = BoardToken.objects.filter(
-                owner=incoming_player_in_turn,
-                type=self.conversion.needs,
-                position=self.location
-            ).order_by('can_move_this_turn')
-
-            for t in consumable[:self.conversion.needs_quantity]:
-                t.delete()
-            for i in range(self.conversion.produces_quantity):
-                BoardToken.objects.create(
-                    type=self.conversion.produces,
-                    position=self.location,
-                    owner=incoming_player_in_turn,
-                    can_move_this_turn=
-                    self.location == incoming_player_in_turn.match_player.country.reserve
-                )
-
-        else:
-            raise Command.InvalidCommandType()
-
     def in_game_str(self):
         if self.type == self.TYPE_MOVEMENT:
             return "Move %s from %s to %s" % (self.token_type.name, self.location.name, self.move_destination.name)
@@ -850,6 +791,14 @@ class Command(models.Model):
         return "%s in %s by %s" % (self.type, self.location.name, self.player_in_turn.__str__())
 
 
+def save_without_fields(instance, fields, args, kwargs):
+    """Save an existing instance without writing fields, unless they are explicitly listed in update_fields."""
+    if not instance._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+        kwargs['update_fields'] = [field.name for field in instance._meta.concrete_fields
+                                   if not field.primary_key and field.name not in fields]
+    models.Model.save(instance, *args, **kwargs)
+
+
 class MatchManager(models.Manager):
     def create_match(self, name, owner, map):
         match = self.create(name=name, owner=owner, map=map, status=Match.STATUS_SETUP)
@@ -858,6 +807,17 @@ class MatchManager(models.Manager):
     def get_by_player(self, player):
         return self.filter(players__player=player)
 
+    def set_current_step(self, turn_step):
+        """Point the match of turn_step and its players to it. Called whenever a newer step is created."""
+        turn = Turn.objects.filter(steps=turn_step).values_list('pk', 'match_id').get()
+        self.filter(pk=turn[1]).update(current_turn=turn[0], current_step=turn_step)
+        for pk, match_player_id in PlayerInTurnStep.objects.filter(turn_step=turn_step).values_list('pk',
+                                                                                                   'match_player_id'):
+            if turn_step.step == 1:
+                MatchPlayer.objects.filter(pk=match_player_id).update(current_turn_player=pk, current_step_player=pk)
+            else:
+                MatchPlayer.objects.filter(pk=match_player_id).update(current_step_player=pk)
+
 
 class Match(models.Model):
     class Meta:
@@ -887,6 +847,15 @@ class Match(models.Model):
     public = models.BooleanField(default=False, db_index=True)
     time_limit = models.DateTimeField(blank=True, null=True)  # TODO: use this
     round_time_limit = models.DateTimeField(blank=True, null=True)  # TODO: use this
+    # Latest turn and step, only moved by MatchManager.set_current_step
+    current_turn = models.ForeignKey('Turn', related_name='current_of_match', blank=True, null=True,
+                                     on_delete=models.SET_NULL)
+    current_step = models.ForeignKey('TurnStep', related_name='current_of_match', blank=True, null=True,
+                                     on_delete=models.SET_NULL)
+
+    def save(self, *args, **kwargs):
+        # Instances loaded before a turn was resolved must not move the current turn back
+        save_without_fields(self, ('current_turn', 'current_step'), args, kwargs)
 
     def is_in_progress(self):
         return self.status in (Match.STATUS_PLAYING, Match.STATUS_PAUSED)
@@ -895,10 +864,17 @@ class Match(models.Model):
         return self.status in (Match.STATUS_FINISHED, Match.STATUS_ABORTED, Match.STATUS_PAUSED, Match.STATUS_PLAYING)
 
     def get_latest_turn(self):
-        return Turn.objects.filter(match=self).order_by('-number').first()
+        return Turn.objects.filter(current_of_match=self).first()
+
+    def is_resolving_turn(self):
+        return TurnResolutionJob.objects.pending().filter(turn__match=self).exists()
+
+    def turn_resolution_failed(self):
+        return TurnResolutionJob.objects.filter(turn__current_of_match=self,
+                                                status=TurnResolutionJob.STATUS_FAILED).exists()
 
     def can_view_match(self, player):
-        return self.public or player in [player.player for player in self.players.all()]
+        return self.public or self.players.filter(player=player).exists()
 
     def join_player(self, player):
         if self.status != self.STATUS_SETUP:
@@ -931,7 +907,14 @@ class Match(models.Model):
         if self.status == self.STATUS_SETUP:
             self.transition_from_setup_to_playing()
         elif self.status == self.STATUS_PLAYING:
-            self.process_turn()
+            if settings.RESOLVE_TURNS_IN_BACKGROUND:
+                TurnResolutionJob.objects.enqueue(self.get_latest_turn())
+            else:
+                try:
+                    self.process_turn()
+                except TurnAlreadyResolved:
+                    # Another player got ready at the same time and resolved the turn
+                    pass
         elif self.status == self.STATUS_PAUSED:
             pass
         else:
@@ -940,6 +923,8 @@ class Match(models.Model):
     all_players_ready.alters_data = True
 
     def transition_from_setup_to_playing(self):
+        from game.engine import history
+
         # Create first turn
         turn = Turn.objects.create(match=self)
         turn_step = TurnStep.objects.create(turn=turn)
@@ -972,87 +957,39 @@ class Match(models.Model):
 
         self.status = self.STATUS_PLAYING
         self.save()
+        Match.objects.set_current_step(turn_step)
+        history.save_snapshot(turn)
+        MatchEvent.objects.publish(self, MatchEvent.TYPE_TURN, "Match %s started" % self.name)
 
     def check_and_process_end_of_game(self):
-        remaining_players = [match_player
-                             for match_player
-                             in self.players.all()
-                             if match_player.is_active()]
-        if len(remaining_players) <= 1:
-            if len(remaining_players) == 1:
-                self.get_latest_turn().get_latest_step().append_report("%s wins the match!" %
-                                                                       remaining_players[0].player.user.username)
-            else:
-                self.get_latest_turn().get_latest_step().append_report("The match ends in a draw!" %
-                                                                       remaining_players[0].player.user.username)
-            self.status = self.STATUS_FINISHED
-            for match_player in self.players.all():
-                if match_player in remaining_players:
-                    match_player.player.add_notification(
-                        "Congratulations! You won the match %s!" % self.name,
-                        self.get_absolute_url()
-                    )
-                elif not match_player.left_match:
-                    match_player.player.add_notification(
-                        "You lost the match %s" % self.name,
-                        self.get_absolute_url()
-                    )
-        self.save()
+        """Finish the match if at most one player is still playing, as the engine does at the end of a turn."""
+        from game.engine import rules, storage
+
+        turn = storage.load_turn(self.get_latest_turn().get_latest_step())
+        rules.check_and_process_end_of_game(turn)
+        storage.save_turn(self, turn)
 
     def process_turn(self):
-        # Create new turn step
-        outgoing_turn = self.get_latest_turn()
-        outgoing_turn_step = outgoing_turn.get_latest_step()
-        incoming_turn_step = outgoing_turn_step.create_next()
-
-        # Process commands
-        for outgoing_player_in_turn in PlayerInTurnStep.objects.filter(turn_step=outgoing_turn_step):
-            incoming_player_in_turn = PlayerInTurnStep.objects.get(turn_step=incoming_turn_step,
-                                                               match_player=outgoing_player_in_turn.match_player)
-
-            valid_command = False
-            for command in outgoing_player_in_turn.commands.all().order_by('order'):
-                command.valid = command.is_valid(incoming_turn_step, incoming_player_in_turn)
-                if command.valid:
-                    valid_command = True
-                    command.execute(incoming_turn_step, incoming_player_in_turn)
-                command.save()
-
-            # if no valid movements, subtract power point
-            if not valid_command and incoming_player_in_turn.power_points > 0:
-                outgoing_turn_step.append_report("%s had no valid commands, loses one power point" %
-                                                 incoming_player_in_turn.match_player.player.user.username)
-                incoming_player_in_turn.power_points -= 1
-                incoming_player_in_turn.save()
-
-        # Process battles
-        Battle.objects.process_battles(incoming_turn_step)
-
-        # Get latest turn step
-        incoming_turn_step = outgoing_turn.get_latest_step()
-
-        # Flag capture & defeats
-        for match_player in (match_player for match_player in self.players.all() if not match_player.defeated):
-            match_player.latest_player_in_turn_last_step().check_and_process_defeat()
-
-        # Check end of game
-        self.check_and_process_end_of_game()
-
-        if self.is_in_progress():
-            # Collect power points
-            for player_in_turn in PlayerInTurnStep.objects.filter(turn_step=incoming_turn_step):
-                player_in_turn.collect_power_points()
-
-            # Send notifications
-            for player_in_turn in PlayerInTurnStep.objects.filter(turn_step=incoming_turn_step):
-                if player_in_turn.is_active():
-                    player_in_turn.match_player.player.add_notification(
-                        "Turn passed (%d) for match %s." % (outgoing_turn.number, self.name),
-                        "%s?turn=%d" % (self.get_absolute_url(), outgoing_turn.number)
-                    )
+        from game.engine import history, rules, storage
 
-        # Create next turn
-        outgoing_turn.create_next()
+        outgoing_turn = self.get_latest_turn()
+        turn = rules.resolve_turn(storage.load_turn(outgoing_turn.get_latest_step()))
+        with transaction.atomic():
+            # Lock the match row, whoever gets it second finds the turn already resolved. An update locks it on every
+            # backend, and on SQLite it also takes the write lock before reading instead of failing to upgrade later.
+            Match.objects.filter(pk=self.pk).update(status=models.F('status'))
+            if not outgoing_turn.is_latest():
+                raise TurnAlreadyResolved()
+            storage.save_turn(self, turn)
+            history.log_turn_resolved(self, turn)
+
+            # Create next turn
+            next_turn = outgoing_turn.create_next()
+            if history.snapshot_due(self, next_turn.number):
+                history.save_snapshot(next_turn)
+            if settings.KEEP_BOARD_ROWS_FOR_TURNS is not None:
+                history.prune_boards(self, settings.KEEP_BOARD_ROWS_FOR_TURNS)
+            MatchEvent.objects.publish(self, MatchEvent.TYPE_TURN, "Turn %d resolved" % outgoing_turn.number)
 
     def get_absolute_url(self):
         return reverse('game.views.view_match', kwargs={'match_pk': self.pk})
@@ -1086,14 +1023,20 @@ class MatchPlayer(models.Model):
     timeout_requested = models.BooleanField(default=False)  # TODO: use this
     left_match = models.BooleanField(default=False)
     defeated = models.BooleanField(default=False)
+    # In the first and in the latest step of the current turn, only moved by MatchManager.set_current_step
+    current_turn_player = models.ForeignKey('PlayerInTurnStep', related_name='current_turn_of', blank=True,
+                                            null=True, on_delete=models.SET_NULL)
+    current_step_player = models.ForeignKey('PlayerInTurnStep', related_name='current_step_of', blank=True,
+                                            null=True, on_delete=models.SET_NULL)
+
+    def save(self, *args, **kwargs):
+        save_without_fields(self, ('current_turn_player', 'current_step_player'), args, kwargs)
 
     def latest_player_in_turn_first_step(self):
-        return PlayerInTurnStep.objects.filter(match_player=self, turn_step__step=1).order_by(
-            '-turn_step__turn__number').first()
+        return PlayerInTurnStep.objects.filter(current_turn_of=self).first()
 
     def latest_player_in_turn_last_step(self):
-        return PlayerInTurnStep.objects.filter(match_player=self).order_by('-turn_step__turn__number',
-                                                                           '-turn_step__step').first()
+        return PlayerInTurnStep.objects.filter(current_step_of=self).first()
 
     def is_active(self):
         return not self.defeated and not self.left_match
@@ -1111,6 +1054,8 @@ class MatchPlayer(models.Model):
 
     def leave(self):
         if self.match.is_in_progress():
+            if self.match.is_resolving_turn():
+                raise TurnBeingResolved()
             self.latest_player_in_turn_last_step().leave()
         elif self.match.status == Match.STATUS_SETUP:
             if self.match.owner.pk == self.pk:
@@ -1140,6 +1085,7 @@ class MatchPlayer(models.Model):
                 raise MatchPlayerAlreadyReady
             self.setup_ready = True
             self.save()
+            MatchEvent.objects.publish(self.match, MatchEvent.TYPE_READY, "%s is ready" % self.player.user.username)
             self.match.check_all_players_ready()
         elif self.match.is_in_progress():
             self.latest_player_in_turn_last_step().make_ready()
@@ -1168,4 +1114,167 @@ class Notification(models.Model):
     url = models.CharField(max_length=300)
 
     def __str__(self):
-        return "%s (to %s, %s, URL: %s)" % (self.text, self.player, "read" if self.read else "unread", self.url)
\ No newline at end of file
+        return "%s (to %s, %s, URL: %s)" % (self.text, self.player, "read" if self.read else "unread", self.url)
+
+
+class MatchEventManager(models.Manager):
+    def publish(self, match, type, text):
+        return self.create(match=match, type=type, text=text)
+
+    def after(self, match, pk):
+        return self.filter(match=match, pk__gt=pk).order_by('pk')
+
+    def latest_pk(self, match):
+        return self.filter(match=match).aggregate(models.Max('pk'))['pk__max'] or 0
+
+
+class MatchEvent(models.Model):
+    """Something that happened in a match, streamed to the clients watching it by views.match_events."""
+    objects = MatchEventManager()
+
+    TYPE_READY = 'RDY'
+    TYPE_TURN = 'TRN'
+    TYPES = (
+        (TYPE_READY, 'ready'),
+        (TYPE_TURN, 'turn'),
+    )
+
+    match = models.ForeignKey(Match, related_name='events')
+    type = models.CharField(max_length=3, choices=TYPES)
+    time = models.DateTimeField(auto_now_add=True)
+    text = models.CharField(max_length=300)
+
+    def __str__(self):
+        return "%s (%s in %s)" % (self.text, self.get_type_display(), self.match)
+
+
+class MatchLogEntry(models.Model):
+    """
+    Append-only log of what changed the boards of a match: the commands each turn was resolved with and the players
+    leaving. Replayed from a BoardSnapshot it gives back every step, see game.engine.history.
+    """
+    TYPE_TURN_RESOLVED = 'RES'
+    TYPE_PLAYER_LEFT = 'LEF'
+    TYPES = (
+        (TYPE_TURN_RESOLVED, 'Turn resolved'),
+        (TYPE_PLAYER_LEFT, 'Player left'),
+    )
+
+    match = models.ForeignKey(Match, related_name='log')
+    turn_number = models.PositiveIntegerField()
+    type = models.CharField(max_length=3, choices=TYPES)
+    match_player = models.ForeignKey(MatchPlayer, null=True, blank=True, related_name='+')
+    data = models.TextField(default='')
+
+    def __str__(self):
+        return "%s in turn %d of %s" % (self.get_type_display(), self.turn_number, self.match)
+
+
+class BoardSnapshot(models.Model):
+    """The board a turn of a match started with, taken every MATCH_SNAPSHOT_INTERVAL turns."""
+    class Meta:
+        unique_together = (("match", "turn_number"),)
+
+    match = models.ForeignKey(Match, related_name='snapshots')
+    turn_number = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    def __str__(self):
+        return "Board of turn %d of %s" % (self.turn_number, self.match)
+
+
+class TurnResolutionJobManager(models.Manager):
+    def pending(self):
+        return self.filter(status__in=(TurnResolutionJob.STATUS_QUEUED, TurnResolutionJob.STATUS_RUNNING))
+
+    def enqueue(self, turn):
+        job, created = self.get_or_create(turn=turn)
+        return job
+
+    def claim(self, worker, count=1):
+        """
+        Take up to count of the oldest queued jobs. Claiming is a conditional update of the job row, which the database
+        runs under a row lock, so only one worker can move a job out of the queue and each job runs once. Jobs claimed
+        longer than TURN_RESOLUTION_TIMEOUT seconds ago are taken as abandoned by a dead worker and queued again first.
+        """
+        self.requeue_abandoned()
+        claimed = list()
+        for job_pk in self.filter(status=TurnResolutionJob.STATUS_QUEUED).order_by('pk').values_list('pk', flat=True):
+            if self.filter(pk=job_pk, status=TurnResolutionJob.STATUS_QUEUED).update(
+                    status=TurnResolutionJob.STATUS_RUNNING, worker=worker, started=timezone.now(),
+                    attempts=models.F('attempts') + 1):
+                claimed.append(job_pk)
+                if len(claimed) == count:
+                    break
+        return list(self.filter(pk__in=claimed).select_related('turn__match').order_by('pk'))
+
+    def requeue_abandoned(self):
+        abandoned = self.filter(status=TurnResolutionJob.STATUS_RUNNING,
+                                started__lt=timezone.now() - timedelta(seconds=settings.TURN_RESOLUTION_TIMEOUT))
+        error = "The worker did not finish the job in %d seconds" % settings.TURN_RESOLUTION_TIMEOUT
+        abandoned.filter(attempts__lt=settings.TURN_RESOLUTION_ATTEMPTS).update(
+            status=TurnResolutionJob.STATUS_QUEUED, error=error)
+        abandoned.update(status=TurnResolutionJob.STATUS_FAILED, error=error, finished=timezone.now())
+
+
+class TurnResolutionJob(models.Model):
+    objects = TurnResolutionJobManager()
+
+    STATUS_QUEUED = 'QUE'
+    STATUS_RUNNING = 'RUN'
+    STATUS_DONE = 'DON'
+    STATUS_FAILED = 'FAI'
+    STATUSES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    turn = models.OneToOneField(Turn, related_name='resolution_job')
+    status = models.CharField(max_length=3, choices=STATUSES, default=STATUS_QUEUED, db_index=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    # When a worker last claimed the job
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    def run(self):
+        match = self.turn.match
+        try:
+            # The turn could have been resolved already by a job that was requeued
+            if match.status == Match.STATUS_PLAYING and self.turn.is_latest():
+                match.process_turn()
+            self.status = self.STATUS_DONE
+        except TurnAlreadyResolved:
+            self.status = self.STATUS_DONE
+        except Exception:
+            self.fail(traceback.format_exc())
+            return False
+        self.finished = timezone.now()
+        self.save()
+        return True
+
+    def fail(self, error):
+        """Queue the job again, or mark it failed once it has been tried TURN_RESOLUTION_ATTEMPTS times."""
+        self.status = self.STATUS_QUEUED if self.attempts < settings.TURN_RESOLUTION_ATTEMPTS else self.STATUS_FAILED
+        self.error = error
+        self.finished = timezone.now()
+        self.save()
+
+    def __str__(self):
+        return "Resolution of turn %s (%s)" % (self.turn, self.get_status_display())
+
+
+def invalidate_map_caches(sender, **kwargs):
+    from game import rendering
+
+    MapGraph.invalidate()
+    rendering.invalidate_base_maps()
+
+
+for map_model in (Map, MapRegion, MapRegionLink, MapCountry):
+    post_save.connect(invalidate_map_caches, sender=map_model)
+    post_delete.connect(invalidate_map_caches, sender=map_model)
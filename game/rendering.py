@@ -0,0 +1,445 @@
+from collections import OrderedDict
+import hashlib
+import io
+import json
+import os
+import threading
+
+from django.conf import settings
+
+
+class RenderCache(object):
+    """
+    Thread safe in-process LRU of rendered PNG files, backed by files in settings.RENDER_CACHE_DIR when it is set.
+
+    Memory entries are kept until they are invalidated or pushed out. Files are named after the key and, if given, a
+    hash of what was rendered, so a stale file is never served and files can be shared by several processes.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def copy(self, value):
+        return value
+
+    def get(self, key):
+        """Return the value of key in memory, or None."""
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                return None
+            self._values.move_to_end(key)
+            return self.copy(value)
+
+    def put(self, key, value):
+        value = self.copy(value)
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+
+    def get_or_render(self, key, render, content_hash=None):
+        """
+        Return the value of key. On a memory miss content_hash() names the file to look for, and render() is only
+        called if there is none.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        path = self.file_path(key, None if content_hash is None else content_hash())
+        value = self.load_file(path)
+        if value is None:
+            value = render()
+            self.save_file(path, value)
+        self.put(key, value)
+        return self.copy(value)
+
+    def invalidate(self, match=None):
+        """Forget the memory entries whose key satisfies match, or all of them."""
+        with self._lock:
+            for key in [key for key in self._values if match is None or match(key)]:
+                del self._values[key]
+
+    def file_path(self, key, content_hash):
+        if not settings.RENDER_CACHE_DIR:
+            return None
+        parts = [str(part) for part in key]
+        if content_hash is not None:
+            parts.append(content_hash)
+        return os.path.join(settings.RENDER_CACHE_DIR, self.name, "%s.png" % "-".join(parts))
+
+    def read(self, path):
+        with open(path, 'rb') as png:
+            return png.read()
+
+    def write(self, path, value):
+        with open(path, 'wb') as png:
+            png.write(value)
+
+    def load_file(self, path):
+        if path is None:
+            return None
+        try:
+            return self.read(path)
+        except (IOError, OSError):
+            return None
+
+    def save_file(self, path, value):
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a temporary name first, so concurrent readers never see a partial file
+        temporary_path = "%s.%d.tmp" % (path, os.getpid())
+        self.write(temporary_path, value)
+        os.replace(temporary_path, path)
+
+
+class ImageRenderCache(RenderCache):
+    """RenderCache of PIL images. They are returned as copies, callers are free to draw on them."""
+
+    def copy(self, value):
+        return value.copy()
+
+    def read(self, path):
+        from PIL import Image
+
+        image = Image.open(path)
+        image.load()
+        return image
+
+    def write(self, path, value):
+        value.save(path, "PNG")
+
+
+base_maps = ImageRenderCache('maps', settings.BASE_MAP_CACHE_SIZE)
+_base_map_hashes = dict()
+
+
+def map_content_hash(game_map, show_debug, show_links):
+    """Hash of everything drawn on the base layer of game_map: the background image, region labels and links."""
+    content = hashlib.sha1()
+    with open(game_map.background_path(), 'rb') as background:
+        content.update(background.read())
+    regions = game_map.regions.order_by('pk').values_list(
+        'pk', 'name', 'short_name', 'country__name', 'land', 'water', 'render_on_map', 'position_x', 'position_y',
+        'size_x', 'size_y')
+    content.update(repr((bool(show_debug), bool(show_links), list(regions))).encode())
+    if show_links:
+        content.update(repr(list(game_map.links().order_by('pk').values_list(
+            'source_id', 'destination_id', 'crossing_water'))).encode())
+    return content.hexdigest()
+
+
+def base_map_hash(game_map, show_debug, show_links):
+    """map_content_hash, remembered until the base maps are invalidated."""
+    key = (game_map.pk, int(bool(show_debug)), int(bool(show_links)))
+    content_hash = _base_map_hashes.get(key)
+    if content_hash is None:
+        content_hash = _base_map_hashes[key] = map_content_hash(game_map, show_debug, show_links)
+    return content_hash
+
+
+def base_map(game_map, show_debug, show_links):
+    """The rendered base layer of game_map, as a new image that can be drawn on."""
+    show_debug = bool(show_debug)
+    show_links = bool(show_links)
+    return base_maps.get_or_render(
+        (game_map.pk, int(show_debug), int(show_links)),
+        lambda: game_map.render_image(show_debug, show_links),
+        lambda: base_map_hash(game_map, show_debug, show_links)
+    )
+
+
+def invalidate_base_maps(map_id=None):
+    match = None if map_id is None else lambda key: key[0] == map_id
+    base_maps.invalidate(match)
+    for key in [key for key in list(_base_map_hashes) if match is None or match(key)]:
+        _base_map_hashes.pop(key, None)
+
+
+# Palette index of the parts of token sprites painted in the colour of their country
+SPRITE_COUNTRY_COLOR = 14
+
+_sprites = dict()
+_sprites_lock = threading.Lock()
+_sprite_files = dict()
+
+
+def token_sprite(image_file_name, color_gif_palette=None):
+    """
+    The sprite of a token type tinted for a country, by the palette index of its colour. Sprites are built once per
+    combination and shared, they must not be modified.
+    """
+    key = (image_file_name, color_gif_palette)
+    sprite = _sprites.get(key)
+    if sprite is None:
+        sprite = build_sprite(image_file_name, color_gif_palette)
+        with _sprites_lock:
+            sprite = _sprites.setdefault(key, sprite)
+    return sprite
+
+
+def build_sprite(image_file_name, color_gif_palette):
+    from PIL import Image
+
+    sprite = Image.open('game/static/game/%s.gif' % image_file_name)
+    sprite.load()
+    if color_gif_palette is not None:
+        # Remap the palette index instead of the pixels, the palette and transparency are kept
+        lookup_table = list(range(256))
+        lookup_table[SPRITE_COUNTRY_COLOR] = color_gif_palette
+        sprite = sprite.point(lookup_table)
+    return sprite
+
+
+def token_sprite_png(image_file_name, color_gif_palette=None):
+    """The sprite of token_sprite as a PNG file, and a hash of its content."""
+    key = (image_file_name, color_gif_palette)
+    sprite_file = _sprite_files.get(key)
+    if sprite_file is None:
+        png = encode_png(token_sprite(image_file_name, color_gif_palette))
+        sprite_file = _sprite_files[key] = (hashlib.sha1(png).hexdigest(), png)
+    return sprite_file
+
+
+def build_all_sprites():
+    """Build the sprites of every token type for every country colour in use."""
+    from game.models import BoardTokenType, MapCountry
+
+    colors = [None] + list(MapCountry.objects.order_by().values_list('color_gif_palette', flat=True).distinct())
+    for image_file_name in BoardTokenType.objects.values_list('image_file_name', flat=True):
+        for color_gif_palette in colors:
+            token_sprite(image_file_name, color_gif_palette)
+
+
+_token_atlases = dict()
+
+
+class TokenAtlas(object):
+    """
+    Every token sprite in every country colour of a map in a single image, one row per country and one column per
+    token type. The first row holds the sprites without a country colour.
+    """
+
+    def __init__(self, content, countries, token_types):
+        self.content = content
+        self.rows = dict((country_pk, row) for row, (country_pk, _) in enumerate(countries))
+        self.columns = dict((token_type_pk, column) for column, (token_type_pk, _) in enumerate(token_types))
+        sprites = [[token_sprite(image_file_name, color_gif_palette) for _, image_file_name in token_types]
+                   for _, color_gif_palette in countries]
+        self.sprite_size = (max([sprite.size[0] for row in sprites for sprite in row] or [0]),
+                            max([sprite.size[1] for row in sprites for sprite in row] or [0]))
+        self.png = encode_png(self.draw(sprites))
+        self.content_hash = hashlib.sha1(self.png).hexdigest()
+
+    def draw(self, sprites):
+        from PIL import Image
+
+        width, height = self.sprite_size
+        atlas = Image.new("RGBA", (max(width * len(self.columns), 1), max(height * len(self.rows), 1)))
+        for row, row_sprites in enumerate(sprites):
+            for column, sprite in enumerate(row_sprites):
+                atlas.paste(sprite.convert("RGBA"), (column * width, row * height))
+        return atlas
+
+    def position(self, token_type_pk, country_pk=None):
+        """Offset of a sprite in the atlas, in pixels."""
+        return (self.columns[token_type_pk] * self.sprite_size[0],
+                self.rows[country_pk or None] * self.sprite_size[1])
+
+    def css(self, url):
+        """Style sheet showing the right sprite in elements of class token and the token_css_class of a sprite."""
+        rules = [".token { display: inline-block; vertical-align: middle; width: %dpx; height: %dpx; "
+                 "background-image: url('%s'); }" % (self.sprite_size + (url, ))]
+        for country_pk in sorted(self.rows, key=lambda pk: pk or 0):
+            for token_type_pk in sorted(self.columns):
+                x, y = self.position(token_type_pk, country_pk)
+                rules.append(".%s { background-position: -%dpx -%dpx; }" % (
+                    token_css_class(token_type_pk, country_pk), x, y))
+        return "\n".join(rules)
+
+
+def token_css_class(token_type_pk, country_pk=None):
+    return "token-%s-%s" % (token_type_pk, country_pk or 0)
+
+
+def token_atlas(game_map):
+    """The TokenAtlas of game_map, drawn again when its countries or the token types change."""
+    from game.models import BoardTokenType
+
+    countries = [(None, None)] + list(game_map.countries.order_by('pk').values_list('pk', 'color_gif_palette'))
+    token_types = list(BoardTokenType.objects.order_by('pk').values_list('pk', 'image_file_name'))
+    content = repr((countries, token_types))
+    atlas = _token_atlases.get(game_map.pk)
+    if atlas is None or atlas.content != content:
+        atlas = TokenAtlas(content, countries, token_types)
+        _token_atlases[game_map.pk] = atlas
+    return atlas
+
+
+def match_board(turn_step):
+    """
+    The board of turn_step for clients drawing it themselves over the base map: the regions shown on the map, the
+    players, the tokens in those regions as [region, match player, token type] in drawing order, and where the
+    sprites of every token type and country are in the token atlas of the map.
+    """
+    from game.engine import history
+    from game.models import BoardToken
+
+    match = turn_step.turn.match
+    atlas = token_atlas(match.map)
+    regions = match.map.regions.filter(render_on_map=True).order_by('pk').values_list(
+        'pk', 'name', 'position_x', 'position_y', 'size_x', 'size_y')
+    players = match.players.order_by('pk').values_list('pk', 'country_id', 'country__color_rgb',
+                                                       'player__user__username')
+    if turn_step.pruned:
+        shown = set(match.map.regions.filter(render_on_map=True).values_list('pk', flat=True))
+        tokens = [token for token in history.step_tokens(turn_step) if token[0] in shown]
+    else:
+        tokens = BoardToken.objects.filter(owner__turn_step=turn_step, position__render_on_map=True).order_by('pk') \
+            .values_list('position_id', 'owner__match_player_id', 'type_id')
+    return {
+        'regions': [{'id': pk, 'name': name, 'position': [position_x, position_y], 'size': [size_x, size_y]}
+                    for pk, name, position_x, position_y, size_x, size_y in regions],
+        'players': [{'id': pk, 'country': country_id, 'color': color_rgb, 'username': username}
+                    for pk, country_id, color_rgb, username in players],
+        'tokens': [list(token) for token in tokens],
+        'atlas': {
+            'sprite_size': list(atlas.sprite_size),
+            'rows': dict((country_pk or 0, row) for country_pk, row in atlas.rows.items()),
+            'columns': atlas.columns,
+        },
+    }
+
+
+# Bump when the way maps in matches are drawn changes, so previously cached steps are drawn again
+MATCH_MAP_RENDER_VERSION = 1
+
+match_maps = RenderCache('steps', settings.MATCH_MAP_CACHE_SIZE)
+
+
+def encode_png(image):
+    png = io.BytesIO()
+    image.save(png, "PNG")
+    return png.getvalue()
+
+
+def match_map_png(turn_step):
+    """
+    The map of a match in turn_step as a PNG file. Final steps never change and are cached, the latest step of a match
+    in progress is drawn on every call.
+    """
+    game_map = turn_step.turn.match.map
+    if not turn_step.is_final():
+        return encode_png(game_map.image_in_match(turn_step))
+    return match_maps.get_or_render((turn_step.pk, MATCH_MAP_RENDER_VERSION),
+                                    lambda: encode_png(game_map.image_in_match(turn_step)),
+                                    lambda: match_map_content_hash(turn_step))
+
+
+def match_map_etag(turn_step, final=None):
+    """
+    ETag of the map of a match in turn_step. Final steps never change, their primary key and the base map name them
+    without looking at their tokens.
+    """
+    if final is None:
+        final = turn_step.is_final()
+    if final:
+        return "%d-%d-%s" % (MATCH_MAP_RENDER_VERSION, turn_step.pk,
+                             base_map_hash(turn_step.turn.match.map, False, False))
+    return "%d-%s" % (MATCH_MAP_RENDER_VERSION, match_map_content_hash(turn_step))
+
+
+def match_map_content_hash(turn_step):
+    """Hash of the map and tokens of turn_step, so files survive neither a database reset nor a map change."""
+    from game.engine import history
+    from game.models import BoardTokenType, MatchPlayer
+
+    game_map = turn_step.turn.match.map
+    image_file_names = dict(BoardTokenType.objects.values_list('pk', 'image_file_name'))
+    palettes = dict(MatchPlayer.objects.filter(match=turn_step.turn.match_id)
+                    .values_list('pk', 'country__color_gif_palette'))
+    tokens = [(position_id, image_file_names[type_id], palettes[match_player_id])
+              for position_id, match_player_id, type_id in history.step_tokens(turn_step)]
+    return hashlib.sha1(repr((game_map.pk, game_map.image_file_name, tokens)).encode()).hexdigest()
+
+
+def cache_match_maps(turn):
+    """Draw and cache the maps of every step of a resolved turn, so nobody waits for them later."""
+    for turn_step in turn.steps.select_related('turn__match__map'):
+        match_map_png(turn_step)
+
+
+STATIC_ASSET_MANIFEST = 'manifest.json'
+
+_static_assets = dict(path=None, mtime=None, files=dict())
+
+
+def token_asset_name(token_type_pk, country_pk=None):
+    return "token-%s-%s" % (token_type_pk, country_pk or 0)
+
+
+def map_asset_name(map_pk, show_debug=False, show_links=False):
+    return "map-%s-%d-%d" % (map_pk, bool(show_debug), bool(show_links))
+
+
+def token_atlas_asset_name(map_pk):
+    return "atlas-%s" % map_pk
+
+
+def static_asset_files():
+    """
+    The manifest of the assets written by the render_static_assets command, mapping asset names to file names. Read
+    again whenever the command writes a new one.
+    """
+    if not settings.RENDERED_ASSETS_DIR:
+        return dict()
+    path = os.path.join(settings.RENDERED_ASSETS_DIR, STATIC_ASSET_MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return dict()
+    if _static_assets['path'] != path or _static_assets['mtime'] != mtime:
+        with open(path) as manifest:
+            _static_assets.update(path=path, mtime=mtime, files=json.load(manifest))
+    return _static_assets['files']
+
+
+def static_asset_url(name):
+    """URL of the pre-rendered file of the asset called name, or None if there is none."""
+    file_name = static_asset_files().get(name)
+    if file_name is None:
+        return None
+    return settings.RENDERED_ASSETS_URL + file_name
+
+
+def write_static_assets(directory, assets):
+    """
+    Write the PNG files of assets, (asset name, file name, function returning the PNG) tuples, to directory and their
+    manifest. File names carry a hash of their content, existing files are not drawn again.
+    """
+    files = dict()
+    written = 0
+    for name, file_name, png in assets:
+        path = os.path.join(directory, file_name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(temporary_path, 'wb') as asset:
+                asset.write(png())
+            os.replace(temporary_path, path)
+            written += 1
+        files[name] = file_name
+
+    # The manifest goes last, templates never link to a file that is not there yet
+    path = os.path.join(directory, STATIC_ASSET_MANIFEST)
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, 'w') as manifest:
+        json.dump(files, manifest, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+    return written
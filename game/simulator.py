@@ -0,0 +1,208 @@
+from collections import defaultdict
+import json
+import math
+import random
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+
+from game.engine import storage
+from game.management.commands import resolve_turns
+from game.models import BoardToken, Command, Match, MatchPlayer, Player, TurnResolutionJob
+
+
+class SimulationError(Exception):
+    pass
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a non-empty list of numbers."""
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(percent / 100.0 * len(ordered))) - 1, 0)]
+
+
+def create_players(count, prefix, password):
+    return [Player.objects.create_player("%s%d@localhost" % (prefix, i), "%s%d" % (prefix, i), password)
+            for i in range(1, count + 1)]
+
+
+def create_matches(game_map, players, count, prefix):
+    """
+    Start count matches on game_map, filling the seats of each with the next players, going around players. Matches
+    are started the way players start them, by making every one of them ready.
+    """
+    seats = game_map.num_seats
+    if len(players) < seats:
+        raise SimulationError("%s has %d seats, %d players can not fill them" % (game_map, seats, len(players)))
+    if game_map.countries.count() < seats:
+        raise SimulationError("%s has fewer countries than seats" % game_map)
+
+    matches = list()
+    for i in range(count):
+        seated = [players[(i * seats + j) % len(players)] for j in range(seats)]
+        match = Match.objects.create_match("%s match %d" % (prefix, i + 1), seated[0], game_map)
+        for player in seated:
+            MatchPlayer.objects.create_player(match, player)
+        for match_player in match.players.all():
+            match_player.make_ready()
+        matches.append(Match.objects.get(pk=match.pk))
+    return matches
+
+
+def random_commands(rng, graph, token_types, tokens, power_points):
+    """
+    Up to COMMANDS_PER_TURN commands for a player with power_points and tokens, a list of the (region id, token type
+    id) of the tokens that can move, as dicts for Command.objects.replace_commands. Every token moves at most once to a
+    region the movement rules let it reach and purchases do not spend more power points than the player has.
+    """
+    tokens = list(tokens)
+    rng.shuffle(tokens)
+    purchasable = sorted((token_type for token_type in token_types.values() if token_type.purchasable),
+                         key=lambda token_type: token_type.id)
+    commands = list()
+    while len(commands) < settings.COMMANDS_PER_TURN:
+        affordable = [token_type for token_type in purchasable if token_type.strength <= power_points]
+        if affordable and (not tokens or rng.random() < 0.3):
+            token_type = rng.choice(affordable)
+            power_points -= token_type.strength
+            commands.append({'type': 'buy', 'token_type': token_type.id})
+        elif tokens:
+            region_id, token_type_id = tokens.pop()
+            destinations = graph.destination_ids(token_types[token_type_id], region_id)
+            if destinations:
+                commands.append({'type': 'move', 'token_type': token_type_id, 'region_from': region_id,
+                                 'region_to': rng.choice(destinations)})
+        else:
+            break
+    return commands
+
+
+class OrmDriver(object):
+    """Plays through the models, as the views do without the requests around them."""
+    name = 'orm'
+
+    def set_commands(self, match_player, commands):
+        Command.objects.replace_commands(match_player.latest_player_in_turn_first_step(), commands)
+
+    def make_ready(self, match_player):
+        match_player.make_ready()
+
+
+class HttpDriver(object):
+    """Plays through the views with a logged in test client per player, sending commands as the match page does."""
+    name = 'http'
+
+    def __init__(self, password, host='testserver'):
+        self.password = password
+        self.host = host
+        self.clients = dict()
+
+    def client(self, match_player):
+        client = self.clients.get(match_player.player_id)
+        if client is None:
+            client = Client(SERVER_NAME=self.host)
+            if not client.login(username=match_player.player.user.username, password=self.password):
+                raise SimulationError("%s can not log in" % match_player.player.user.username)
+            self.clients[match_player.player_id] = client
+        return client
+
+    def set_commands(self, match_player, commands):
+        response = self.client(match_player).post(
+            reverse('game.views.set_commands', kwargs={'match_pk': match_player.match_id}),
+            json.dumps({'commands': commands}), content_type='application/json')
+        if response.status_code != 200:
+            raise SimulationError("Sending commands of %s: HTTP %d %s" % (
+                match_player, response.status_code, response.content.decode(errors='replace')))
+
+    def make_ready(self, match_player):
+        response = self.client(match_player).get(reverse('game.views.ready',
+                                                         kwargs={'match_pk': match_player.match_id}))
+        if response.status_code != 302:
+            raise SimulationError("Making %s ready: HTTP %d" % (match_player, response.status_code))
+
+
+class SimulationReport(object):
+    def __init__(self):
+        self.turns = 0
+        self.turn_queries = list()
+        self.turn_seconds = list()
+        # Seconds of every call by operation: commands, ready and resolve
+        self.latencies = defaultdict(list)
+
+    def seconds(self):
+        return sum(self.turn_seconds)
+
+    def turns_per_second(self):
+        return self.turns / self.seconds() if self.turn_seconds else 0
+
+    def queries_per_turn(self):
+        return sum(self.turn_queries) / len(self.turn_queries) if self.turn_queries else 0
+
+
+class Simulation(object):
+    """
+    Plays matches with random commands through driver, one turn of every unfinished match after another, until they
+    finish or have played max_turns turns. Everything the players do counts towards the report, looking up their
+    boards to choose the commands does not.
+    """
+
+    def __init__(self, matches, driver, seed=None):
+        self.match_pks = [match.pk for match in matches]
+        self.driver = driver
+        self.rng = random.Random(seed)
+        self.token_types = storage.load_token_types()
+
+    def run(self, max_turns):
+        report = SimulationReport()
+        for _ in range(max_turns):
+            matches = list(Match.objects.filter(pk__in=self.match_pks, status=Match.STATUS_PLAYING)
+                           .select_related('map').order_by('pk'))
+            if not matches:
+                break
+            for match in matches:
+                self.play_turn(match, report)
+        return report
+
+    def play_turn(self, match, report):
+        graph = match.map.graph()
+        turn_number = match.get_latest_turn().number
+        plans = list()
+        for match_player in match.players.filter(defeated=False, left_match=False).select_related('player__user'):
+            player_in_turn = match_player.latest_player_in_turn_first_step()
+            tokens = BoardToken.objects.filter(owner=player_in_turn, can_move_this_turn=True) \
+                .order_by('pk').values_list('position_id', 'type_id')
+            plans.append((match_player, random_commands(self.rng, graph, self.token_types, list(tokens),
+                                                        player_in_turn.power_points)))
+
+        queries = 0
+        seconds = 0
+        calls = [('commands', lambda match_player=match_player, commands=commands:
+                  self.driver.set_commands(match_player, commands)) for match_player, commands in plans]
+        calls += [('ready', lambda match_player=match_player: self.driver.make_ready(match_player))
+                  for match_player, commands in plans]
+        if settings.RESOLVE_TURNS_IN_BACKGROUND:
+            calls.append(('resolve', lambda: self.resolve_queued(match)))
+        for operation, call in calls:
+            with CaptureQueriesContext(connection) as context:
+                call_start = time.perf_counter()
+                call()
+                elapsed = time.perf_counter() - call_start
+            report.latencies[operation].append(elapsed)
+            queries += len(context)
+            seconds += elapsed
+
+        if match.get_latest_turn().number == turn_number and Match.objects.get(pk=match.pk).is_in_progress():
+            raise SimulationError("Turn %d of %s was not resolved" % (turn_number, match))
+        report.turns += 1
+        report.turn_queries.append(queries)
+        report.turn_seconds.append(seconds)
+
+    def resolve_queued(self, match):
+        """Resolve the queued turn of match here, as a resolve_turns worker would."""
+        for job in TurnResolutionJob.objects.filter(turn__match=match, status=TurnResolutionJob.STATUS_QUEUED) \
+                .select_related('turn__match'):
+            resolve_turns.resolve(job)
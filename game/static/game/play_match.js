@@ -1,7 +1,16 @@
 var map_click_callback = null;
 
 $(function () {
+    $("canvas.board").each(function () {
+        draw_board(this);
+    });
+
+    $("#match_events").each(function () {
+        listen_to_match_events(this);
+    });
+
     $("#map_image").click(function (e) {
+        if (map_click_callback == null) return;
 
         var offset = $(this).offset();
         var X = (e.pageX - offset.left);
@@ -13,13 +22,76 @@ $(function () {
                 X <= region.position[0] + region.size[0] &&
                 Y >= region.position[1] &&
                 Y <= region.position[1] + region.size[1]) {
-                if (map_click_callback != null) map_click_callback(region);
+                map_click_callback(region);
                 break;
             }
         }
     });
 });
 
+function draw_board(canvas) {
+    $.getJSON($(canvas).data("board"), function (board) {
+        var map_image = new Image();
+        var atlas = new Image();
+        var loaded = 0;
+
+        var draw = function () {
+            if (++loaded < 2) return;
+
+            canvas.width = map_image.width;
+            canvas.height = map_image.height;
+            var context = canvas.getContext("2d");
+            context.drawImage(map_image, 0, 0);
+
+            var regions_by_id = {};
+            for (var i = 0; i < board.regions.length; i++) {
+                regions_by_id[board.regions[i].id] = board.regions[i];
+            }
+            var countries = {};
+            for (i = 0; i < board.players.length; i++) {
+                countries[board.players[i].id] = board.players[i].country || 0;
+            }
+
+            // Tokens are laid out in rows of four under the region name, as in Map.image_in_match
+            var width = board.atlas.sprite_size[0];
+            var height = board.atlas.sprite_size[1];
+            var tokens_per_region = {};
+            for (i = 0; i < board.tokens.length; i++) {
+                var region = regions_by_id[board.tokens[i][0]];
+                var country = countries[board.tokens[i][1]];
+                var token_type = board.tokens[i][2];
+                var count = tokens_per_region[region.id] || 0;
+                context.drawImage(atlas,
+                    board.atlas.columns[token_type] * width, board.atlas.rows[country] * height, width, height,
+                    region.position[0] + 5 + (count % 4) * 20, region.position[1] + 20 + Math.floor(count / 4) * 20,
+                    width, height);
+                tokens_per_region[region.id] = count + 1;
+            }
+        };
+
+        map_image.onload = draw;
+        atlas.onload = draw;
+        map_image.src = board.map.image;
+        atlas.src = board.atlas.image;
+    });
+}
+
+function listen_to_match_events(list) {
+    if (!window.EventSource) return;
+
+    var source = new EventSource($(list).data("events"));
+    var show = function (e) {
+        $("<li>").text(JSON.parse(e.data).text).prependTo(list);
+    };
+    source.addEventListener("ready", show);
+    source.addEventListener("notification", show);
+    // The page shows the latest turn, load it again when a new one starts
+    source.addEventListener("turn", function () {
+        source.close();
+        window.location.reload();
+    });
+}
+
 function enter_command_mode() {
     $('#command_type_chooser').slideUp();
     $('#command_cancel').slideDown();
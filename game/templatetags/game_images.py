@@ -0,0 +1,54 @@
+from django import template
+from django.core.urlresolvers import reverse
+from django.utils.safestring import mark_safe
+
+from game import rendering
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def token_image_url(token_type_pk, country_pk=None):
+    """URL of the sprite of a token type in the colour of a country, pre-rendered if render_static_assets was run."""
+    url = rendering.static_asset_url(rendering.token_asset_name(token_type_pk, country_pk))
+    if url is not None:
+        return url
+    url = reverse('game.views.view_token', args=(token_type_pk, ))
+    if country_pk:
+        url += "?country=%s" % country_pk
+    return url
+
+
+@register.simple_tag
+def map_image_url(map_pk, show_debug=False, show_links=False):
+    """URL of the base image of a map, pre-rendered if render_static_assets was run."""
+    url = rendering.static_asset_url(rendering.map_asset_name(map_pk, show_debug, show_links))
+    if url is not None:
+        return url
+    url = reverse('game.views.view_map', args=(map_pk, ))
+    parameters = [name for name, value in (('show_debug', show_debug), ('show_links', show_links)) if value]
+    if parameters:
+        url += "?" + "&".join("%s=1" % name for name in parameters)
+    return url
+
+
+@register.simple_tag
+def token_atlas_style(game_map):
+    """Style sheet for the token_css_class of game_map, all sprites come from a single image."""
+    atlas = rendering.token_atlas(game_map)
+    return mark_safe("<style>\n%s\n</style>" % atlas.css(token_atlas_url(game_map, atlas)))
+
+
+def token_atlas_url(game_map, atlas=None):
+    url = rendering.static_asset_url(rendering.token_atlas_asset_name(game_map.pk))
+    if url is None:
+        atlas = atlas or rendering.token_atlas(game_map)
+        url = "%s?v=%s" % (reverse('game.views.view_token_atlas', args=(game_map.pk, )), atlas.content_hash)
+    return url
+
+
+@register.simple_tag
+def token_css_class(token_type_pk, country_pk=None):
+    """Classes of an element showing a token sprite, the page must include token_atlas_style."""
+    return "token %s" % rendering.token_css_class(token_type_pk, country_pk)
@@ -1,14 +1,36 @@
-from unittest import skipIf
+from io import BytesIO, StringIO
+from datetime import timedelta
+import importlib
+import json
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock, skipIf
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
 from django.core.urlresolvers import reverse
 
+from game import rendering, simulator
+from game.engine import history, kernels, rules, storage
+from game.engine.compact import CompactBoard
+from game.engine.state import Token
+from game.management.commands import resolve_turns
+from game.map_graph import MapGraph
+from game.middleware import get_match_player, get_player
+from game.templatetags import game_images
 from game.models import Match, MatchPlayer, Turn, PlayerInTurnStep, BoardToken, Command, BoardTokenType, MapRegion, \
     Player, \
-    Invite, Battle
+    Invite, Battle, Map, MapCountry, TurnStep, TurnResolutionJob, TurnBeingResolved, MatchEvent, Notification, \
+    MatchLogEntry, TurnAlreadyResolved
 
 
 # TODO bug: movement from So9 to No7 & So7 to No7 fails
@@ -28,6 +50,27 @@ def create_not_player():
     return User.objects.create_user('noplayer@localhost', 'noplayer@localhost', 'apwd')
 
 
+def create_started_match(players, map_name="Alpha"):
+    match = Match.objects.create_match("testmatch", players[0], Map.objects.get(name=map_name))
+    for player in players:
+        MatchPlayer.objects.create_player(match, player)
+    match.transition_from_setup_to_playing()
+    return match
+
+
+def use_temporary_render_cache(test_case):
+    cache_dir = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, cache_dir)
+    cache_settings = override_settings(RENDER_CACHE_DIR=cache_dir)
+    cache_settings.enable()
+    test_case.addCleanup(cache_settings.disable)
+    # Rolled back changes to maps do not send signals, start and end with empty caches
+    for invalidate in (rendering.invalidate_base_maps, rendering.match_maps.invalidate):
+        invalidate()
+        test_case.addCleanup(invalidate)
+    return cache_dir
+
+
 def create_inactive_players():
     player_one = Player.objects.create_player('Inactive', 'inactive1@localhost', 'ipwd')
     player_one.user.is_active = False
@@ -358,6 +401,14 @@ class UnauthenticatedAccess(TestCase):
         response = self.client.get(reverse('game.views.add_command', kwargs={'match_pk': 1}), follow=True)
         self.assertContains(response, "Welcome to Repower")
 
+    def test_set_commands_no_login(self):
+        response = self.client.get(reverse('game.views.set_commands', kwargs={'match_pk': 1}), follow=True)
+        self.assertContains(response, "Welcome to Repower")
+
+    def test_match_events_no_login(self):
+        response = self.client.get(reverse('game.views.match_events', kwargs={'match_pk': 1}), follow=True)
+        self.assertContains(response, "Welcome to Repower")
+
     def test_delete_command_no_login(self):
         response = self.client.get(reverse('game.views.delete_command', kwargs={'match_pk': 1, 'order': 0}),
                                    follow=True)
@@ -367,6 +418,10 @@ class UnauthenticatedAccess(TestCase):
         response = self.client.get(reverse('game.views.view_map_in_match', kwargs={'match_pk': 1}), follow=True)
         self.assertContains(response, "Welcome to Repower")
 
+    def test_view_board_in_match_no_login(self):
+        response = self.client.get(reverse('game.views.view_board_in_match', kwargs={'match_pk': 1}), follow=True)
+        self.assertContains(response, "Welcome to Repower")
+
 
 class ViewCallsTests(TestCase):
     def test_view_map(self):
@@ -380,6 +435,1522 @@ class ViewCallsTests(TestCase):
             self.assertEqual(response.status_code, 200)
 
 
+class MapGraphTests(TestCase):
+    @staticmethod
+    def orm_path_exists(token_type, source, destination, links):
+        # Reference search using MapRegion.usable_links, as Map.check_map_path used to do
+        def check_path(source, movements_left, crossed_water):
+            if source == destination:
+                return True
+            if movements_left == 0:
+                return False
+            for link in links[source.pk]:
+                if link.crossing_water and (
+                        not token_type.can_be_on_water and crossed_water and token_type.one_water_cross_per_movement):
+                    continue
+                links_to = link.destination if link.source == source else link.source
+                if ((links_to.water and token_type.can_be_on_water) or (links_to.land and token_type.can_be_on_land)) \
+                        and check_path(links_to, movements_left - 1, crossed_water or link.crossing_water):
+                    return True
+            return False
+
+        if destination.countries_with_this_reserve.exists() and not token_type.special_attack_reserves:
+            return False
+        if source == destination and not token_type.special_missile:
+            return False
+        if source.countries_with_this_reserve.exists():
+            return destination.countries_with_this_headquarter.exists() and \
+                destination.countries_with_this_headquarter.first() == source.countries_with_this_reserve.first()
+        return check_path(source, token_type.movements, False)
+
+    def test_graph_matches_orm_links(self):
+        game_map = Map.objects.get(name="Alpha")
+        regions = list(game_map.regions.all())
+        links = dict((region.pk, list(region.usable_links().select_related('source', 'destination')))
+                     for region in regions)
+        graph = game_map.graph()
+        self.assertEqual(len(graph.region_ids), len(regions))
+
+        for token_type in BoardTokenType.objects.exclude(special_missile=True):
+            for source in regions:
+                for destination in regions:
+                    self.assertEqual(
+                        graph.path_exists(token_type, source.pk, destination.pk),
+                        self.orm_path_exists(token_type, source, destination, links),
+                        "%s from %s to %s" % (token_type, source.short_name, destination.short_name)
+                    )
+
+    def test_path_checks_without_queries(self):
+        graph = Map.objects.get(name="Alpha").graph()
+        fighter = BoardTokenType.objects.get(name="Fighter")
+        destroyer = BoardTokenType.objects.get(name="Destroyer")
+        region = dict((region.short_name, region.pk) for region in MapRegion.objects.filter(map_id=graph.map_id))
+
+        with self.assertNumQueries(0):
+            self.assertIs(graph, MapGraph.for_map(graph.map_id))
+            self.assertTrue(graph.path_exists(fighter, region['NRe'], region['NHQ']))
+            self.assertFalse(graph.path_exists(fighter, region['NRe'], region['SHQ']))
+            self.assertFalse(graph.path_exists(fighter, region['NHQ'], region['NRe']))
+            self.assertTrue(graph.path_exists(fighter, region['NHQ'], region['So7']))
+            self.assertFalse(graph.path_exists(destroyer, region['NHQ'], region['No5']))
+
+    def test_reachability_tables(self):
+        graph = Map.objects.get(name="Alpha").graph()
+        infantry = BoardTokenType.objects.get(name="Infantry")
+        regiment = BoardTokenType.objects.get(name="Regiment")
+        region = dict((region.short_name, region.pk) for region in MapRegion.objects.filter(map_id=graph.map_id))
+
+        with self.assertNumQueries(0):
+            table = graph.reachability(infantry.movements, infantry.can_be_on_land, infantry.can_be_on_water,
+                                       infantry.one_water_cross_per_movement)
+            self.assertIs(table, graph.reachability(regiment.movements, regiment.can_be_on_land,
+                                                    regiment.can_be_on_water, regiment.one_water_cross_per_movement))
+            self.assertEqual(len(table), len(graph.region_ids))
+            self.assertEqual(graph.destination_ids(infantry, region['SRe']), [region['SHQ']])
+            self.assertNotIn(region['So5'], graph.destination_ids(infantry, region['So5']))
+            for destination in graph.destination_ids(infantry, region['So5']):
+                self.assertTrue(graph.path_exists(infantry, region['So5'], destination))
+
+    def test_graph_invalidated_on_region_change(self):
+        self.addCleanup(MapGraph.invalidate)  # The rollback at the end of the test does not send signals
+        game_map = Map.objects.get(name="Alpha")
+        graph = game_map.graph()
+        region = game_map.regions.get(short_name="No5")
+        region.water = True
+        region.save()
+        self.assertIsNot(graph, game_map.graph())
+        self.assertTrue(game_map.graph().water >> game_map.graph().index[region.pk] & 1)
+
+
+class CloneTests(TestCase):
+    def add_tokens(self, player_in_turn, count):
+        infantry = BoardTokenType.objects.get(name="Infantry")
+        BoardToken.objects.bulk_create(
+            BoardToken(owner=player_in_turn, position=player_in_turn.match_player.country.reserve, type=infantry)
+            for _ in range(count))
+
+    def count_clone_queries(self, clone):
+        with CaptureQueriesContext(connection) as context:
+            clone()
+        return len(context)
+
+    def test_clone_to_new_step(self):
+        match = create_started_match(create_test_users()[:2])
+        turn = match.get_latest_turn()
+        step = turn.get_latest_step()
+        players_in_turn = list(step.players.all())
+        players_in_turn[0].ready = True
+        players_in_turn[0].save()
+        self.assertEqual(BoardToken.objects.filter(owner__turn_step=step).count(), 16)
+
+        small_board_queries = self.count_clone_queries(
+            lambda: step.clone_to_new_step(TurnStep.objects.create(turn=turn, step=2)))
+        self.add_tokens(players_in_turn[0], 50)
+        self.add_tokens(players_in_turn[1], 50)
+        big_board_queries = self.count_clone_queries(
+            lambda: step.clone_to_new_step(TurnStep.objects.create(turn=turn, step=3)))
+        self.assertEqual(small_board_queries, big_board_queries)
+
+        new_step = turn.get_latest_step()
+        self.assertEqual(new_step.step, 3)
+        for player_in_turn in players_in_turn:
+            clone = new_step.players.get(match_player=player_in_turn.match_player)
+            self.assertEqual(clone.ready, player_in_turn.ready)
+            self.assertEqual(clone.tokens.count(), player_in_turn.tokens.count())
+            self.assertEqual(sorted(clone.tokens.values_list('type', 'position')),
+                             sorted(player_in_turn.tokens.values_list('type', 'position')))
+
+    def test_clone_to_new_turn(self):
+        match = create_started_match(create_test_users()[:2])
+        turn = match.get_latest_turn()
+        step = turn.get_latest_step()
+        step.players.update(ready=True)
+        BoardToken.objects.filter(owner__turn_step=step).update(moved_this_turn=True, can_move_this_turn=False,
+                                                                retreat_from_draw=True)
+
+        small_board_queries = self.count_clone_queries(turn.create_next)
+        big_step = match.get_latest_turn().get_latest_step()
+        for player_in_turn in big_step.players.all():
+            self.add_tokens(player_in_turn, 50)
+        big_step.players.update(ready=True)
+        BoardToken.objects.filter(owner__turn_step=big_step).update(moved_this_turn=True, can_move_this_turn=False,
+                                                                    retreat_from_draw=True)
+        big_board_queries = self.count_clone_queries(match.get_latest_turn().create_next)
+        self.assertEqual(small_board_queries, big_board_queries)
+
+        new_step = Turn.objects.get(match=match, number=3).get_latest_step()
+        self.assertFalse(new_step.players.filter(ready=True).exists())
+        self.assertEqual(BoardToken.objects.filter(owner__turn_step=new_step).count(), 116)
+        self.assertFalse(BoardToken.objects.filter(owner__turn_step=new_step, moved_this_turn=True).exists())
+        self.assertFalse(BoardToken.objects.filter(owner__turn_step=new_step, can_move_this_turn=False).exists())
+        self.assertFalse(BoardToken.objects.filter(owner__turn_step=new_step, retreat_from_draw=True).exists())
+
+
+class BattleTests(TestCase):
+    def setUp(self):
+        self.match = create_started_match(create_test_users()[:2])
+        self.turn = self.match.get_latest_turn()
+        self.incoming_turn_step = self.turn.get_latest_step().create_next()
+        self.players_in_turn = list(self.incoming_turn_step.players.order_by('pk'))
+        self.region = dict((region.short_name, region) for region in self.match.map.regions.all())
+
+    def move_token(self, player_in_turn, type_name, destination, command_from=None):
+        token = player_in_turn.tokens.filter(type__name=type_name, position=player_in_turn.match_player.country.reserve)[0]
+        token.position = destination
+        token.moved_this_turn = True
+        token.save()
+        if command_from is not None:
+            Command.objects.create(
+                player_in_turn=PlayerInTurnStep.objects.get(turn_step__turn=self.turn, turn_step__step=1,
+                                                            match_player=player_in_turn.match_player),
+                order=Command.objects.filter(player_in_turn__match_player=player_in_turn.match_player).count(),
+                type=Command.TYPE_MOVEMENT, token_type=token.type, location=command_from,
+                move_destination=destination, valid=True)
+        return token
+
+    def test_single_winner_captures(self):
+        self.move_token(self.players_in_turn[0], "Infantry", self.region['So5'])
+        self.move_token(self.players_in_turn[1], "Small Tank", self.region['So5'])
+
+        Battle.objects.process_battles(self.incoming_turn_step)
+
+        self.assertEqual(self.turn.steps.count(), 3)
+        battle = Battle.objects.get()
+        self.assertEqual(battle.turn_step, self.incoming_turn_step)
+        self.assertEqual(battle.location, self.region['So5'])
+        self.assertEqual(battle.winner.match_player, self.players_in_turn[1].match_player)
+        self.assertEqual(battle.winning_tokens.count(), 1)
+        self.assertEqual(battle.captured_tokens.count(), 1)
+        captured = battle.captured_tokens.get()
+        self.assertEqual(captured.owner, battle.winner)
+        self.assertEqual(captured.position, battle.winner.match_player.country.reserve)
+        self.assertEqual(BoardToken.objects.filter(owner=battle.winner).count(), 9)
+
+    def test_draw_retreats(self):
+        self.move_token(self.players_in_turn[0], "Infantry", self.region['No5'], command_from=self.region['NHQ'])
+        self.move_token(self.players_in_turn[1], "Infantry", self.region['No5'], command_from=self.region['SHQ'])
+
+        Battle.objects.process_battles(self.incoming_turn_step)
+
+        self.assertEqual(self.turn.steps.count(), 3)
+        battle = Battle.objects.get()
+        self.assertIsNone(battle.winner)
+        self.assertEqual(battle.winning_tokens.count(), 2)
+        self.assertEqual(battle.captured_tokens.count(), 0)
+        self.assertEqual(Command.objects.filter(reverted_in_draw=True).count(), 2)
+        last_step = self.turn.get_latest_step()
+        for region in ('NHQ', 'SHQ'):
+            token = BoardToken.objects.get(owner__turn_step=last_step, position=self.region[region])
+            self.assertTrue(token.retreat_from_draw)
+
+    def test_queries_do_not_depend_on_uncontested_tokens(self):
+        def count_battle_queries():
+            Battle.objects.all().delete()
+            self.turn.steps.filter(step__gt=2).delete()
+            with CaptureQueriesContext(connection) as context:
+                Battle.objects.process_battles(self.incoming_turn_step)
+            return len(context)
+
+        self.move_token(self.players_in_turn[0], "Infantry", self.region['So5'])
+        self.move_token(self.players_in_turn[1], "Small Tank", self.region['So5'])
+        count_battle_queries()  # Warm up the map graph
+        few_tokens_queries = count_battle_queries()
+
+        infantry = BoardTokenType.objects.get(name="Infantry")
+        for player_in_turn in self.players_in_turn:
+            BoardToken.objects.bulk_create(
+                BoardToken(owner=player_in_turn, position=region, type=infantry)
+                for region in self.match.map.regions.filter(country=player_in_turn.match_player.country))
+        self.assertEqual(count_battle_queries(), few_tokens_queries)
+
+
+class EngineTests(TestCase):
+    def setUp(self):
+        self.match = create_started_match(create_test_users()[:2])
+        self.step = self.match.get_latest_turn().get_latest_step()
+        self.players_in_turn = list(self.step.players.order_by('pk'))
+        self.region = dict((region.short_name, region) for region in self.match.map.regions.all())
+
+    def add_command(self, player_in_turn, **kwargs):
+        return Command.objects.create(player_in_turn=player_in_turn, order=player_in_turn.commands.count(), **kwargs)
+
+    def test_resolve_turn_without_queries(self):
+        self.add_command(self.players_in_turn[0], type=Command.TYPE_MOVEMENT,
+                         token_type=BoardTokenType.objects.get(name="Fighter"),
+                         location=self.region['NRe'], move_destination=self.region['NHQ'])
+        turn = storage.load_turn(self.step)
+
+        with self.assertNumQueries(0):
+            rules.resolve_turn(turn)
+
+        self.assertEqual([step.number for step in turn.steps], [1, 2])
+        self.assertEqual(turn.new_steps(), turn.steps[1:])
+        self.assertTrue(turn.commands[0].valid)
+        fighter = [token for token in turn.latest_step().board.tokens if token.position == self.region['NHQ'].pk]
+        self.assertEqual(len(fighter), 1)
+        self.assertTrue(fighter[0].moved_this_turn)
+        self.assertTrue(fighter[0].can_move_this_turn)
+        self.assertEqual(len(turn.notifications), 2)
+
+    def test_purchase_and_lost_power_point(self):
+        self.step.players.update(power_points=4)
+        self.add_command(self.players_in_turn[0], type=Command.TYPE_PURCHASE,
+                         token_type=BoardTokenType.objects.get(name="Small Tank"))
+        self.add_command(self.players_in_turn[1], type=Command.TYPE_PURCHASE,
+                         token_type=BoardTokenType.objects.get(name="Fighter"))
+
+        self.match.process_turn()
+
+        self.assertEqual(list(Command.objects.order_by('pk').values_list('valid', flat=True)), [True, False])
+        last_step = Turn.objects.get(match=self.match, number=1).get_latest_step()
+        self.assertEqual(last_step.step, 2)
+        self.assertIn("Bob had no valid commands, loses one power point", TurnStep.objects.get(pk=self.step.pk).report)
+        alice, bob = last_step.players.order_by('pk')
+        self.assertEqual(alice.power_points, 1)
+        self.assertEqual(bob.power_points, 3)
+        self.assertEqual(alice.tokens.count(), 9)
+        self.assertEqual(BoardToken.objects.filter(owner__turn_step__turn__number=2).count(), 17)
+
+    def test_turn_resolved_twice(self):
+        # Both players got ready at once and read the same latest turn
+        outgoing_turn = self.match.get_latest_turn()
+        with mock.patch.object(Match, 'get_latest_turn', return_value=outgoing_turn):
+            self.match.all_players_ready()
+            self.assertRaises(TurnAlreadyResolved, self.match.process_turn)
+            self.match.all_players_ready()
+
+        self.assertEqual(list(Turn.objects.filter(match=self.match).order_by('number').values_list('number', flat=True)),
+                         [1, 2])
+        self.assertEqual(self.match.log.filter(type=MatchLogEntry.TYPE_TURN_RESOLVED).count(), 1)
+
+    def test_flag_capture_ends_match(self):
+        infantry = BoardToken.objects.filter(owner=self.players_in_turn[0], type__name="Infantry")[0]
+        infantry.position = self.region['SHQ']
+        infantry.save()
+
+        self.match.process_turn()
+
+        match = Match.objects.get(pk=self.match.pk)
+        self.assertEqual(match.status, Match.STATUS_FINISHED)
+        alice, bob = match.players.order_by('pk')
+        self.assertFalse(alice.defeated)
+        self.assertTrue(bob.defeated)
+        last_step = Turn.objects.get(match=match, number=1).get_latest_step()
+        self.assertIn("Alice captured Bob's flag.", last_step.report)
+        self.assertIn("Alice wins the match!", last_step.report)
+        self.assertTrue(last_step.players.get(match_player=bob).defeated)
+        self.assertEqual(BoardToken.objects.filter(owner__turn_step=last_step, owner__match_player=alice).count(), 16)
+        self.assertEqual(alice.player.unread_notifications().filter(text__startswith="Congratulations").count(), 1)
+        self.assertEqual(bob.player.unread_notifications().filter(text__startswith="You lost").count(), 1)
+        self.assertTrue(Turn.objects.filter(match=match, number=2).exists())
+
+    def test_leaving_ends_match(self):
+        alice, bob = self.match.players.order_by('pk')
+        bob.leave()
+
+        match = Match.objects.get(pk=self.match.pk)
+        self.assertEqual(match.status, Match.STATUS_FINISHED)
+        self.assertIn("Alice wins the match!", TurnStep.objects.get(pk=self.step.pk).report)
+        self.assertEqual(alice.player.unread_notifications().filter(text__startswith="Congratulations").count(), 1)
+        self.assertFalse(bob.player.unread_notifications().filter(text__startswith="You lost").exists())
+
+    def test_leaving_without_remaining_players_is_a_draw(self):
+        alice, bob = self.match.players.order_by('pk')
+        MatchPlayer.objects.filter(pk=alice.pk).update(defeated=True)
+        bob.leave()
+
+        self.assertEqual(Match.objects.get(pk=self.match.pk).status, Match.STATUS_FINISHED)
+        self.assertIn("The match ends in a draw!", TurnStep.objects.get(pk=self.step.pk).report)
+        self.assertEqual(alice.player.unread_notifications().filter(text__startswith="You lost").count(), 1)
+
+
+class CompactBoardTests(TestCase):
+    def setUp(self):
+        self.match = create_started_match(create_test_users()[:2])
+        self.turn = self.match.get_latest_turn()
+        self.step = self.turn.get_latest_step()
+        self.graph = self.match.map.graph()
+        infantry = BoardToken.objects.filter(owner__turn_step=self.step, type__name="Infantry")[0]
+        infantry.position = MapRegion.objects.get(map=self.match.map, short_name="NHQ")
+        infantry.moved_this_turn = True
+        infantry.can_move_this_turn = False
+        infantry.save()
+        self.step.players.filter(pk=infantry.owner_id).update(power_points=7, ready=True)
+
+    def token_rows(self, turn_step):
+        return sorted(BoardToken.objects.filter(owner__turn_step=turn_step).values_list(
+            'owner__match_player', 'position', 'type', 'moved_this_turn', 'can_move_this_turn', 'retreat_from_draw'))
+
+    def player_rows(self, turn_step):
+        return list(turn_step.players.order_by('pk').values_list(
+            'match_player', 'power_points', 'total_strength', 'defeated', 'timeout_requested', 'ready', 'left_match'))
+
+    def test_board_round_trip(self):
+        turn = storage.load_turn(self.step)
+        board = turn.latest_step().board
+        compact = CompactBoard.from_board(board, self.graph.region_ids,
+                                          BoardTokenType.objects.values_list('pk', flat=True))
+
+        self.assertEqual(compact.shape, (len(self.graph.region_ids), 2, BoardTokenType.objects.count()))
+        self.assertEqual(compact.token_count(), 16)
+        self.assertEqual(len(compact.flagged_cells), 1)
+
+        token_types = storage.load_token_types()
+        match_players = dict((match_player.id, match_player) for match_player in turn.match_players)
+        expanded = compact.to_board(match_players, token_types)
+
+        def tokens(board):
+            return sorted((token.owner, token.position, token.type.id, token.moved_this_turn, token.can_move_this_turn,
+                           token.retreat_from_draw) for token in board.tokens)
+
+        self.assertEqual(tokens(expanded), tokens(board))
+        self.assertEqual([(player.id, player.match_player, player.power_points, player.ready)
+                          for player in expanded.players],
+                         [(player.id, player.match_player, player.power_points, player.ready)
+                          for player in board.players])
+
+    def test_orm_round_trip(self):
+        with self.assertNumQueries(3):
+            compact = storage.load_compact_board(self.step, self.graph.region_ids)
+        self.assertEqual(compact.count(MapRegion.objects.get(map=self.match.map, short_name="NHQ").pk,
+                                       compact.player_ids[0], BoardTokenType.objects.get(name="Infantry").pk), 1)
+
+        new_step = TurnStep.objects.create(turn=self.turn, step=2)
+        with self.assertNumQueries(3):
+            storage.save_compact_board(new_step, compact)
+        self.assertEqual(self.token_rows(new_step), self.token_rows(self.step))
+        self.assertEqual(self.player_rows(new_step), self.player_rows(self.step))
+        self.assertEqual(list(compact.player_row_ids), list(new_step.players.order_by('pk').values_list('pk', flat=True)))
+
+
+class KernelTests(TestCase):
+    def test_kernels_match_token_loop(self):
+        match = create_started_match(create_test_users()[:2])
+        step = match.get_latest_turn().get_latest_step()
+        graph = match.map.graph()
+        turn = storage.load_turn(step)
+        board = turn.latest_step().board
+        regions = [graph.region_ids[2], graph.region_ids[5]]
+        for i, token in enumerate(board.tokens):
+            token.position = regions[i % 2]
+            token.moved_this_turn = i % 3 == 0
+        missile = BoardTokenType.objects.get(name="Mega-Missile")
+        board.tokens.append(Token(board.players[0].match_player.id, regions[0], storage.load_token_types()[missile.pk]))
+        compact, token_types = rules.battle_summary(graph, board)
+
+        for use_numpy in (True, False):
+            self.assertEqual(kernels.contested_regions(compact, use_numpy), [2, 5])
+            strengths = kernels.region_strengths(compact, token_types, use_numpy)
+            for region in regions:
+                for i, player in enumerate(board.players):
+                    self.assertEqual(strengths[graph.index[region]][i], sum(
+                        kernels.token_strength(token.type, token.moved_this_turn) for token in board.tokens
+                        if token.position == region and token.owner == player.match_player.id))
+
+    def test_bench_battles_command(self):
+        out = StringIO()
+        call_command('bench_battles', regions=20, repeat=1, stdout=out)
+        self.assertIn("Alpha: 33 regions", out.getvalue())
+        self.assertIn("Synthetic: 20 regions", out.getvalue())
+
+
+@override_settings(RESOLVE_TURNS_IN_BACKGROUND=True)
+class TurnResolutionJobTests(TestCase):
+    def setUp(self):
+        self.players = create_test_users()
+        self.match = create_started_match(self.players[:2])
+        self.match_players = list(self.match.players.order_by('pk'))
+
+    def make_all_ready(self):
+        for match_player in self.match_players:
+            match_player.make_ready()
+
+    def test_ready_queues_turn(self):
+        self.make_all_ready()
+
+        self.assertEqual(self.match.get_latest_turn().number, 1)
+        job = TurnResolutionJob.objects.get()
+        self.assertEqual(job.status, TurnResolutionJob.STATUS_QUEUED)
+        self.assertEqual(job.turn, self.match.get_latest_turn())
+        self.assertTrue(self.match.is_resolving_turn())
+        self.assertFalse(self.match_players[0].latest_player_in_turn_first_step().can_add_commands())
+        self.assertRaises(TurnBeingResolved, self.match_players[0].leave)
+        self.assertRaises(TurnBeingResolved, self.match_players[0].make_ready)
+
+        self.client.login(username='Alice', password='apwd')
+        response = self.client.get(self.match.get_absolute_url())
+        self.assertContains(response, "the turn is being resolved")
+        self.assertNotContains(response, "make ready")
+
+    def test_worker_resolves_queued_turns(self):
+        self.make_all_ready()
+        other_match = create_started_match(self.players[2:4])
+        for match_player in other_match.players.all():
+            match_player.make_ready()
+
+        cache_dir = use_temporary_render_cache(self)
+        out = StringIO()
+        call_command('resolve_turns', once=True, stdout=out)
+
+        self.assertEqual(out.getvalue().count("Resolved turn"), 2)
+        self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'steps'))),
+                         TurnStep.objects.filter(turn__number=1).count())
+        self.assertFalse(TurnResolutionJob.objects.pending().exists())
+        for match in (self.match, other_match):
+            self.assertEqual(match.get_latest_turn().number, 2)
+            self.assertFalse(match.is_resolving_turn())
+            self.assertEqual(TurnResolutionJob.objects.get(turn__match=match).status, TurnResolutionJob.STATUS_DONE)
+        self.assertTrue(self.match_players[0].latest_player_in_turn_first_step().can_add_commands())
+
+    def test_job_is_claimed_once(self):
+        self.make_all_ready()
+        jobs = TurnResolutionJob.objects.claim("first", count=5)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0].worker, "first")
+        self.assertEqual(jobs[0].status, TurnResolutionJob.STATUS_RUNNING)
+        self.assertEqual(TurnResolutionJob.objects.claim("second"), [])
+        self.assertTrue(self.match.is_resolving_turn())
+
+    def test_failed_job(self):
+        self.make_all_ready()
+        Command.objects.create(player_in_turn=self.match_players[0].latest_player_in_turn_first_step(), order=0,
+                               type='XXX')
+
+        err = StringIO()
+        call_command('resolve_turns', once=True, stdout=StringIO(), stderr=err)
+
+        job = TurnResolutionJob.objects.get()
+        self.assertEqual(job.status, TurnResolutionJob.STATUS_FAILED)
+        self.assertEqual(job.attempts, settings.TURN_RESOLUTION_ATTEMPTS)
+        self.assertIn("InvalidCommandType", job.error)
+        self.assertEqual(err.getvalue().count("it will be tried again"), settings.TURN_RESOLUTION_ATTEMPTS - 1)
+        self.assertIn("giving up after %d attempts" % settings.TURN_RESOLUTION_ATTEMPTS, err.getvalue())
+        self.assertEqual(self.match.get_latest_turn().number, 1)
+        self.assertEqual(self.match.get_latest_turn().steps.count(), 1)
+        self.assertFalse(self.match.is_resolving_turn())
+        self.assertTrue(self.match.turn_resolution_failed())
+
+        Command.objects.filter(type='XXX').delete()
+        self.client.login(username='Alice', password='apwd')
+        self.assertContains(self.client.get(self.match.get_absolute_url()), "the turn could not be resolved")
+        call_command('resolve_turns', once=True, retry_failed=True, stdout=StringIO())
+        self.assertEqual(TurnResolutionJob.objects.get().status, TurnResolutionJob.STATUS_DONE)
+        self.assertEqual(self.match.get_latest_turn().number, 2)
+        self.assertFalse(self.match.turn_resolution_failed())
+
+    def test_abandoned_job_is_claimed_again(self):
+        self.make_all_ready()
+        TurnResolutionJob.objects.claim("dead")
+        self.assertEqual(TurnResolutionJob.objects.claim("second"), [])
+
+        for attempt in range(2, settings.TURN_RESOLUTION_ATTEMPTS + 1):
+            TurnResolutionJob.objects.update(
+                started=timezone.now() - timedelta(seconds=settings.TURN_RESOLUTION_TIMEOUT + 1))
+            jobs = TurnResolutionJob.objects.claim("worker %d" % attempt)
+            self.assertEqual(len(jobs), 1)
+            self.assertEqual(jobs[0].worker, "worker %d" % attempt)
+            self.assertEqual(jobs[0].attempts, attempt)
+            self.assertIn("did not finish the job", jobs[0].error)
+
+        TurnResolutionJob.objects.update(
+            started=timezone.now() - timedelta(seconds=settings.TURN_RESOLUTION_TIMEOUT + 1))
+        self.assertEqual(TurnResolutionJob.objects.claim("last"), [])
+        self.assertEqual(TurnResolutionJob.objects.get().status, TurnResolutionJob.STATUS_FAILED)
+        self.assertFalse(self.match.is_resolving_turn())
+        self.assertTrue(self.match.turn_resolution_failed())
+
+    def test_recent_running_job_is_not_claimed_again(self):
+        self.make_all_ready()
+        TurnResolutionJob.objects.claim("first")
+        TurnResolutionJob.objects.update(
+            started=timezone.now() - timedelta(seconds=settings.TURN_RESOLUTION_TIMEOUT - 10))
+        self.assertEqual(TurnResolutionJob.objects.claim("second"), [])
+        self.assertEqual(TurnResolutionJob.objects.get().worker, "first")
+
+
+run_job = resolve_turns.run_job
+
+
+def crash_on_first_attempt(job_pk):
+    """run_job killing its pool process the first time it is given the turn of the match named crash."""
+    job = TurnResolutionJob.objects.select_related('turn__match').get(pk=job_pk)
+    if job.turn.match.name == "crash" and job.attempts == 1:
+        os._exit(1)
+    return run_job(job_pk)
+
+
+@skipIf(connection.vendor == 'sqlite' and not settings.DATABASES['default'].get('TEST', {}).get('NAME'),
+        "Pool processes can not open an in-memory test database, run with --settings=Repower.test_settings")
+@override_settings(RESOLVE_TURNS_IN_BACKGROUND=True)
+class TurnResolutionPoolTests(TransactionTestCase):
+    def setUp(self):
+        # Bring back the maps and token types the migrations insert after the database is flushed
+        if not Map.objects.exists():
+            migration = importlib.import_module('game.migrations.0002_maps_and_token_types')
+            migration.insert_maps(None, None)
+            migration.insert_token_types(None, None)
+        use_temporary_render_cache(self)
+        players = create_test_users()
+        self.matches = [create_started_match(players[i % 2 * 2:i % 2 * 2 + 2]) for i in range(6)]
+        for match in self.matches:
+            for match_player in match.players.all():
+                match_player.make_ready()
+
+    def assertResolvedOnce(self):
+        self.assertFalse(TurnResolutionJob.objects.exclude(status=TurnResolutionJob.STATUS_DONE).exists())
+        for match in self.matches:
+            self.assertEqual(list(Turn.objects.filter(match=match).order_by('number')
+                                  .values_list('number', flat=True)), [1, 2])
+            self.assertEqual(MatchLogEntry.objects.filter(match=match, type=MatchLogEntry.TYPE_TURN_RESOLVED).count(),
+                             1)
+
+    def test_pool_resolves_every_job_once(self):
+        out = StringIO()
+        call_command('resolve_turns', once=True, processes=3, poll_interval=0.1, stdout=out, stderr=StringIO())
+
+        self.assertIn("6 turns resolved, 0 failed", out.getvalue())
+        self.assertEqual(out.getvalue().count("Resolved turn"), 6)
+        self.assertEqual(list(TurnResolutionJob.objects.values_list('attempts', flat=True).distinct()), [1])
+        self.assertResolvedOnce()
+
+    def test_broken_pool_is_replaced(self):
+        Match.objects.filter(pk=self.matches[2].pk).update(name="crash")
+        err = StringIO()
+        with mock.patch.object(resolve_turns, 'run_job', crash_on_first_attempt):
+            call_command('resolve_turns', once=True, processes=2, poll_interval=0.1, stdout=StringIO(), stderr=err)
+
+        self.assertIn("A pool process died, starting new ones", err.getvalue())
+        self.assertIn("BrokenProcessPool", err.getvalue())
+        self.assertEqual(TurnResolutionJob.objects.get(turn__match=self.matches[2]).attempts, 2)
+        self.assertResolvedOnce()
+
+
+@skipIf(settings.SKIP_STRESS_TESTS, "Stress tests are disabled")
+@override_settings(RESOLVE_TURNS_IN_BACKGROUND=True)
+class TurnResolutionStressTests(TestCase):
+    def test_resolve_thousand_matches(self):
+        players = create_test_users()[:2]
+        matches = [create_started_match(players) for _ in range(1000)]
+        for match in matches:
+            for match_player in match.players.all():
+                match_player.make_ready()
+        self.assertEqual(TurnResolutionJob.objects.pending().count(), 1000)
+
+        # Pool processes can not see an in-memory test database
+        in_memory = connection.vendor == 'sqlite' and 'memory' in connection.settings_dict['NAME']
+        out = StringIO()
+        call_command('resolve_turns', once=True, processes=1 if in_memory else 4, stdout=out)
+
+        self.assertIn("1000 turns resolved, 0 failed", out.getvalue())
+        self.assertEqual(TurnResolutionJob.objects.filter(status=TurnResolutionJob.STATUS_DONE).count(), 1000)
+        self.assertEqual(Turn.objects.filter(number=2).count(), 1000)
+        self.assertFalse(Turn.objects.filter(number=3).exists())
+
+
+class BaseMapCacheTests(TestCase):
+    def setUp(self):
+        cache_dir = use_temporary_render_cache(self)
+        self.map = Map.objects.get(name="Alpha")
+        self.cache_files = lambda: os.listdir(os.path.join(cache_dir, 'maps'))
+
+    def test_cached_image_is_the_rendered_one(self):
+        for show_debug, show_links in ((False, False), (True, False), (True, True)):
+            self.assertEqual(self.map.image(show_debug, show_links).tobytes(),
+                             self.map.render_image(show_debug, show_links).tobytes())
+        self.assertEqual(len(self.cache_files()), 3)
+
+    def test_memory_cache(self):
+        image = self.map.image(False, False)
+        expected = image.tobytes()
+        image.paste((255, 0, 0), (0, 0, 100, 100))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.map.image(False, False).tobytes(), expected)
+
+    def test_disk_cache(self):
+        expected = self.map.image(False, True).tobytes()
+        rendering.invalidate_base_maps()
+
+        def render_image(show_debug, show_links):
+            raise AssertionError("The base map should have been read from disk")
+
+        self.map.render_image = render_image
+        self.assertEqual(self.map.image(False, True).tobytes(), expected)
+
+    def test_invalidated_when_regions_change(self):
+        old_image = self.map.image(False, False).tobytes()
+        region = self.map.regions.filter(render_on_map=True).first()
+        region.name = "Renamed"
+        region.save()
+        self.addCleanup(MapGraph.invalidate)
+
+        new_image = self.map.image(False, False).tobytes()
+        self.assertNotEqual(new_image, old_image)
+        self.assertEqual(new_image, self.map.render_image(False, False).tobytes())
+        self.assertEqual(len(self.cache_files()), 2)
+
+
+class SpriteCacheTests(TestCase):
+    def test_tinted_sprites_match_pixel_recoloring(self):
+        from PIL import Image
+
+        for token_type in BoardTokenType.objects.all():
+            for country in [None] + list(MapCountry.objects.all()):
+                expected = Image.open('game/static/game/%s.gif' % token_type.image_file_name)
+                pixel_data = expected.load()
+                if country is not None:
+                    for y in range(expected.size[1]):
+                        for x in range(expected.size[0]):
+                            if pixel_data[x, y] == 14:
+                                pixel_data[x, y] = country.color_gif_palette
+                sprite = token_type.image(country)
+                self.assertEqual(sprite.tobytes(), expected.tobytes())
+                self.assertEqual(sprite.getpalette(), expected.getpalette())
+                self.assertEqual(sprite.info.get('transparency'), expected.info.get('transparency'))
+
+    def test_sprites_are_built_once(self):
+        rendering.build_all_sprites()
+        token_type = BoardTokenType.objects.get(name="Tank")
+        country = MapCountry.objects.first()
+        self.assertIs(rendering.token_sprite(token_type.image_file_name, country.color_gif_palette),
+                      rendering.token_sprite(token_type.image_file_name, country.color_gif_palette))
+        self.assertIsNot(token_type.image(country), token_type.image(country))
+
+    def test_map_in_match_queries_do_not_depend_on_tokens(self):
+        match = create_started_match(create_test_users()[:2])
+        turn_step = match.get_latest_turn().get_latest_step()
+        BoardToken.objects.filter(owner__turn_step=turn_step).update(
+            position=MapRegion.objects.filter(map=match.map, render_on_map=True).first())
+        match.map.image_in_match(turn_step)
+
+        with CaptureQueriesContext(connection) as context:
+            match.map.image_in_match(turn_step)
+        self.assertEqual(len(context), 1)
+
+
+class MatchMapCacheTests(TestCase):
+    def setUp(self):
+        cache_dir = use_temporary_render_cache(self)
+        self.cache_files = lambda: os.listdir(os.path.join(cache_dir, 'steps')) \
+            if os.path.exists(os.path.join(cache_dir, 'steps')) else []
+        self.match = create_started_match(create_test_users()[:2])
+
+    def get_map(self, turn_number, step_number):
+        response = self.client.get("%s?turn=%d&step=%d" % (
+            reverse('game.views.view_map_in_match', kwargs={'match_pk': self.match.pk}), turn_number, step_number))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "image/png")
+        return response.content
+
+    def test_latest_step_is_drawn_on_demand(self):
+        self.client.login(username='Alice', password='apwd')
+        turn_step = self.match.get_latest_turn().get_latest_step()
+        self.assertFalse(turn_step.is_final())
+
+        first_map = self.get_map(1, 1)
+        self.assertEqual(first_map, rendering.encode_png(self.match.map.image_in_match(turn_step)))
+        BoardToken.objects.filter(owner__turn_step=turn_step, type__name="Infantry").update(
+            position=MapRegion.objects.filter(map=self.match.map, render_on_map=True).first())
+        self.assertNotEqual(self.get_map(1, 1), first_map)
+        self.assertEqual(self.cache_files(), [])
+
+    def test_resolved_steps_are_cached(self):
+        self.client.login(username='Alice', password='apwd')
+        turn_step = self.match.get_latest_turn().get_latest_step()
+        expected = rendering.encode_png(self.match.map.image_in_match(turn_step))
+        for match_player in self.match.players.all():
+            match_player.make_ready()
+
+        self.assertTrue(TurnStep.objects.get(pk=turn_step.pk).is_final())
+        self.assertEqual(self.cache_files(), [])
+        self.assertEqual(self.get_map(1, 1), expected)
+        self.assertEqual([name.rsplit('-', 1)[0] for name in self.cache_files()],
+                         ["%d-%d" % (turn_step.pk, rendering.MATCH_MAP_RENDER_VERSION)])
+
+        def image_in_match(turn_step):
+            raise AssertionError("Final steps should not be drawn again")
+
+        self.addCleanup(setattr, Map, 'image_in_match', Map.image_in_match)
+        Map.image_in_match = image_in_match
+        self.assertEqual(self.get_map(1, 1), expected)
+        rendering.match_maps.invalidate()
+        self.assertEqual(self.get_map(1, 1), expected)
+
+
+class ImageHttpCachingTests(TestCase):
+    def setUp(self):
+        use_temporary_render_cache(self)
+
+    def assertNotModified(self, url, response):
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertEqual(not_modified['Cache-Control'], response['Cache-Control'])
+
+    def test_token(self):
+        token_type = BoardTokenType.objects.get(name="Tank")
+        url = "%s?country=%d" % (reverse('game.views.view_token', kwargs={'token_type_pk': token_type.pk}),
+                                 MapCountry.objects.first().pk)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertNotModified(url, response)
+        self.assertNotEqual(self.client.get(reverse('game.views.view_token', kwargs={
+            'token_type_pk': token_type.pk}))['ETag'], response['ETag'])
+
+    def test_map(self):
+        game_map = Map.objects.get(name="Alpha")
+        url = reverse('game.views.view_map', kwargs={'map_pk': game_map.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertNotModified(url, response)
+
+        region = game_map.regions.filter(render_on_map=True).first()
+        region.name = "Renamed"
+        region.save()
+        self.addCleanup(MapGraph.invalidate)
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+    def test_map_in_match(self):
+        match = create_started_match(create_test_users()[:2])
+        self.client.login(username='Alice', password='apwd')
+        url = "%s?turn=1&step=1" % reverse('game.views.view_map_in_match', kwargs={'match_pk': match.pk})
+        latest = self.client.get(url)
+        self.assertEqual(latest.status_code, 200)
+        self.assertIn('private', latest['Cache-Control'])
+        self.assertIn('no-cache', latest['Cache-Control'])
+
+        def image_in_match(turn_step):
+            raise AssertionError("Not modified images should not be drawn")
+
+        original_image_in_match = Map.image_in_match
+        Map.image_in_match = image_in_match
+        try:
+            self.assertNotModified(url, latest)
+        finally:
+            Map.image_in_match = original_image_in_match
+
+        for match_player in match.players.all():
+            match_player.make_ready()
+        final = self.client.get(url, HTTP_IF_NONE_MATCH=latest['ETag'])
+        self.assertEqual(final.status_code, 200)
+        self.assertEqual(final.content, latest.content)
+        self.assertEqual(final['Cache-Control'], "private, max-age=31536000, immutable")
+        with mock.patch.object(rendering, 'match_map_content_hash',
+                               side_effect=AssertionError("Final steps are not hashed")):
+            self.assertNotModified(url, final)
+
+
+class StaticAssetTests(TestCase):
+    def setUp(self):
+        use_temporary_render_cache(self)
+        self.assets_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.assets_dir)
+        assets_settings = override_settings(RENDERED_ASSETS_DIR=self.assets_dir, RENDERED_ASSETS_URL='/rendered/')
+        assets_settings.enable()
+        self.addCleanup(assets_settings.disable)
+
+    def render_static_assets(self):
+        output = StringIO()
+        call_command('render_static_assets', stdout=output, stderr=StringIO())
+        return output.getvalue()
+
+    def test_render_static_assets(self):
+        self.assertIn("new files", self.render_static_assets())
+        with open(os.path.join(self.assets_dir, rendering.STATIC_ASSET_MANIFEST)) as manifest:
+            files = json.load(manifest)
+
+        token_type = BoardTokenType.objects.get(name="Tank")
+        country = MapCountry.objects.first()
+        token_file = files[rendering.token_asset_name(token_type.pk, country.pk)]
+        with open(os.path.join(self.assets_dir, token_file), 'rb') as png:
+            self.assertEqual(png.read(), rendering.token_sprite_png(token_type.image_file_name,
+                                                                    country.color_gif_palette)[1])
+        self.assertNotEqual(token_file, files[rendering.token_asset_name(token_type.pk)])
+
+        game_map = Map.objects.get(name="Alpha")
+        for show_debug in (False, True):
+            for show_links in (False, True):
+                map_file = files[rendering.map_asset_name(game_map.pk, show_debug, show_links)]
+                self.assertTrue(os.path.exists(os.path.join(self.assets_dir, map_file)))
+
+        # Files are only drawn again when their content changes
+        self.assertIn(" 0 new files", self.render_static_assets())
+
+    def test_template_helpers(self):
+        token_type = BoardTokenType.objects.get(name="Tank")
+        country = MapCountry.objects.first()
+        game_map = Map.objects.get(name="Alpha")
+        self.assertEqual(game_images.token_image_url(token_type.pk, country.pk), "%s?country=%d" % (
+            reverse('game.views.view_token', kwargs={'token_type_pk': token_type.pk}), country.pk))
+        self.assertEqual(game_images.map_image_url(game_map.pk, show_links=True), "%s?show_links=1" % reverse(
+            'game.views.view_map', kwargs={'map_pk': game_map.pk}))
+
+        self.render_static_assets()
+        self.assertTrue(game_images.token_image_url(token_type.pk, country.pk).startswith("/rendered/tokens/"))
+        self.assertTrue(game_images.map_image_url(game_map.pk, show_links=True).startswith("/rendered/maps/"))
+
+        match = create_started_match(create_test_users()[:2])
+        self.client.login(username='Alice', password='apwd')
+        response = self.client.get(reverse('game.views.view_match', kwargs={'match_pk': match.pk}))
+        self.assertContains(response, "/rendered/atlases/%d-" % match.map.pk)
+        self.assertNotContains(response, reverse('game.views.view_token_atlas', kwargs={'map_pk': match.map.pk}))
+
+
+class TokenAtlasTests(TestCase):
+    def test_atlas(self):
+        from PIL import Image
+
+        game_map = Map.objects.get(name="Alpha")
+        atlas = rendering.token_atlas(game_map)
+        self.assertIs(rendering.token_atlas(game_map), atlas)
+        image = Image.open(BytesIO(atlas.png)).convert("RGBA")
+
+        width, height = atlas.sprite_size
+        for country in [None] + list(game_map.countries.all()):
+            for token_type in BoardTokenType.objects.all():
+                x, y = atlas.position(token_type.pk, country and country.pk)
+                sprite = token_type.image(country).convert("RGBA")
+                self.assertEqual(list(image.crop((x, y, x + width, y + height)).getdata()), list(sprite.getdata()))
+
+    def test_match_page(self):
+        match = create_started_match(create_test_users()[:2])
+        atlas = rendering.token_atlas(match.map)
+        self.client.login(username='Alice', password='apwd')
+        response = self.client.get(reverse('game.views.view_match', kwargs={'match_pk': match.pk}))
+        self.assertNotContains(response, "<img src=\"%s" % reverse('game.views.view_token', kwargs={
+            'token_type_pk': BoardTokenType.objects.first().pk}))
+        country = match.players.get(player__user__username='Alice').country
+        self.assertContains(response, "token token-%d-%d" % (BoardTokenType.objects.first().pk, country.pk))
+
+        url = "%s?v=%s" % (reverse('game.views.view_token_atlas', kwargs={'map_pk': match.map.pk}),
+                           atlas.content_hash)
+        self.assertContains(response, url)
+        image = self.client.get(url)
+        self.assertEqual(image.content, atlas.png)
+        self.assertIn('immutable', image['Cache-Control'])
+        self.assertIn('no-cache', self.client.get(url.split('?')[0])['Cache-Control'])
+
+
+class BoardJsonTests(TestCase):
+    def test_board_in_match(self):
+        match = create_started_match(create_test_users()[:2])
+        self.client.login(username='Alice', password='apwd')
+        turn_step = TurnStep.objects.get(turn__match=match, turn__number=1, step=1)
+        response = self.client.get(turn_step.get_board_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/json")
+        self.assertIn('no-cache', response['Cache-Control'])
+        board = json.loads(response.content.decode())
+
+        self.assertEqual(board['map']['image'], game_images.map_image_url(match.map_id))
+        self.assertEqual(board['atlas']['image'], game_images.token_atlas_url(match.map))
+        self.assertEqual(sorted(player['id'] for player in board['players']),
+                         sorted(match.players.values_list('pk', flat=True)))
+        self.assertEqual(len(board['regions']), match.map.regions.filter(render_on_map=True).count())
+        tokens = BoardToken.objects.filter(owner__turn_step=turn_step, position__render_on_map=True).order_by('pk')
+        self.assertEqual(board['tokens'], [[token.position_id, token.owner.match_player_id, token.type_id]
+                                           for token in tokens])
+        self.assertLess(len(response.content), len(self.client.get(turn_step.get_absolute_url()).content))
+
+        not_modified = self.client.get(turn_step.get_board_url(), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+        for match_player in match.players.all():
+            match_player.make_ready()
+        final = self.client.get(turn_step.get_board_url())
+        self.assertEqual(final['Cache-Control'], "private, max-age=31536000, immutable")
+
+    def test_match_page(self):
+        match = create_started_match(create_test_users()[:2])
+        self.client.login(username='Alice', password='apwd')
+        response = self.client.get(reverse('game.views.view_match', kwargs={'match_pk': match.pk}))
+        turn_step = TurnStep.objects.get(turn__match=match, turn__number=1, step=1)
+        self.assertContains(response, 'data-board="%s"' % turn_step.get_board_url().replace('&', '&amp;'))
+
+
+class ViewMatchQueryTests(TestCase):
+    def setUp(self):
+        self.players = create_test_users()
+        self.match = create_started_match(self.players[:2])
+        self.client.login(username='Alice', password='apwd')
+
+    def view_match_queries(self, turn_number):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("%s?turn=%d" % (self.match.get_absolute_url(), turn_number))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def grow_turn(self, turn):
+        """Add a player, a step with a battle, tokens in every reserve and commands to turn."""
+        match_player = MatchPlayer.objects.create_player(self.match, self.players[self.match.players.count()])
+        match_player.country = self.match.map.countries.first()
+        match_player.save()
+        token_type = BoardTokenType.objects.get(name="Infantry")
+
+        latest_step = turn.steps.order_by('-step').first()
+        new_step = TurnStep.objects.create(turn=turn, step=latest_step.step + 1)
+        latest_step.clone_board_to(new_step)
+        for turn_step in turn.steps.all():
+            PlayerInTurnStep.objects.get_or_create(turn_step=turn_step, match_player=match_player,
+                                                   defaults={'power_points': 0})
+            for player_in_turn in turn_step.players.select_related('match_player__country'):
+                for _ in range(3):
+                    BoardToken.objects.create(owner=player_in_turn, type=token_type,
+                                              position=player_in_turn.match_player.country.reserve)
+                if turn_step.step == 1:
+                    Command.objects.create(player_in_turn=player_in_turn, type=Command.TYPE_PURCHASE,
+                                           order=player_in_turn.commands.count(), token_type=token_type)
+
+        winner = new_step.players.order_by('pk').first()
+        battle = Battle.objects.create(turn_step=new_step, winner=winner,
+                                       location=self.match.map.regions.filter(render_on_map=True).first())
+        battle.captured_tokens.add(*winner.tokens.all()[:2])
+
+    def test_latest_turn(self):
+        turn = self.match.get_latest_turn()
+        self.grow_turn(turn)
+        queries = self.view_match_queries(1)
+        self.grow_turn(turn)
+        self.grow_turn(turn)
+        self.assertEqual(self.view_match_queries(1), queries)
+
+    def test_previous_turn(self):
+        turn = self.match.get_latest_turn()
+        self.grow_turn(turn)
+        turn.create_next()
+        queries = self.view_match_queries(1)
+        self.grow_turn(turn)
+        self.grow_turn(turn)
+        self.assertEqual(self.view_match_queries(1), queries)
+        self.assertLessEqual(queries, 25)
+
+
+def board_signature(board):
+    return ([(player.match_player.id, player.power_points, player.total_strength, player.defeated,
+              player.timeout_requested, player.ready, player.left_match) for player in board.players],
+            [(token.owner, token.position, token.type.id, token.moved_this_turn, token.can_move_this_turn,
+              token.retreat_from_draw) for token in board.tokens])
+
+
+@override_settings(MATCH_SNAPSHOT_INTERVAL=2)
+class MatchHistoryTests(TestCase):
+    def setUp(self):
+        self.match = create_started_match(create_test_users()[:2])
+        self.region = dict((region.short_name, region) for region in self.match.map.regions.all())
+        self.token_type = dict((token_type.name, token_type) for token_type in BoardTokenType.objects.all())
+        self.addCleanup(history.materialized_boards.invalidate)
+
+    def play_turn(self, commands):
+        match_players = list(self.match.players.order_by('pk'))
+        for player, type, token_type, location, destination in commands:
+            player_in_turn = match_players[player].latest_player_in_turn_first_step()
+            Command.objects.create(player_in_turn=player_in_turn, order=player_in_turn.commands.count(), type=type,
+                                   token_type=self.token_type[token_type], location=self.region.get(location),
+                                   move_destination=self.region.get(destination))
+        self.match.process_turn()
+
+    def play(self):
+        self.play_turn([(0, Command.TYPE_MOVEMENT, "Infantry", 'NHQ', 'No5'),
+                        (0, Command.TYPE_MOVEMENT, "Fighter", 'NRe', 'NHQ'),
+                        (1, Command.TYPE_MOVEMENT, "Infantry", 'SHQ', 'No5')])
+        self.play_turn([(0, Command.TYPE_PURCHASE, "Small Tank", None, None),
+                        (1, Command.TYPE_MOVEMENT, "Infantry", 'No5', 'No4')])
+        self.play_turn([(1, Command.TYPE_PURCHASE, "Small Tank", None, None),
+                        (0, Command.TYPE_MOVEMENT, "Fighter", 'NHQ', 'So7')])
+        self.play_turn([])
+
+    def stored_steps(self):
+        token_types = storage.load_token_types()
+        match_players = storage.load_match_players(self.match)
+        return dict(((turn_step.turn.number, turn_step.step),
+                     board_signature(storage.load_board(turn_step, match_players, token_types)))
+                    for turn_step in TurnStep.objects.filter(turn__match=self.match).select_related('turn'))
+
+    def test_log_and_snapshots(self):
+        self.play()
+        self.assertEqual(list(self.match.snapshots.order_by('turn_number').values_list('turn_number', flat=True)),
+                         [1, 3, 5])
+        self.assertEqual(list(self.match.log.order_by('pk').values_list('turn_number', 'type')), [
+            (1, MatchLogEntry.TYPE_TURN_RESOLVED),
+            (2, MatchLogEntry.TYPE_TURN_RESOLVED),
+            (3, MatchLogEntry.TYPE_TURN_RESOLVED),
+            (4, MatchLogEntry.TYPE_TURN_RESOLVED),
+        ])
+
+    def test_replay_gives_stored_steps(self):
+        self.play()
+        stored = self.stored_steps()
+        for number in range(1, 5):
+            steps = history.replay_turn(self.match, number)
+            self.assertEqual(len(steps), len([key for key in stored if key[0] == number]))
+            for step in steps:
+                self.assertEqual(board_signature(step.board), stored[(number, step.number)])
+        self.assertRaises(history.HistoryNotInLog, history.replay_turn, self.match, 5)
+
+    def test_player_left(self):
+        self.play_turn([(1, Command.TYPE_MOVEMENT, "Infantry", 'SHQ', 'No5')])
+        bob = self.match.players.order_by('pk')[1]
+        bob.leave()
+        self.assertEqual(list(self.match.log.filter(type=MatchLogEntry.TYPE_PLAYER_LEFT)
+                              .values_list('turn_number', 'match_player')), [(2, bob.pk)])
+
+        board = history.next_turn_board(history.replay_turn(self.match, 1)[-1].board)
+        history.leave(board, bob.pk)
+        self.assertEqual(board_signature(board), self.stored_steps()[(2, 1)])
+
+    def test_pruned_steps(self):
+        self.play()
+        tokens = dict((turn_step.pk, history.step_tokens(turn_step))
+                      for turn_step in TurnStep.objects.filter(turn__match=self.match))
+        boards = dict((turn_step.pk, rendering.match_board(turn_step))
+                      for turn_step in TurnStep.objects.filter(turn__match=self.match))
+        first_step = TurnStep.objects.get(turn__match=self.match, turn__number=1, step=1)
+        image = rendering.encode_png(self.match.map.image_in_match(first_step))
+
+        with override_settings(KEEP_BOARD_ROWS_FOR_TURNS=2):
+            self.play_turn([])
+        self.assertEqual(set(TurnStep.objects.filter(pruned=True).values_list('turn__number', flat=True)),
+                         {1, 2, 3, 4})
+        self.assertEqual(PlayerInTurnStep.objects.filter(turn_step__pruned=True).count(),
+                         2 * TurnStep.objects.filter(pruned=True).count())
+        self.assertFalse(BoardToken.objects.filter(owner__turn_step__pruned=True).exists())
+        for turn_step in TurnStep.objects.filter(turn__match=self.match, pk__in=tokens):
+            self.assertEqual(history.step_tokens(turn_step), tokens[turn_step.pk])
+            self.assertEqual(rendering.match_board(turn_step), boards[turn_step.pk])
+        first_step = TurnStep.objects.get(pk=first_step.pk)
+        self.assertEqual(rendering.encode_png(self.match.map.image_in_match(first_step)), image)
+
+    def test_latest_turn_is_not_pruned(self):
+        self.play()
+        with override_settings(KEEP_BOARD_ROWS_FOR_TURNS=0):
+            self.play_turn([])
+            self.assertFalse(TurnStep.objects.filter(turn__number=6, pruned=True).exists())
+            self.assertTrue(BoardToken.objects.filter(owner__turn_step__turn__number=6).exists())
+            self.play_turn([])
+        self.assertEqual(self.match.get_latest_turn().number, 7)
+        self.assertEqual(set(TurnStep.objects.filter(pruned=True).values_list('turn__number', flat=True)),
+                         {1, 2, 3, 4, 5, 6})
+        self.assertEqual(sorted(history.step_tokens(self.match.get_latest_turn().get_latest_step())),
+                         sorted(history.step_tokens(Turn.objects.get(match=self.match, number=6).get_latest_step())))
+
+    def test_delta(self):
+        self.play()
+        token_types = storage.load_token_types()
+        match_players = storage.load_match_players(self.match)
+        boards = [storage.load_board(turn_step, match_players, token_types)
+                  for turn_step in TurnStep.objects.filter(turn__match=self.match).order_by('turn__number', 'step')]
+        match_players = dict((match_player.id, match_player) for match_player in match_players)
+        for previous, board in zip(boards, boards[1:]):
+            delta = history.encode_delta(previous, board)
+            self.assertEqual(board_signature(history.apply_delta(previous, delta, match_players, token_types)),
+                             board_signature(board))
+            self.assertLess(len(delta), len(history.encode_board(board)))
+
+    def test_pruned_steps_are_rebuilt_from_deltas(self):
+        self.play()
+        stored = self.stored_steps()
+        with override_settings(KEEP_BOARD_ROWS_FOR_TURNS=3):
+            self.play_turn([])
+            self.play_turn([])
+        self.assertFalse(TurnStep.objects.filter(pruned=True, board_delta=None).exists())
+        history.materialized_boards.invalidate()
+
+        def replay_turn(match, turn_number):
+            raise AssertionError("Pruned steps with deltas are not replayed")
+        self.addCleanup(setattr, history, 'replay_turn', history.replay_turn)
+        history.replay_turn = replay_turn
+
+        for turn_step in TurnStep.objects.filter(pruned=True).select_related('turn__match') \
+                .order_by('-turn__number', '-step'):
+            self.assertEqual(board_signature(history.step_board(turn_step)),
+                             stored[(turn_step.turn.number, turn_step.step)])
+            with self.assertNumQueries(0):
+                board = history.step_board(turn_step)
+            board.tokens[0].position = None
+            del board.tokens[1:]
+            self.assertEqual(board_signature(history.step_board(turn_step)),
+                             stored[(turn_step.turn.number, turn_step.step)])
+
+    def test_view_pruned_turn(self):
+        self.play()
+        first_step = TurnStep.objects.for_display(Turn.objects.get(match=self.match, number=2))[0]
+        players = [(player_in_turn.match_player_id, player_in_turn.power_points,
+                    [token.type_id for token in player_in_turn.reserve_tokens])
+                   for player_in_turn in first_step.players_for_display]
+        with override_settings(KEEP_BOARD_ROWS_FOR_TURNS=1):
+            self.play_turn([])
+
+        self.client.login(username='Alice', password='apwd')
+        response = self.client.get(reverse('game.views.view_match', kwargs={'match_pk': self.match.pk}),
+                                   data={'turn': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['steps'][0].pruned)
+        self.assertEqual([(player_in_turn.match_player_id, player_in_turn.power_points,
+                           [token.type_id for token in player_in_turn.reserve_tokens])
+                          for player_in_turn in response.context['steps'][0].players_for_display], players)
+        self.assertEqual(response.context['player_in_turn'].match_player.player.user.username, 'Alice')
+
+    def test_view_pruned_turn_with_commands_and_battles(self):
+        self.play_turn([(0, Command.TYPE_MOVEMENT, "Fighter", 'NRe', 'NHQ'),
+                        (0, Command.TYPE_MOVEMENT, "Fighter", 'NHQ', 'So7'),
+                        (0, Command.TYPE_MOVEMENT, "Fighter", 'NRe', 'NHQ'),
+                        (0, Command.TYPE_MOVEMENT, "Fighter", 'NHQ', 'So7'),
+                        (1, Command.TYPE_MOVEMENT, "Small Tank", 'SRe', 'SHQ'),
+                        (1, Command.TYPE_MOVEMENT, "Small Tank", 'SHQ', 'So7')])
+        self.play_turn([])
+        with override_settings(KEEP_BOARD_ROWS_FOR_TURNS=1):
+            self.play_turn([])
+        self.assertTrue(TurnStep.objects.get(turn__match=self.match, turn__number=1, step=2).pruned)
+
+        self.client.login(username='Alice', password='apwd')
+        response = self.client.get(reverse('game.views.view_match', kwargs={'match_pk': self.match.pk}),
+                                   data={'turn': 1})
+        self.assertEqual(response.status_code, 200)
+        first_step = response.context['steps'][0]
+        self.assertTrue(first_step.pruned)
+        self.assertEqual([[command.in_game_str() for command in player_in_turn.commands.all()]
+                          for player_in_turn in first_step.players_for_display], [
+            ["Move Fighter from North Reserve to North HQ", "Move Fighter from North HQ to South 7",
+             "Move Fighter from North Reserve to North HQ", "Move Fighter from North HQ to South 7"],
+            ["Move Small Tank from South Reserve to South HQ", "Move Small Tank from South HQ to South 7"],
+        ])
+        self.assertTrue(response.context['steps'][1].pruned)
+        self.assertEqual([battle.in_game_str() for battle in response.context['steps'][1].battles.all()],
+                         ["Battle in South 7 is won by Alice, capturing 1 tokens"])
+        self.assertContains(response, "Battle in South 7 is won by Alice, capturing 1 tokens")
+        self.assertContains(response, "Move Small Tank from South HQ to South 7")
+
+    def test_pruned_steps_have_their_own_etag(self):
+        self.play()
+        steps = list(TurnStep.objects.filter(turn__match=self.match).exclude(turn=self.match.get_latest_turn())
+                     .select_related('turn__match__map').order_by('turn__number', 'step'))
+        etags = [rendering.match_map_etag(turn_step) for turn_step in steps]
+        with override_settings(KEEP_BOARD_ROWS_FOR_TURNS=1):
+            self.play_turn([])
+
+        pruned = list(TurnStep.objects.filter(pk__in=[turn_step.pk for turn_step in steps], pruned=True)
+                      .select_related('turn__match__map').order_by('turn__number', 'step'))
+        self.assertGreater(len(pruned), 2)
+        self.assertEqual([rendering.match_map_etag(turn_step) for turn_step in pruned], etags[:len(pruned)])
+        self.assertNotEqual(rendering.match_map_etag(pruned[0]), rendering.match_map_etag(pruned[1]))
+
+    def test_replay_match_command(self):
+        self.play()
+        with override_settings(KEEP_BOARD_ROWS_FOR_TURNS=2):
+            self.play_turn([(0, Command.TYPE_PURCHASE, "Small Tank", None, None)])
+        out = StringIO()
+        call_command('replay_match', str(self.match.pk), stdout=out)
+        self.assertIn("Turn 1: 2 steps in", out.getvalue())
+        self.assertIn("5 turns replayed in", out.getvalue())
+        self.assertIn(", 0 diverging", out.getvalue())
+
+        token = BoardToken.objects.filter(owner__turn_step__turn__number=5, owner__turn_step__step=2).last()
+        token.position = self.region['No5']
+        token.save()
+        out = StringIO()
+        self.assertRaises(CommandError, call_command, 'replay_match', str(self.match.pk), from_turn=4,
+                          stdout=out)
+        self.assertIn("Turn 4: 2 steps in", out.getvalue())
+        self.assertIn("Turn 5: 2 steps in", out.getvalue())
+        self.assertIn("DIVERGES\n  step 2: token", out.getvalue())
+        self.assertIn("2 turns replayed in", out.getvalue())
+
+        for options in ({'from_turn': 0}, {'repeat': 0}):
+            self.assertRaisesMessage(CommandError, "has to be at least 1", call_command, 'replay_match',
+                                     str(self.match.pk), stdout=StringIO(), **options)
+        Turn.objects.get(match=self.match, number=2).steps.all().delete()
+        self.assertRaisesMessage(CommandError, "Turn 2 of match %d has no steps" % self.match.pk, call_command,
+                                 'replay_match', str(self.match.pk), stdout=StringIO())
+
+    def test_storage_size(self):
+        for _ in range(6):
+            self.play_turn([])
+        board_rows = BoardToken.objects.filter(owner__turn_step__turn__match=self.match).count()
+        snapshots = self.match.snapshots.count()
+        self.assertEqual(history.prune_boards(self.match, 1), TurnStep.objects.filter(turn__number__lt=7).count())
+        self.assertLess(BoardToken.objects.filter(owner__turn_step__turn__match=self.match).count() * 6, board_rows)
+        self.assertEqual(self.match.snapshots.count(), snapshots)
+
+
+class CurrentPointerTests(TestCase):
+    def setUp(self):
+        self.match = create_started_match(create_test_users()[:2])
+
+    def assertCurrentStep(self, turn_step):
+        match = Match.objects.get(pk=self.match.pk)
+        self.assertEqual(match.current_turn, turn_step.turn)
+        self.assertEqual(match.current_step, turn_step)
+        first_step = turn_step.turn.steps.get(step=1)
+        for match_player in match.players.all():
+            self.assertEqual(match_player.current_turn_player, first_step.players.get(match_player=match_player))
+            self.assertEqual(match_player.current_step_player, turn_step.players.get(match_player=match_player))
+
+    def test_pointers_follow_the_turn_engine(self):
+        first_turn = Turn.objects.get(match=self.match, number=1)
+        self.assertCurrentStep(first_turn.steps.get())
+
+        new_step = first_turn.get_latest_step().create_next()
+        self.assertCurrentStep(new_step)
+        self.assertTrue(new_step.players.first().is_latest_turn_step())
+        self.assertFalse(first_turn.steps.get(step=1).players.first().is_latest_turn_step())
+
+        stale_match = Match.objects.get(pk=self.match.pk)
+        for match_player in self.match.players.all():
+            match_player.make_ready()
+        stale_match.public = True
+        stale_match.save()
+        second_turn = Turn.objects.get(match=self.match, number=2)
+        self.assertCurrentStep(second_turn.steps.get())
+        self.assertTrue(Match.objects.get(pk=self.match.pk).public)
+        self.assertEqual(self.match.get_latest_turn(), second_turn)
+        self.assertFalse(first_turn.is_latest())
+        self.assertTrue(second_turn.is_latest())
+        self.assertEqual(first_turn.get_latest_step(), first_turn.steps.order_by('-step').first())
+        self.assertFalse(new_step.players.first().is_latest_turn())
+
+    def test_lookups_do_not_depend_on_match_length(self):
+        match_player = self.match.players.first()
+        for _ in range(3):
+            for player in self.match.players.all():
+                player.make_ready()
+        turn = self.match.get_latest_turn()
+        self.assertEqual(turn.number, 4)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.match.get_latest_turn(), turn)
+        with self.assertNumQueries(1):
+            self.assertTrue(turn.is_latest())
+        with self.assertNumQueries(1):
+            player_in_turn = match_player.latest_player_in_turn_first_step()
+        self.assertEqual(player_in_turn.turn_step.turn, turn)
+        with self.assertNumQueries(1):
+            self.assertEqual(match_player.latest_player_in_turn_last_step(), player_in_turn)
+        with self.assertNumQueries(2):
+            self.assertTrue(player_in_turn.is_latest_turn())
+            self.assertTrue(player_in_turn.is_latest_turn_step())
+
+
+class RequestPlayerTests(TestCase):
+    def test_player_is_loaded_once_per_request(self):
+        match = create_started_match(create_test_users()[:2])
+        self.client.login(username='Alice', password='apwd')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('game.views.view_match', kwargs={'match_pk': match.pk}))
+        self.assertEqual(response.context['player'], Player.objects.get(user__username='Alice'))
+
+        sql = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(len([query for query in sql if 'SELECT "game_player"."id"' in query and
+                              '"game_player"."user_id" =' in query]), 1)
+        self.assertEqual(len([query for query in sql if 'SELECT "game_matchplayer"."id"' in query and
+                              '"game_matchplayer"."player_id" =' in query]), 1)
+
+    def test_get_match_player(self):
+        players = create_test_users()
+        match = create_started_match(players[:2])
+        match_player = match.players.get(player=players[0])
+        request = RequestFactory().get('/')
+        request.user = players[0].user
+        with self.assertNumQueries(2):
+            self.assertEqual(get_player(request), players[0])
+            self.assertEqual(get_match_player(request, match), match_player)
+            self.assertEqual(get_player(request), players[0])
+            self.assertEqual(get_match_player(request, match), match_player)
+
+        request.user = players[2].user
+        del request._cached_player
+        del request._cached_match_players
+        self.assertIsNone(get_match_player(request, match))
+
+
+class SetCommandsTests(TestCase):
+    def setUp(self):
+        self.players = create_test_users()
+        self.match = create_started_match(self.players[:2])
+        self.player_in_turn = self.match.players.get(player=self.players[0]).latest_player_in_turn_first_step()
+        self.regions = list(self.match.map.regions.order_by('pk')[:2])
+        self.small_tank = BoardTokenType.objects.get(name="Small Tank")
+        self.client.login(username='Alice', password='apwd')
+
+    def post(self, data):
+        return self.client.post(reverse('game.views.set_commands', kwargs={'match_pk': self.match.pk}),
+                                data=json.dumps(data), content_type='application/json')
+
+    def test_replace_commands(self):
+        Command.objects.create(player_in_turn=self.player_in_turn, order=0, type=Command.TYPE_PURCHASE,
+                               token_type=self.small_tank)
+        response = self.post({'commands': [
+            {'type': 'move', 'token_type': self.small_tank.pk, 'region_from': self.regions[0].pk,
+             'region_to': self.regions[1].pk},
+            {'type': 'buy', 'token_type': self.small_tank.pk},
+            {'type': 'buy', 'token_type': self.small_tank.pk},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([command['type'] for command in json.loads(response.content.decode())['commands']],
+                         [Command.TYPE_MOVEMENT, Command.TYPE_PURCHASE, Command.TYPE_PURCHASE])
+        self.assertEqual(list(self.player_in_turn.commands.order_by('order').values_list('order', 'type')),
+                         [(0, Command.TYPE_MOVEMENT), (1, Command.TYPE_PURCHASE), (2, Command.TYPE_PURCHASE)])
+
+        response = self.post({'commands': []})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.player_in_turn.commands.count(), 0)
+
+    def test_invalid_list_keeps_commands(self):
+        Command.objects.create(player_in_turn=self.player_in_turn, order=0, type=Command.TYPE_PURCHASE,
+                               token_type=self.small_tank)
+        other_region = MapRegion.objects.create(map=Map.objects.exclude(pk=self.match.map_id).first(), name="Other",
+                                                short_name="OTH")
+        for commands, error in (
+                ([{'type': 'buy', 'token_type': self.small_tank.pk}, {'type': 'LOL'}],
+                 "Command 2: Invalid command type"),
+                ([{'type': 'move', 'token_type': self.small_tank.pk, 'region_from': self.regions[0].pk,
+                   'region_to': other_region.pk}], "Command 1: Invalid location(s)"),
+                ([{'type': 'buy', 'token_type': 'x'}], "Command 1: Invalid token type"),
+                ([{'type': 'buy', 'token_type': self.small_tank.pk}] * (settings.COMMANDS_PER_TURN + 1),
+                 "At most %d commands per turn" % settings.COMMANDS_PER_TURN),
+                ("buy", "Commands must be a list")):
+            response = self.post({'commands': commands})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.content.decode())['error'], error)
+        self.assertEqual(self.player_in_turn.commands.count(), 1)
+
+        response = self.client.post(reverse('game.views.set_commands', kwargs={'match_pk': self.match.pk}),
+                                    data="commands", content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(RESOLVE_TURNS_IN_BACKGROUND=True)
+    def test_locked_while_resolving(self):
+        for match_player in self.match.players.all():
+            match_player.make_ready()
+        response = self.post({'commands': [{'type': 'buy', 'token_type': self.small_tank.pk}]})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.player_in_turn.commands.count(), 0)
+
+    def test_not_playing(self):
+        self.client.login(username='Carol', password='cpwd')
+        response = self.post({'commands': []})
+        self.assertEqual(response.status_code, 403)
+
+    def test_match_in_setup(self):
+        self.match = Match.objects.create_match("setupmatch", self.players[0], Map.objects.get(name="Alpha"))
+        for player in self.players[:2]:
+            MatchPlayer.objects.create_player(self.match, player)
+        response = self.post({'commands': [{'type': 'buy', 'token_type': self.small_tank.pk}]})
+        self.assertEqual(response.status_code, 409)
+
+
+@override_settings(MATCH_EVENTS_STREAM_SECONDS=0)
+class MatchEventTests(TestCase):
+    def setUp(self):
+        self.players = create_test_users()
+        self.match = create_started_match(self.players[:2])
+        self.client.login(username='Alice', password='apwd')
+
+    def stream(self, last_event_id=None):
+        extra = dict() if last_event_id is None else {'HTTP_LAST_EVENT_ID': last_event_id}
+        response = self.client.get(reverse('game.views.match_events', kwargs={'match_pk': self.match.pk}), **extra)
+        self.assertEqual(response['Content-Type'], "text/event-stream")
+        return b''.join(response.streaming_content).decode()
+
+    def test_stream_continues_from_last_event_id(self):
+        content = self.stream('0-0')
+        self.assertIn('event: turn\ndata: {"text": "Match testmatch started"}', content)
+        self.assertIn('event: notification\ndata: ', content)
+        self.assertIn('"text": "Match testmatch started!"', content)
+        last_event_id = content.split('id: ')[-1].split('\n')[0]
+
+        self.match.players.get(player=self.players[1]).make_ready()
+        content = self.stream(last_event_id)
+        self.assertIn('event: ready\ndata: {"text": "Bob is ready"}', content)
+        self.assertNotIn('Match testmatch started', content)
+
+    def test_new_stream_starts_at_latest_event(self):
+        content = self.stream()
+        self.assertEqual(content, "retry: 1000\nid: %d-%d\n\n" % (
+            MatchEvent.objects.latest_pk(self.match),
+            Notification.objects.filter(player=self.players[0]).latest('pk').pk))
+
+    def test_turn_resolved_event(self):
+        for match_player in self.match.players.all():
+            match_player.make_ready()
+        self.assertEqual(list(self.match.events.order_by('pk').values_list('type', 'text')), [
+            (MatchEvent.TYPE_TURN, "Match testmatch started"),
+            (MatchEvent.TYPE_READY, "Alice is ready"),
+            (MatchEvent.TYPE_READY, "Bob is ready"),
+            (MatchEvent.TYPE_TURN, "Turn 1 resolved"),
+        ])
+
+    def test_private_match(self):
+        self.client.login(username='Carol', password='cpwd')
+        response = self.client.get(reverse('game.views.match_events', kwargs={'match_pk': self.match.pk}))
+        self.assertRedirects(response, reverse('game.views.start'))
+
+
+class SimulatorTests(TestCase):
+    def setUp(self):
+        self.players = simulator.create_players(3, 'sim', 'spwd')
+        self.matches = simulator.create_matches(Map.objects.get(name="Alpha"), self.players, 2, 'sim')
+
+    def test_matches_fill_seats_going_around_players(self):
+        self.assertEqual([list(match.players.order_by('pk').values_list('player__user__username', flat=True))
+                          for match in self.matches], [['sim1', 'sim2'], ['sim3', 'sim1']])
+        for match in self.matches:
+            self.assertEqual(match.status, Match.STATUS_PLAYING)
+
+    def test_random_commands_are_legal(self):
+        match_player = self.matches[0].players.first()
+        graph = self.matches[0].map.graph()
+        token_types = storage.load_token_types()
+        tokens = list(BoardToken.objects.filter(owner=match_player.latest_player_in_turn_first_step())
+                      .values_list('position_id', 'type_id'))
+        commands = simulator.random_commands(random.Random(1), graph, token_types, tokens, 10)
+        self.assertEqual(len(commands), settings.COMMANDS_PER_TURN)
+        spent = 0
+        for command in commands:
+            if command['type'] == 'move':
+                self.assertIn((command['region_from'], command['token_type']), tokens)
+                self.assertTrue(graph.path_exists(token_types[command['token_type']], command['region_from'],
+                                                  command['region_to']))
+            else:
+                spent += token_types[command['token_type']].strength
+        self.assertLessEqual(spent, 10)
+
+    def test_orm_driver(self):
+        report = simulator.Simulation(self.matches, simulator.OrmDriver(), seed=1).run(3)
+        self.assertEqual(report.turns, 6)
+        self.assertEqual(len(report.latencies['commands']), 12)
+        self.assertEqual(len(report.latencies['ready']), 12)
+        self.assertTrue(all(report.turn_queries))
+        self.assertEqual(list(Turn.objects.filter(match__in=self.matches).values_list('number', flat=True)
+                              .order_by('-number'))[:2], [4, 4])
+        commands = Command.objects.filter(player_in_turn__turn_step__turn__match=self.matches[0])
+        self.assertTrue(commands.filter(valid=True).exists())
+        self.assertFalse(commands.filter(valid=False, type=Command.TYPE_PURCHASE).exists())
+
+    def test_http_driver(self):
+        report = simulator.Simulation(self.matches[:1], simulator.HttpDriver('spwd'), seed=1).run(2)
+        self.assertEqual(report.turns, 2)
+        self.assertEqual(self.matches[0].get_latest_turn().number, 3)
+
+    def test_background_resolution(self):
+        with override_settings(RESOLVE_TURNS_IN_BACKGROUND=True):
+            report = simulator.Simulation(self.matches[:1], simulator.OrmDriver(), seed=1).run(2)
+        self.assertEqual(len(report.latencies['resolve']), 2)
+        self.assertEqual(self.matches[0].get_latest_turn().number, 3)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('simulate_matches', matches=2, turns=2, prefix='load', seed=1, stdout=out)
+        self.assertIn("4 turns of 2 matches on Alpha through orm", out.getvalue())
+        self.assertIn("queries per turn", out.getvalue())
+        self.assertIn("  ready      p50", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('simulate_matches', prefix='load', stdout=StringIO())
+
+
 class MatchPlay(TestCase):
     def test_start_four_player_game(self):
         players = create_test_users()
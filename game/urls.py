@@ -23,10 +23,15 @@ urlpatterns = patterns('',
                        url(r'^match/(?P<match_pk>\d+)/make_private$', 'game.views.make_private', name='make_private'),
                        url(r'^match/(?P<match_pk>\d+)/kick/(?P<player_pk>\d+)$', 'game.views.kick', name='kick'),
                        url(r'^match/(?P<match_pk>\d+)/add_command$', 'game.views.add_command', name='add_command'),
+                       url(r'^match/(?P<match_pk>\d+)/commands$', 'game.views.set_commands', name='set_commands'),
                        url(r'^match/(?P<match_pk>\d+)/delete_command/(?P<order>\d+)$', 'game.views.delete_command',
                            name='delete_command'),
                        url(r'^match/(?P<match_pk>\d+)/map$', 'game.views.view_map_in_match', name='view_map_in_match'),
+                       url(r'^match/(?P<match_pk>\d+)/board$', 'game.views.view_board_in_match',
+                           name='view_board_in_match'),
+                       url(r'^match/(?P<match_pk>\d+)/events$', 'game.views.match_events', name='match_events'),
                        url(r'^map/(?P<map_pk>\d+)$', 'game.views.view_map', name='view_map'),
+                       url(r'^map/(?P<map_pk>\d+)/tokens$', 'game.views.view_token_atlas', name='view_token_atlas'),
                        url(r'^token/(?P<token_type_pk>\d+)$', 'game.views.view_token', name='view_token'),
 )
 
@@ -1,4 +1,8 @@
-from django.http import HttpResponse
+import hashlib
+import json
+import time
+
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.contrib.auth import authenticate, login as django_login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
@@ -7,14 +11,19 @@ from django.contrib.auth.views import logout_then_login
 from django.contrib import messages
 from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
+from django.db.models import Max
 from django.shortcuts import render, HttpResponseRedirect, get_object_or_404
 from django.conf import settings
 from django import forms
-from django.views.decorators.vary import vary_on_cookie
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 
+from game import rendering
+from game.middleware import get_match_player, get_player
+from game.templatetags import game_images
 from game.models import Match, MatchPlayer, PlayerCannotJoinMatch, MatchIsFull, MatchInWrongStatus, \
-    MatchPlayerAlreadyReady, Map, BoardTokenType, TokenConversion, TokenValueConversion, MapCountry, MapRegion, Command, \
-    Turn, PlayerInTurnStep, Player, Invite, Notification, TurnStep
+    MatchPlayerAlreadyReady, TurnBeingResolved, Map, BoardTokenType, TokenConversion, TokenValueConversion, \
+    MapCountry, MapRegion, Command, Turn, PlayerInTurnStep, Player, Invite, Notification, TurnStep, MatchEvent
 
 
 class InviteForm(forms.Form):
@@ -97,7 +106,7 @@ def game_invite(request):
             elif User.objects.filter(email=email).exists():
                 messages.error(request, 'You cannot invite this player')
             else:
-                new_invite = Invite.objects.create_invite(email=email, invitor=Player.objects.get_by_user(request.user))
+                new_invite = Invite.objects.create_invite(email=email, invitor=request.player)
                 send_mail(
                     'Invited to Repower',
 
@@ -165,14 +174,14 @@ def start(request):
         'game/start.html',
         {
             'invite_form': InviteForm(),
-            'match_players': MatchPlayer.objects.filter(player=Player.objects.get_by_user(request.user))
+            'match_players': MatchPlayer.objects.filter(player=request.player)
         }
     )
 
 
 @login_required
 def notifications(request):  # TODO separate new and old notifications
-    player = Player.objects.get_by_user(request.user)
+    player = request.player
     notifications = list(Notification.objects.filter(player=player))
     player.set_all_notifications_read()
     return render(request, 'game/notifications.html', {'notifications': notifications})
@@ -205,7 +214,7 @@ def new_match(request):
         if form.is_valid():
             name = form.cleaned_data['name']
             map = form.cleaned_data['map']
-            current_player = Player.objects.get_by_user(request.user)
+            current_player = request.player
             match = Match.objects.create_match(name, current_player, map)
             MatchPlayer.objects.create_player(match, current_player)
             return HttpResponseRedirect(match.get_absolute_url())
@@ -217,7 +226,7 @@ def new_match(request):
 @login_required
 def match_invite(request, match_pk, player_pk=None):
     match = get_object_or_404(Match, pk=match_pk)
-    player = Player.objects.get_by_user(request.user)
+    player = request.player
 
     if player_pk is not None:
         player_to_invite = get_object_or_404(Player, pk=player_pk)
@@ -246,17 +255,17 @@ def match_invite(request, match_pk, player_pk=None):
 
 @login_required
 def view_match(request, match_pk):
-    match = get_object_or_404(Match, pk=match_pk)
-    player = Player.objects.get_by_user(request.user)
+    match = get_object_or_404(Match.objects.select_related('owner__user', 'map'), pk=match_pk)
+    player = request.player
     if not match.can_view_match(player):
         messages.error(request, "You can not see this match because it's private and you are not playing in it")
         return HttpResponseRedirect(reverse('game.views.start'))
 
     token_types = BoardTokenType.objects.all()
-    conversions = TokenConversion.objects.all()
+    conversions = TokenConversion.objects.select_related('needs', 'produces')
     value_conversions = TokenValueConversion.objects.all()
 
-    match_player = MatchPlayer.objects.get_by_match_and_player(match, player)
+    match_player = get_match_player(request, match)
     is_owner = (player == match.owner)
     client_is_in_game = match_player in match.players.all()
 
@@ -277,13 +286,18 @@ def view_match(request, match_pk):
         except Turn.DoesNotExist:
             turn = match.get_latest_turn()
 
+        steps = list(TurnStep.objects.for_display(turn))
         player_in_turn = None if not client_is_in_game else \
-            PlayerInTurnStep.objects.get(match_player__match=match, match_player__player=player, turn_step__turn=turn,
-                                         turn_step__step=1)
+            [player_in_turn for player_in_turn in steps[0].players_for_display
+             if player_in_turn.match_player_id == match_player.pk][0]
 
         context = dict(list(context.items()) + list({
                                                         'player_in_turn': player_in_turn,
                                                         'turn': turn,
+                                                        'turn_is_latest': turn.is_latest(),
+                                                        'steps': steps,
+                                                        'resolving_turn': match.is_resolving_turn(),
+                                                        'turn_resolution_failed': match.turn_resolution_failed(),
                                                     }.items()))
 
     context['can_add_commands'] = \
@@ -300,7 +314,26 @@ def view_match(request, match_pk):
 @login_required()
 def view_map_in_match(request, match_pk):
     match = get_object_or_404(Match, pk=match_pk)
-    player = Player.objects.get_by_user(request.user)
+    player = request.player
+
+    if not match.can_view_match(player):
+        messages.error(request, "You can not see this match because it's private and you are not playing in it")
+        return HttpResponseRedirect(reverse('game.views.start'))
+
+    turn_number = request.GET.get('turn', match.get_latest_turn().number)
+    step_number = request.GET.get('step', 1)
+    turn_step = get_object_or_404(TurnStep.objects.select_related('turn__match__map'), turn__match=match,
+                                  turn__number=turn_number, step=step_number)
+
+    final = turn_step.is_final()
+    return image_response(request, rendering.match_map_etag(turn_step, final),
+                          lambda: rendering.match_map_png(turn_step), private=True, immutable=final)
+
+
+@login_required()
+def view_board_in_match(request, match_pk):
+    match = get_object_or_404(Match, pk=match_pk)
+    player = request.player
 
     if not match.can_view_match(player):
         messages.error(request, "You can not see this match because it's private and you are not playing in it")
@@ -310,38 +343,114 @@ def view_map_in_match(request, match_pk):
     step_number = request.GET.get('step', 1)
     turn_step = get_object_or_404(TurnStep, turn__match=match, turn__number=turn_number, step=step_number)
 
-    response = HttpResponse(content_type="image/png")
-    match.map.image_in_match(turn_step).save(response, "PNG")
+    board = rendering.match_board(turn_step)
+    board['map'] = {'id': match.map_id, 'image': game_images.map_image_url(match.map_id)}
+    board['atlas']['image'] = game_images.token_atlas_url(match.map)
+    content = json.dumps(board, separators=(',', ':')).encode()
+    return image_response(request, hashlib.sha1(content).hexdigest(), lambda: content, private=True,
+                          immutable=turn_step.is_final(), content_type="application/json")
+
+
+def match_event_stream(match, player, event_pk, notification_pk):
+    """
+    Server-sent events of match, and the notifications of player, newer than the given primary keys. Events are read
+    from the database every MATCH_EVENTS_POLL_INTERVAL seconds until MATCH_EVENTS_STREAM_SECONDS have passed. The event
+    ids carry both keys, so the browser can reconnect and continue where it left.
+    """
+    deadline = time.monotonic() + settings.MATCH_EVENTS_STREAM_SECONDS
+    # An id without data sets where the browser continues from, even if no event comes before the stream ends
+    yield "retry: 1000\nid: %d-%d\n\n" % (event_pk, notification_pk)
+    while True:
+        events = list()
+        for event in MatchEvent.objects.after(match, event_pk):
+            event_pk = event.pk
+            events.append((event.get_type_display(), event.text, None))
+        if player is not None:
+            for notification in Notification.objects.filter(player=player, pk__gt=notification_pk).order_by('pk'):
+                notification_pk = notification.pk
+                events.append(('notification', notification.text, notification.url))
+
+        for name, text, url in events:
+            data = json.dumps({'text': text, 'url': url} if url else {'text': text})
+            yield "id: %d-%d\nevent: %s\ndata: %s\n\n" % (event_pk, notification_pk, name, data)
+
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(settings.MATCH_EVENTS_POLL_INTERVAL)
+
+
+@login_required()
+def match_events(request, match_pk):
+    match = get_object_or_404(Match, pk=match_pk)
+    player = get_player(request)
+
+    if not match.can_view_match(player):
+        messages.error(request, "You can not see this match because it's private and you are not playing in it")
+        return HttpResponseRedirect(reverse('game.views.start'))
+
+    try:
+        event_pk, notification_pk = (int(pk) for pk in request.META['HTTP_LAST_EVENT_ID'].split('-'))
+    except (KeyError, ValueError):
+        event_pk = MatchEvent.objects.latest_pk(match)
+        notification_pk = Notification.objects.filter(player=player).aggregate(Max('pk'))['pk__max'] or 0
+
+    response = StreamingHttpResponse(match_event_stream(match, player, event_pk, notification_pk),
+                                     content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
     return response
 
 
-@vary_on_cookie  # TODO: not working as intended
 def view_map(request, map_pk):
+    game_map = get_object_or_404(Map, pk=map_pk)
     show_debug = request.GET.get('show_debug', False)
     show_links = request.GET.get('show_links', False)
-    response = HttpResponse(content_type="image/png")
-    get_object_or_404(Map, pk=map_pk).image(show_debug, show_links).save(response, "PNG")
-    return response
+    return image_response(request, rendering.base_map_hash(game_map, show_debug, show_links),
+                          lambda: rendering.encode_png(game_map.image(show_debug, show_links)))
+
+
+def view_token_atlas(request, map_pk):
+    atlas = rendering.token_atlas(get_object_or_404(Map, pk=map_pk))
+    # Pages link to the atlas with its hash, other versions must not be kept
+    return image_response(request, atlas.content_hash, lambda: atlas.png,
+                          immutable=request.GET.get('v') == atlas.content_hash)
 
 
-@vary_on_cookie  # TODO: not working as intended
 def view_token(request, token_type_pk):
+    token_type = get_object_or_404(BoardTokenType, pk=token_type_pk)
     country_pk = request.GET.get('country', None)
     if country_pk is not None:
         country = MapCountry.objects.get(pk=country_pk)
     else:
         country = None
 
-    response = HttpResponse(content_type="image/png")
-    get_object_or_404(BoardTokenType, pk=token_type_pk).image(country).save(response, "PNG")
+    etag, png = rendering.token_sprite_png(token_type.image_file_name,
+                                           None if country is None else country.color_gif_palette)
+    return image_response(request, etag, lambda: png, immutable=True)
+
+
+def image_response(request, etag, render, private=False, immutable=False, content_type="image/png"):
+    """
+    Response with a content hash ETag, a PNG image unless told otherwise. render() is only called when the client does
+    not have the image yet. Immutable images can be kept by clients for a year without asking again, the others are
+    revalidated every time.
+    """
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(render(), content_type=content_type)
+    response['ETag'] = quote_etag(etag)
+    if immutable:
+        response['Cache-Control'] = "%s, max-age=31536000, immutable" % ("private" if private else "public")
+    else:
+        patch_cache_control(response, private=private, public=not private, no_cache=True)
     return response
 
 
 @login_required
 def ready(request, match_pk):
     match = get_object_or_404(Match, pk=match_pk)
-    player = Player.objects.get_by_user(request.user)
-    match_player = MatchPlayer.objects.get_by_match_and_player(match, player)
+    match_player = get_match_player(request, match)
     if match_player is None:
         messages.error(request, "You are not playing in this game")
     try:
@@ -350,6 +459,8 @@ def ready(request, match_pk):
         messages.error(request, "You are already ready")
     except MatchInWrongStatus:
         messages.error(request, "The current game status doesn't allow you to be ready")
+    except TurnBeingResolved:
+        messages.error(request, "The turn is being resolved")
     return HttpResponseRedirect(match.get_absolute_url())
 
 
@@ -384,7 +495,7 @@ def kick(request, match_pk, player_pk):
     match = get_object_or_404(Match, pk=match_pk)
     player_to_kick = get_object_or_404(Player, pk=player_pk)
     match_player_to_kick = MatchPlayer.objects.get_by_match_and_player(match, player_to_kick)
-    player = Player.objects.get_by_user(request.user)
+    player = request.player
 
     if player != match.owner:
         messages.error(request, "Only the match owner can kick players")
@@ -399,10 +510,12 @@ def kick(request, match_pk, player_pk):
 @login_required
 def leave(request, match_pk):
     match = get_object_or_404(Match, pk=match_pk)
-    player = Player.objects.get_by_user(request.user)
-    match_player = MatchPlayer.objects.get_by_match_and_player(match, player)
+    match_player = get_match_player(request, match)
     if match_player is not None:
-        match_player.leave()
+        try:
+            match_player.leave()
+        except TurnBeingResolved:
+            messages.error(request, "You can not leave the match while the turn is being resolved")
     else:
         messages.error(request, "You are not participating in that game")
     return HttpResponseRedirect(match.get_absolute_url())
@@ -411,8 +524,7 @@ def leave(request, match_pk):
 @login_required
 def add_command(request, match_pk):
     match = get_object_or_404(Match, pk=match_pk)
-    player = Player.objects.get_by_user(request.user)
-    match_player = MatchPlayer.objects.get_by_match_and_player(match, player)
+    match_player = get_match_player(request, match)
 
     if match_player is None:
         messages.error(request, "You are not playing in this match")
@@ -421,6 +533,7 @@ def add_command(request, match_pk):
     elif not match_player.latest_player_in_turn_first_step().can_add_commands():
         messages.error(request, "You can not add more commands this turn")
     else:
+        player_in_turn = match_player.latest_player_in_turn_first_step()
 
         if request.POST.get('command_type') == 'move':
             try:
@@ -429,9 +542,8 @@ def add_command(request, match_pk):
                 region_to = MapRegion.objects.get(id=request.POST.get('move_region_to'))
 
                 command = Command(
-                    player_in_turn=match_player.latest_player_in_turn_first_step(),
-                    order=Command.objects.filter(
-                        player_in_turn=match_player.latest_player_in_turn_first_step()).count(),
+                    player_in_turn=player_in_turn,
+                    order=player_in_turn.commands.count(),
                     type=Command.TYPE_MOVEMENT,
                     token_type=token_type,
                     location=region_from,
@@ -452,9 +564,8 @@ def add_command(request, match_pk):
                 token_type = BoardTokenType.objects.get(id=request.POST.get('buy_token_type'))
 
                 command = Command(
-                    player_in_turn=match_player.latest_player_in_turn_first_step(),
-                    order=Command.objects.filter(
-                        player_in_turn=match_player.latest_player_in_turn_first_step()).count(),
+                    player_in_turn=player_in_turn,
+                    order=player_in_turn.commands.count(),
                     type=Command.TYPE_PURCHASE,
                     token_type=token_type
                 )
@@ -472,9 +583,8 @@ def add_command(request, match_pk):
                 location = MapRegion.objects.get(id=request.POST.get('convert_region'))
 
                 command = Command(
-                    player_in_turn=match_player.latest_player_in_turn_first_step(),
-                    order=Command.objects.filter(
-                        player_in_turn=match_player.latest_player_in_turn_first_step()).count(),
+                    player_in_turn=player_in_turn,
+                    order=player_in_turn.commands.count(),
                     type=Command.TYPE_CONVERSION,
                     conversion=conversion,
                     location=location
@@ -495,11 +605,41 @@ def add_command(request, match_pk):
     return HttpResponseRedirect(match.get_absolute_url())
 
 
+@login_required
+def set_commands(request, match_pk):
+    match = get_object_or_404(Match, pk=match_pk)
+    match_player = get_match_player(request, match)
+
+    if match_player is None:
+        return JsonResponse({'error': "You are not playing in this match"}, status=403)
+    elif request.method != 'POST':
+        return JsonResponse({'error': "Post me the commands"}, status=405)
+
+    try:
+        commands = json.loads(request.body.decode())['commands']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "Post a JSON object with a list of commands"}, status=400)
+
+    player_in_turn = match_player.latest_player_in_turn_first_step()
+    locked = JsonResponse({'error': "You can not change your commands this turn"}, status=409)
+    if player_in_turn is None or not match.is_in_progress():
+        return locked
+
+    try:
+        commands = Command.objects.replace_commands(player_in_turn, commands)
+    except Command.InvalidCommandList as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Command.CommandsLocked:
+        return locked
+
+    return JsonResponse({'commands': [{'order': command.order, 'type': command.type, 'text': command.in_game_str()}
+                                      for command in commands]})
+
+
 @login_required
 def delete_command(request, match_pk, order):
     match = get_object_or_404(Match, pk=match_pk)
-    player = Player.objects.get_by_user(request.user)
-    match_player = MatchPlayer.objects.get_by_match_and_player(match, player)
+    match_player = get_match_player(request, match)
 
     if match_player is None:
         messages.error(request, "You are not playing in this match")